@@ -0,0 +1,352 @@
+import re
+from datetime import datetime, timedelta, timezone as fixed_timezone
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python 3.8
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import numpy as np
+
+# Numerical input features shown on the Analysis page
+ANALYSIS_FEATURES = [
+    'Age', 'Bilirubin', 'Cholesterol', 'Albumin', 'Copper',
+    'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin'
+]
+CATEGORICAL_FILTERS = {
+    'drug': 'Drug', 'sex': 'Sex', 'ascites': 'Ascites', 'hepatomegaly': 'Hepatomegaly',
+    'spiders': 'Spiders', 'edema': 'Edema'
+}
+BINNING_METHODS = ('equal_width', 'quantile')
+MAX_BINS = 100
+# Bucket labels per trend granularity; weeks start on Monday and are labelled by that day
+TREND_GRANULARITIES = {'hour': '%Y-%m-%dT%H:00', 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}
+TREND_BREAKDOWNS = ('risk_level', 'prediction')
+UTC_OFFSET = re.compile(r'^[+-](\d{2}):?(\d{2})?$')
+DATE_ONLY = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def parse_analysis_filters(args):
+    """Build a $match document from the analysis filters in a request's query string.
+
+    Supports risk_level, prediction, model_version, stage, the categorical
+    inputs (drug, sex, ascites, hepatomegaly, spiders, edema),
+    min_<feature>/max_<feature> for the ANALYSIS_FEATURES (lower case, e.g.
+    min_bilirubin) and an ISO 8601 date_from/date_to on the prediction
+    timestamp. A date_to without a time includes that whole day, as in
+    the correlation endpoint. Raises ValueError naming the parameter that
+    does not parse.
+    """
+    query = {}
+    for name, field in (('risk_level', 'risk_level'), ('prediction', 'prediction'),
+                        ('model_version', 'model_version')):
+        if args.get(name):
+            query[field] = args[name]
+    for name, feature in CATEGORICAL_FILTERS.items():
+        if args.get(name):
+            query[f'input_data.{feature}'] = args[name]
+
+    def number(name):
+        try:
+            return float(args[name])
+        except ValueError:
+            raise ValueError(f'{name} must be a number')
+
+    if args.get('stage'):
+        query['input_data.Stage'] = number('stage')
+    for feature in ANALYSIS_FEATURES:
+        bounds = {}
+        for prefix, operator in (('min', '$gte'), ('max', '$lte')):
+            name = f'{prefix}_{feature.lower()}'
+            if args.get(name):
+                bounds[operator] = number(name)
+        if bounds:
+            query[f'input_data.{feature}'] = bounds
+
+    timestamp = {}
+    for name, operator in (('date_from', '$gte'), ('date_to', '$lte')):
+        if args.get(name):
+            try:
+                bound = datetime.fromisoformat(args[name])
+            except ValueError:
+                raise ValueError(f'{name} must be an ISO 8601 date')
+            if name == 'date_to' and DATE_ONLY.match(args[name]):
+                operator, bound = '$lt', bound + timedelta(days=1)
+            timestamp[operator] = bound
+    if timestamp:
+        query['timestamp'] = timestamp
+    return query
+
+
+def finite_number(expression):
+    """Aggregation expression for a value as a double, or null if it is missing, not numeric, NaN or infinite.
+
+    The server-side equivalent of the float() and isnan/isinf checks the
+    analysis endpoints used to run on every document in Python.
+    """
+    value = {'$convert': {'input': expression, 'to': 'double', 'onError': None, 'onNull': None}}
+    return {'$let': {
+        'vars': {'value': value},
+        'in': {'$cond': [
+            {'$and': [{'$gt': ['$$value', float('-inf')]}, {'$lt': ['$$value', float('inf')]}]},
+            '$$value',
+            None
+        ]}
+    }}
+
+
+def numeric_inputs_stage(features):
+    """$project of input_data features to finite doubles (or null), one top-level field per feature."""
+    return {'$project': {'_id': 0, **{feature: finite_number(f'$input_data.{feature}') for feature in features}}}
+
+
+def feature_stats_group(features):
+    """$group accumulators for count, min, max, mean and population std of each projected feature."""
+    group = {'_id': None}
+    for feature in features:
+        group[f'{feature}__count'] = {'$sum': {'$cond': [{'$eq': [f'${feature}', None]}, 0, 1]}}
+        group[f'{feature}__min'] = {'$min': f'${feature}'}
+        group[f'{feature}__max'] = {'$max': f'${feature}'}
+        group[f'{feature}__mean'] = {'$avg': f'${feature}'}
+        group[f'{feature}__std'] = {'$stdDevPop': f'${feature}'}
+    return group
+
+
+def _feature_stats(row, feature):
+    return {stat: row.get(f'{feature}__{stat}') for stat in ('count', 'min', 'max', 'mean', 'std')}
+
+
+def equal_width_edges(minimum, maximum, bins):
+    """np.histogram's edges for bins equal-width bins; a single unit-wide bin when all values are equal."""
+    if minimum == maximum:
+        return [minimum - 0.5, maximum + 0.5]
+    return np.linspace(minimum, maximum, bins + 1).tolist()
+
+
+def _distribution(stats, histogram):
+    counts = [bucket['count'] for bucket in histogram]
+    return {
+        'histogram': histogram,
+        'mean': float(stats['mean']),
+        'std': float(stats['std'] or 0.0),
+        'min': float(stats['min']),
+        'max': float(stats['max']),
+        'count': int(stats['count']),
+        'max_count': int(max(counts)) if counts else 1
+    }
+
+
+def feature_distributions(collection, match=None, features=ANALYSIS_FEATURES, bins=10, binning='equal_width'):
+    """Histogram, mean and std of each numerical input feature, computed inside MongoDB.
+
+    Only bucket counts and per-feature statistics come back to Python, so
+    the cost on the API worker does not grow with the collection. With
+    'quantile' binning this is a single $facet aggregation of $bucketAuto
+    buckets (roughly equal counts) next to a statistics facet. With
+    'equal_width' binning the edges depend on each feature's min and max,
+    so a statistics $group runs first and a $facet of $bucket stages second.
+    The result is the same as np.histogram over the values that float()
+    accepts, as the endpoint used to compute in Python.
+    """
+    prefix = ([{'$match': match}] if match else []) + [numeric_inputs_stage(features)]
+
+    if binning == 'quantile':
+        facets = {'stats': [{'$group': feature_stats_group(features)}]}
+        for feature in features:
+            facets[feature] = [
+                {'$match': {feature: {'$ne': None}}},
+                {'$bucketAuto': {'groupBy': f'${feature}', 'buckets': bins, 'output': {'count': {'$sum': 1}}}}
+            ]
+        result = next(collection.aggregate(prefix + [{'$facet': facets}], allowDiskUse=True), None)
+        stats_row = (result or {}).get('stats') or [{}]
+        distributions = {}
+        for feature in features:
+            stats = _feature_stats(stats_row[0], feature)
+            if not stats['count']:
+                continue
+            histogram = [
+                {'range': f"{bucket['_id']['min']:.1f}-{bucket['_id']['max']:.1f}", 'count': int(bucket['count'])}
+                for bucket in result[feature]
+            ]
+            distributions[feature] = _distribution(stats, histogram)
+        return distributions
+
+    stats_row = next(collection.aggregate(prefix + [{'$group': feature_stats_group(features)}], allowDiskUse=True),
+                     None) or {}
+    stats = {feature: _feature_stats(stats_row, feature) for feature in features}
+    edges = {feature: equal_width_edges(stats[feature]['min'], stats[feature]['max'], bins)
+             for feature in features if stats[feature]['count']}
+    if not edges:
+        return {}
+
+    facets = {}
+    for feature, feature_edges in edges.items():
+        # $bucket's upper boundary is exclusive; np.histogram's last bin includes the maximum
+        boundaries = feature_edges[:-1] + [float(np.nextafter(feature_edges[-1], np.inf))]
+        facets[feature] = [
+            {'$match': {feature: {'$ne': None}}},
+            # Documents inserted since the statistics pass can fall outside the edges
+            {'$bucket': {'groupBy': f'${feature}', 'boundaries': boundaries, 'default': 'outside',
+                         'output': {'count': {'$sum': 1}}}}
+        ]
+    result = next(collection.aggregate(prefix + [{'$facet': facets}], allowDiskUse=True), None) or {}
+
+    distributions = {}
+    for feature, feature_edges in edges.items():
+        counts = dict.fromkeys(range(len(feature_edges) - 1), 0)
+        lower_bounds = {edge: i for i, edge in enumerate(feature_edges[:-1])}
+        for bucket in result.get(feature, []):
+            if bucket['_id'] in lower_bounds:
+                counts[lower_bounds[bucket['_id']]] = int(bucket['count'])
+        histogram = [
+            {'range': f'{feature_edges[i]:.1f}-{feature_edges[i + 1]:.1f}', 'count': counts[i]}
+            for i in range(len(feature_edges) - 1)
+        ]
+        distributions[feature] = _distribution(stats[feature], histogram)
+    return distributions
+
+
+def parse_timezone(name):
+    """tzinfo for an Olson name (Europe/Berlin) or a UTC offset (+05:30), as MongoDB's date operators accept them.
+
+    Raises ValueError if it is neither.
+    """
+    offset = UTC_OFFSET.match(name)
+    if offset:
+        hours, minutes = int(offset.group(1)), int(offset.group(2) or 0)
+        sign = -1 if name.startswith('-') else 1
+        return fixed_timezone(sign * timedelta(hours=hours, minutes=minutes))
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f'Unknown timezone: {name}')
+
+
+def localize_timestamp_filter(match, tz):
+    """Read naive date_from/date_to bounds of a parse_analysis_filters() query as local times in tz."""
+    bounds = match.get('timestamp')
+    if not bounds:
+        return match
+    localized = {}
+    for operator, bound in bounds.items():
+        if bound.tzinfo is None:
+            bound = bound.replace(tzinfo=tz)
+        localized[operator] = bound.astimezone(fixed_timezone.utc).replace(tzinfo=None)
+    return {**match, 'timestamp': localized}
+
+
+def temporal_trends(collection, match=None, granularity='day', timezone='UTC', breakdown=None):
+    """Prediction counts per hour, day, week or month, computed inside MongoDB.
+
+    Timestamps are truncated with $dateTrunc in ``timezone`` and counted
+    with $group, so only one row per bucket (and breakdown value) comes
+    back, not every timestamp. A range on timestamp in ``match`` uses the
+    timestamp index. Timestamps stored as ISO strings are still counted,
+    and compared with a range once converted. With ``breakdown`` ('risk_level' or 'prediction') each bucket also
+    carries its count per value.
+    """
+    date = {'$convert': {'input': '$timestamp', 'to': 'date', 'onError': None, 'onNull': None}}
+    bucket = {'$dateTrunc': {'date': date, 'unit': granularity, 'timezone': timezone, 'startOfWeek': 'monday'}}
+    group_id = {'bucket': bucket}
+    if breakdown is not None:
+        group_id['value'] = f'${breakdown}'
+    stages = [{'$match': match}] if match else []
+    bounds = (match or {}).get('timestamp')
+    if isinstance(bounds, dict):
+        # A date range never matches strings, so those are picked by type and compared after $convert
+        rest = {field: condition for field, condition in match.items() if field != 'timestamp'}
+        stages = [
+            {'$match': {**rest, '$or': [{'timestamp': bounds}, {'timestamp': {'$type': 'string'}}]}},
+            {'$match': {'$expr': {'$and': [{operator: [date, bound]} for operator, bound in bounds.items()]}}}
+        ]
+    pipeline = stages + [
+        {'$group': {'_id': group_id, 'count': {'$sum': 1}}},
+        {'$match': {'_id.bucket': {'$ne': None}}},
+        {'$sort': {'_id.bucket': 1}},
+        {'$project': {
+            '_id': 0,
+            'date': {'$dateToString': {'date': '$_id.bucket', 'format': TREND_GRANULARITIES[granularity],
+                                       'timezone': timezone}},
+            'value': '$_id.value',
+            'count': 1
+        }}
+    ]
+
+    trends = {}
+    for row in collection.aggregate(pipeline, allowDiskUse=True):
+        trend = trends.setdefault(row['date'], {'date': row['date'], 'count': 0})
+        trend['count'] += row['count']
+        if breakdown is not None:
+            value = row.get('value')
+            value = 'Unknown' if value is None else str(value)
+            counts = trend.setdefault('breakdown', {})
+            counts[value] = counts.get(value, 0) + row['count']
+    return list(trends.values())
+
+
+def _unless_missing(expression, default):
+    """The field, or default when the document does not have it at all (null stays null)."""
+    return {'$cond': [{'$eq': [{'$type': expression}, 'missing']}, default, expression]}
+
+
+def _as_string(expression):
+    return {'$convert': {'input': expression, 'to': 'string', 'onError': None, 'onNull': None}}
+
+
+# name -> group key expression (null leaves the prediction out), groups always listed, minimum group size
+SUBGROUP_DIMENSIONS = {
+    'gender': ({'$let': {
+        'vars': {'sex': {'$toUpper': _as_string(_unless_missing('$input_data.Sex', 'M'))}},
+        'in': {'$switch': {'branches': [
+            {'case': {'$in': ['$$sex', ['M', 'MALE']]}, 'then': 'Male'},
+            {'case': {'$in': ['$$sex', ['F', 'FEMALE']]}, 'then': 'Female'}
+        ], 'default': None}}
+    }}, ('Male', 'Female'), 0),
+    'risk_level': ({'$let': {
+        'vars': {'risk': _unless_missing('$risk_level', 'Low')},
+        'in': {'$cond': [{'$in': ['$$risk', ['Low', 'Medium', 'High']]}, '$$risk', None]}
+    }}, ('Low', 'Medium', 'High'), 0),
+    'age_group': ({'$let': {
+        'vars': {'age': finite_number('$input_data.Age')},
+        'in': {'$cond': [{'$gt': ['$$age', 0]}, {'$cond': [{'$lt': ['$$age', 50]}, 'Under_50', 'Over_50']}, None]}
+    }}, ('Under_50', 'Over_50'), 0),
+    'stage': ({'$let': {
+        'vars': {'stage': finite_number('$input_data.Stage')},
+        'in': {'$cond': [
+            {'$and': [{'$gte': ['$$stage', 1]}, {'$lte': ['$$stage', 4]}]},
+            {'$concat': ['Stage_', {'$toString': {'$toInt': {'$trunc': '$$stage'}}}]},
+            None
+        ]}
+    }}, (), 0),
+    'drug': ({'$let': {
+        'vars': {'drug': _as_string(_unless_missing('$input_data.Drug', 'Unknown'))},
+        'in': {'$cond': [{'$in': ['$$drug', [None, '']]}, None, '$$drug']}
+    }}, (), 5),
+}
+SUBGROUP_METRICS = ('Age', 'Bilirubin', 'Albumin')
+
+
+def subgroup_comparison(collection, match=None, dimensions=tuple(SUBGROUP_DIMENSIONS), metrics=SUBGROUP_METRICS):
+    """Count and metric averages per subgroup of each dimension, in a single aggregation.
+
+    One $project computes every prediction's group key per dimension and
+    its metrics as finite doubles, and a $facet groups by each dimension
+    side by side, so the collection is read once whatever is selected.
+    Metrics are ANALYSIS_FEATURES, reported as avg_<metric> (lower case).
+    """
+    project = {'_id': 0, **{dimension: SUBGROUP_DIMENSIONS[dimension][0] for dimension in dimensions},
+               **{metric: finite_number(f'$input_data.{metric}') for metric in metrics}}
+    averages = {f'avg_{metric.lower()}': {'$avg': f'${metric}'} for metric in metrics}
+    facets = {dimension: [{'$group': {'_id': f'${dimension}', 'count': {'$sum': 1}, **averages}}]
+              for dimension in dimensions}
+    pipeline = ([{'$match': match}] if match else []) + [{'$project': project}, {'$facet': facets}]
+    result = next(collection.aggregate(pipeline, allowDiskUse=True), None) or {}
+
+    comparisons = {}
+    for dimension in dimensions:
+        _, listed_groups, min_count = SUBGROUP_DIMENSIONS[dimension]
+        groups = {group: {'count': 0, **dict.fromkeys(averages)} for group in listed_groups}
+        for row in result.get(dimension, []):
+            if row['_id'] is None or row['count'] < min_count:
+                continue
+            groups[row['_id']] = {'count': int(row['count']), **{name: row.get(name) for name in averages}}
+        comparisons[dimension] = groups
+    return comparisons
@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from pymongo import MongoClient
+from analytics import ANALYSIS_FEATURES, feature_distributions, subgroup_comparison, temporal_trends
+from correlation import CorrelationStore
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_COLUMNS = [
+    'N_Days', 'Drug', 'Age', 'Sex', 'Ascites', 'Hepatomegaly', 'Spiders', 'Edema', 'Bilirubin', 'Cholesterol',
+    'Albumin', 'Copper', 'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin', 'Stage'
+]
+RISK_LEVELS = {'C': 'Low', 'CL': 'Medium', 'D': 'High'}
+SERVING_DATABASE = 'liverlens_db'
+
+
+def seed(collection, train_path, documents, batch_size=10000, users=50, days=3 * 365, irregular=0.0):
+    """Insert synthetic prediction records shaped like the API's, resampled from data/train.csv.
+
+    Ages are converted to years as the API stores them, and missing values
+    stay missing (None), as they do for bulk uploads. A share ``irregular``
+    of the records is stored the way older data can be: an ISO 8601 string
+    timestamp, one feature as a numeric string and another as text, which
+    exercises the server-side $convert expressions.
+    """
+    train = pd.read_csv(train_path)
+    train['Age'] = train['Age'] / 365.25
+    rng = np.random.default_rng(0)
+    start = datetime.utcnow() - timedelta(days=days)
+    inserted = 0
+    while inserted < documents:
+        size = min(batch_size, documents - inserted)
+        sample = train.iloc[rng.integers(0, len(train), size)]
+        inputs = sample[INPUT_COLUMNS].astype(object).where(sample[INPUT_COLUMNS].notna(), None).to_dict('records')
+        seconds = rng.integers(0, days * 86400, size)
+        irregular_rows = rng.random(size) < irregular
+        features = rng.choice(ANALYSIS_FEATURES, (size, 2), replace=True)
+        records = []
+        for i, (data, status) in enumerate(zip(inputs, sample['Status'])):
+            data.update({'Patient_Name': f'Patient {inserted + i}', 'Patient_ID': f'P{inserted + i}'})
+            timestamp = start + timedelta(seconds=int(seconds[i]))
+            if irregular_rows[i]:
+                as_string, as_text = features[i]
+                if data[as_string] is not None:
+                    data[as_string] = str(data[as_string])
+                data[as_text] = 'n/a'
+                timestamp = timestamp.isoformat() + 'Z'
+            records.append({
+                'user_id': f'user{int(seconds[i]) % users}',
+                'input_data': data,
+                'prediction': status,
+                'probabilities': {label: float(label == status) for label in RISK_LEVELS},
+                'risk_level': RISK_LEVELS[status],
+                'model_version': 'benchmark',
+                'timestamp': timestamp
+            })
+        collection.insert_many(records, ordered=False)
+        inserted += size
+        print(f"Inserted {inserted}/{documents}", file=sys.stderr)
+
+
+def legacy_feature_distribution(collection, bins=10):
+    """The endpoint before it moved into MongoDB: every document fetched and binned in Python."""
+    predictions = list(collection.find({}, {'input_data': 1}))
+    distributions = {}
+    for feature in ANALYSIS_FEATURES:
+        values = []
+        for pred in predictions:
+            value = pred.get('input_data', {}).get(feature)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (ValueError, TypeError):
+                continue
+            if not np.isnan(value) and not np.isinf(value):
+                values.append(value)
+        if not values:
+            continue
+        values = np.array(values)
+        if values.min() == values.max():
+            edges = np.array([values.min() - 0.5, values.max() + 0.5])
+        else:
+            edges = np.linspace(values.min(), values.max(), bins + 1)
+        hist, edges = np.histogram(values, bins=edges)
+        distributions[feature] = {
+            'histogram': [{'range': f'{edges[i]:.1f}-{edges[i + 1]:.1f}', 'count': int(hist[i])}
+                          for i in range(len(hist))],
+            'mean': float(values.mean()),
+            'std': float(values.std()),
+            'max_count': int(hist.max())
+        }
+    return distributions
+
+
+def legacy_correlation(collection):
+    """The correlation endpoint before it read stored moments: every document into a DataFrame and df.corr()."""
+    rows = []
+    for pred in collection.find({}, {'input_data': 1}):
+        row = {}
+        for feature in ANALYSIS_FEATURES:
+            value = pred.get('input_data', {}).get(feature)
+            try:
+                value = float(value) if value is not None else np.nan
+            except (ValueError, TypeError):
+                value = np.nan
+            row[feature] = value if np.isfinite(value) else np.nan
+        rows.append(row)
+    correlation = pd.DataFrame(rows).dropna(axis=1, how='all').corr()
+    return {'features': list(correlation.columns), 'matrix': np.nan_to_num(correlation.to_numpy()).tolist()}
+
+
+def correlation_store(collection):
+    return CorrelationStore(collection.database['correlation_stats'], flush_interval=0)
+
+
+def stored_correlation(collection):
+    """What /api/analysis/correlation does now: one stored document read."""
+    moments = correlation_store(collection).read()
+    present = np.diag(moments.n) > 0
+    features = [feature for feature, keep in zip(ANALYSIS_FEATURES, present) if keep]
+    return {'features': features,
+            'matrix': np.nan_to_num(moments.correlation()[np.ix_(present, present)]).tolist()}
+
+
+def same_correlation(result, baseline):
+    return result['features'] == baseline['features'] and np.allclose(result['matrix'], baseline['matrix'],
+                                                                       rtol=0, atol=1e-9)
+
+
+def legacy_temporal_trends(collection):
+    """The temporal trends endpoint before $dateTrunc: every timestamp counted per day in Python."""
+    date_counts = {}
+    for pred in collection.find({}, {'timestamp': 1}):
+        timestamp = pred.get('timestamp')
+        if timestamp:
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+            date = timestamp.strftime('%Y-%m-%d')
+            date_counts[date] = date_counts.get(date, 0) + 1
+    return sorted(({'date': date, 'count': count} for date, count in date_counts.items()), key=lambda x: x['date'])
+
+
+def legacy_subgroup_comparison(collection):
+    """The subgroup comparison before $facet: every prediction loaded, one Python pass per dimension."""
+    predictions = list(collection.find({}, {'input_data': 1, 'risk_level': 1}))
+
+    def safe_float(value):
+        try:
+            return float(value) if value is not None else None
+        except (ValueError, TypeError):
+            return None
+
+    def group_stats(group):
+        stats = {'count': len(group)}
+        for feature in ('Age', 'Bilirubin', 'Albumin'):
+            values = [safe_float(pred.get('input_data', {}).get(feature)) for pred in group]
+            values = [value for value in values if value is not None]
+            stats[f'avg_{feature.lower()}'] = float(np.mean(values)) if values else None
+        return stats
+
+    groups = {'gender': {'Male': [], 'Female': []}, 'risk_level': {'Low': [], 'Medium': [], 'High': []},
+              'age_group': {'Under_50': [], 'Over_50': []}, 'stage': {}, 'drug': {}}
+    for pred in predictions:
+        data = pred.get('input_data', {})
+        sex = data.get('Sex', 'M')
+        sex = str(sex).upper() if sex else None
+        if sex in ('M', 'MALE', 'F', 'FEMALE'):
+            groups['gender']['Male' if sex in ('M', 'MALE') else 'Female'].append(pred)
+        risk = pred.get('risk_level', 'Low')
+        if risk in groups['risk_level']:
+            groups['risk_level'][risk].append(pred)
+        age = safe_float(data.get('Age'))
+        if age is not None and age > 0:
+            groups['age_group']['Under_50' if age < 50 else 'Over_50'].append(pred)
+        stage = safe_float(data.get('Stage'))
+        if stage is not None and 1 <= stage <= 4:
+            groups['stage'].setdefault(f'Stage_{int(stage)}', []).append(pred)
+        drug = data.get('Drug', 'Unknown')
+        if drug:
+            groups['drug'].setdefault(str(drug), []).append(pred)
+    return {dimension: {name: group_stats(group) for name, group in dimension_groups.items()
+                        if dimension != 'drug' or len(group) >= 5}
+            for dimension, dimension_groups in groups.items()}
+
+
+def same_subgroups(result, baseline):
+    if result.keys() != baseline.keys():
+        return False
+    for dimension, groups in baseline.items():
+        if result[dimension].keys() != groups.keys():
+            return False
+        for name, expected in groups.items():
+            actual = result[dimension][name]
+            if actual['count'] != expected['count']:
+                return False
+            for stat, value in expected.items():
+                if (value is None) != (actual[stat] is None) or (
+                        value is not None and not np.isclose(actual[stat], value, rtol=1e-9)):
+                    return False
+    return True
+
+
+def same_distributions(result, baseline):
+    """Histograms identical and mean/std equal up to float summation order."""
+    if set(result) != set(baseline):
+        return False
+    for feature, expected in baseline.items():
+        actual = result[feature]
+        if actual['histogram'] != expected['histogram'] or actual['max_count'] != expected['max_count']:
+            return False
+        for stat in ('mean', 'std'):
+            if not np.isclose(actual[stat], expected[stat], rtol=1e-9, atol=1e-9):
+                return False
+    return True
+
+
+# name -> (function of the collection, baseline case it must agree with, comparison); run in this order
+CASES = {
+    'feature_distribution_legacy': (legacy_feature_distribution, None, None),
+    'feature_distribution': (lambda collection: feature_distributions(collection), 'feature_distribution_legacy',
+                             same_distributions),
+    'feature_distribution_quantile': (lambda collection: feature_distributions(collection, binning='quantile'),
+                                      None, None),
+    'correlation_legacy': (legacy_correlation, None, None),
+    'correlation_rebuild': (lambda collection: correlation_store(collection).rebuild(collection), None, None),
+    'correlation': (stored_correlation, 'correlation_legacy', same_correlation),
+    'temporal_trends_legacy': (legacy_temporal_trends, None, None),
+    'temporal_trends': (lambda collection: temporal_trends(collection), 'temporal_trends_legacy',
+                        lambda result, baseline: result == baseline),
+    'temporal_trends_month_by_risk': (lambda collection: temporal_trends(collection, granularity='month',
+                                                                         breakdown='risk_level'), None, None),
+    'subgroup_comparison_legacy': (legacy_subgroup_comparison, None, None),
+    'subgroup_comparison': (lambda collection: subgroup_comparison(collection), 'subgroup_comparison_legacy',
+                            same_subgroups),
+}
+
+
+def measure(function, collection, repeat):
+    """Best wall time over repeat runs, and the peak Python allocation of one run."""
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(collection)
+        seconds.append(time.perf_counter() - started)
+    tracemalloc.start()
+    function(collection)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'best_seconds': min(seconds), 'median_seconds': float(np.median(seconds)),
+                    'python_peak_mb': peak / 2 ** 20}
+
+
+def run(collection, case_names, repeat, output):
+    documents = collection.estimated_document_count()
+    results = {'created_at': datetime.utcnow().isoformat(), 'documents': documents, 'cases': {}}
+    outputs = {}
+    for name in case_names:
+        function, baseline, compare = CASES[name]
+        print(f"Running {name} on {documents} documents...", file=sys.stderr)
+        outputs[name], results['cases'][name] = measure(function, collection, repeat)
+        if baseline is not None and baseline in outputs:
+            results['cases'][name]['matches_baseline'] = bool(compare(outputs[name], outputs[baseline]))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"{'case':<32} {'best s':>8} {'median s':>9} {'peak MB':>8}  matches baseline")
+    for name, case in results['cases'].items():
+        print(f"{name:<32} {case['best_seconds']:>8.3f} {case['median_seconds']:>9.3f} "
+              f"{case['python_peak_mb']:>8.1f}  {case.get('matches_baseline', '-')}")
+    print(f"Wrote {output}")
+    mismatched = [name for name, case in results['cases'].items() if case.get('matches_baseline') is False]
+    if mismatched:
+        raise SystemExit(f"Results differ from the baseline for: {', '.join(mismatched)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a benchmark database with synthetic predictions and time '
+                                                 'the analysis queries against it')
+    parser.add_argument('--mongo-uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='liverlens_benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help='Replace the benchmark collection with synthetic predictions')
+    seed_parser.add_argument('--documents', type=int, default=1_000_000)
+    seed_parser.add_argument('--train', default=os.path.join(BACKEND_DIR, '..', 'data', 'train.csv'))
+    seed_parser.add_argument('--irregular', type=float, default=0.0,
+                             help='Share of records with a string timestamp and string feature values')
+
+    run_parser = subparsers.add_parser('run', help='Time each case and check it against its baseline')
+    run_parser.add_argument('--cases', default=','.join(CASES))
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--output', default='analytics_benchmark.json')
+
+    args = parser.parse_args()
+    if args.database == SERVING_DATABASE:
+        raise SystemExit(f"Refusing to use the serving database {SERVING_DATABASE}")
+    collection = MongoClient(args.mongo_uri)[args.database]['predictions']
+
+    if args.command == 'seed':
+        collection.drop()
+        seed(collection, args.train, args.documents, irregular=args.irregular)
+        correlation_store(collection).rebuild(collection)
+    else:
+        unknown = [name for name in args.cases.split(',') if name not in CASES]
+        if unknown:
+            raise SystemExit(f"Unknown cases: {', '.join(unknown)} (choose from {', '.join(CASES)})")
+        run(collection, args.cases.split(','), args.repeat, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from model_store import ModelStore
+
+SUBMISSION_PREFIX = 'Status_'
+
+# Set in each pool process by _init_worker; the model is loaded once per process
+_worker_model = None
+
+
+def _init_worker(model_dir, bundle_dir, backend):
+    global _worker_model
+    _worker_model = ModelStore(model_dir=model_dir, bundle_dir=bundle_dir, backend=backend, nthread=1).load()
+
+
+def _worker_ready(_):
+    return os.getpid()
+
+
+def _score_chunk(chunk):
+    features = _worker_model.feature_plan.encode_frame(chunk)
+    return chunk['id'].to_numpy(), _worker_model.scorer.predict_proba(features)
+
+
+def start_pool(store, workers):
+    """Start the scoring processes and wait until each has loaded the model."""
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(store.model_dir, store.bundle_dir, store.backend)
+    )
+    list(pool.map(_worker_ready, range(workers)))
+    return pool
+
+
+def score_file(input_path, pool, workers, chunk_size, class_labels):
+    """Score a CSV in the data/test.csv schema and return the submission DataFrame.
+
+    Chunks are scored on a pool of processes that each hold the model, with
+    at most two chunks per worker read ahead; results are kept in file order.
+    """
+    ids, probabilities = [], []
+    with pd.read_csv(input_path, chunksize=chunk_size) as chunks:
+        pending = []
+        for chunk in chunks:
+            pending.append(pool.submit(_score_chunk, chunk))
+            if len(pending) >= workers * 2:
+                chunk_ids, chunk_probabilities = pending.pop(0).result()
+                ids.append(chunk_ids)
+                probabilities.append(chunk_probabilities)
+        for future in pending:
+            chunk_ids, chunk_probabilities = future.result()
+            ids.append(chunk_ids)
+            probabilities.append(chunk_probabilities)
+
+    if not ids:
+        return pd.DataFrame(columns=['id'] + [SUBMISSION_PREFIX + label for label in class_labels])
+    submission = pd.DataFrame(np.vstack(probabilities), columns=[SUBMISSION_PREFIX + label for label in class_labels])
+    submission.insert(0, 'id', np.concatenate(ids))
+    return submission
+
+
+def compare_submissions(output_path, reference_path):
+    """Compare two submission files row by row; returns (exact rows, total rows, max abs diff)."""
+    output = pd.read_csv(output_path, dtype=str).set_index('id')
+    reference = pd.read_csv(reference_path, dtype=str).set_index('id')
+    if list(output.columns) != list(reference.columns) or not output.index.equals(reference.index):
+        raise SystemExit(f"{output_path} and {reference_path} do not have the same ids and columns")
+    exact = int((output == reference).all(axis=1).sum())
+    max_diff = float(np.abs(output.astype(np.float64) - reference.astype(np.float64)).to_numpy().max())
+    return exact, len(reference), max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a CSV in the data/test.csv schema into a submission file')
+    parser.add_argument('input', nargs='?', default=os.path.join('..', 'data', 'test.csv'))
+    parser.add_argument('--output', default='submission.csv')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=2000)
+    parser.add_argument('--check', metavar='SUBMISSION', help='Compare the output against a submission.csv')
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+                        help='Largest probability difference --check accepts; 0 requires an exact match')
+    args = parser.parse_args()
+
+    workers = max(1, args.workers)
+    store = ModelStore.from_env(model_dir=os.path.dirname(os.path.abspath(__file__)))
+    started = time.perf_counter()
+    loaded = store.load()
+    pool = start_pool(store, workers)
+    startup_seconds = time.perf_counter() - started
+    print(f"Model {loaded.version} ({loaded.scorer.name} backend) loaded in {workers} workers "
+          f"in {startup_seconds:.2f} s")
+
+    with pool:
+        started = time.perf_counter()
+        try:
+            submission = score_file(args.input, pool, workers, max(1, args.chunk_size),
+                                    loaded.feature_plan.class_labels)
+        except ValueError as e:
+            raise SystemExit(f"Could not score {args.input}: {e}")
+        score_seconds = time.perf_counter() - started
+    submission.to_csv(args.output, index=False)
+
+    rows = len(submission)
+    print(f"Scored {rows} rows in {score_seconds:.2f} s ({rows / score_seconds if score_seconds else 0:.0f} rows/s)")
+    print(f"Wrote {args.output}")
+
+    if args.check:
+        exact, total, max_diff = compare_submissions(args.output, args.check)
+        print(f"Max absolute probability difference {max_diff:.3g}, "
+              f"{total - exact} of {total} rows not bit-identical")
+        if max_diff > args.tolerance:
+            raise SystemExit(f"{args.output} does not match {args.check} (tolerance {args.tolerance:g})")
+        if exact == total:
+            print(f"{args.output} matches {args.check} exactly")
+        else:
+            print(f"{args.output} matches {args.check} within {args.tolerance:g}, not bit for bit")
+
+
+if __name__ == '__main__':
+    main()
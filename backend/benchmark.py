@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from inference import INFERENCE_BACKENDS
+from model_store import ModelStore, resolve_bundle
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BATCH_SIZES = '16,64,256,1024,4096'
+
+
+def percentile_ms(seconds, q):
+    return float(np.percentile(seconds, q) * 1000)
+
+
+def golden_check(probabilities, reference, tolerance):
+    """Compare probabilities with submission.csv rows; returns a JSON-ready summary."""
+    diff = np.abs(np.asarray(probabilities, dtype=np.float64) - reference)
+    max_diff = float(diff.max()) if diff.size else 0.0
+    return {
+        'rows': int(len(diff)),
+        'max_abs_diff': max_diff,
+        'mismatched_rows': int((diff > tolerance).any(axis=1).sum()),
+        'passed': bool(max_diff <= tolerance)
+    }
+
+
+def digest(probabilities):
+    """Short fingerprint of float32 probabilities, so output changes show up in a results diff."""
+    return hashlib.sha256(np.ascontiguousarray(probabilities, dtype=np.float32).tobytes()).hexdigest()[:16]
+
+
+def measure_load(backend, repeat):
+    """Cold load time and peak RSS of a fresh interpreter (best of repeat), via model_store.py measure."""
+    bundle_dir = os.path.join(BACKEND_DIR, 'model_bundle')
+    source = 'bundle' if resolve_bundle(bundle_dir) is not None else 'pickle'
+    runs = []
+    for _ in range(repeat):
+        command = [sys.executable, os.path.join(BACKEND_DIR, 'model_store.py'), 'measure', source,
+                   '--backend', backend, '--bundle', bundle_dir, '--model-dir', BACKEND_DIR]
+        started = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process_ms'] = (time.perf_counter() - started) * 1000
+        runs.append(result)
+    best = min(runs, key=lambda run: run['process_ms'])
+    return {key: best[key] for key in ('source', 'process_ms', 'load_ms', 'peak_rss_mb')}
+
+
+def measure_single(loaded, test, reference, rows, tolerance):
+    """Per-row latency of the model scoring path and of the API's serving path.
+
+    ``score`` is one training-encoded row through predict_proba and is
+    checked against submission.csv. ``serve`` is FeaturePlan.transform on a
+    record dict plus predict_proba, which is what make_prediction does after
+    validation. It follows the API's first-letter category rule rather than
+    the notebook's encoding, so it is checked against transform_frame on the
+    same rows instead.
+    """
+    feature_plan, scorer = loaded.feature_plan, loaded.scorer
+    sample = test.head(rows)
+    features = feature_plan.encode_frame(sample)
+    records = sample.astype(object).where(sample.notna(), None).to_dict('records')
+    score_seconds, serve_seconds = [], []
+    scored = np.zeros((len(sample), len(feature_plan.class_labels)), dtype=np.float32)
+    served = np.zeros_like(scored)
+    out = np.zeros((1, feature_plan.n_features), dtype=np.float32)
+
+    scorer.predict_proba(features[:1])
+    for i in range(len(sample)):
+        started = time.perf_counter()
+        scored[i] = scorer.predict_proba(features[i:i + 1])[0]
+        score_seconds.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        served[i] = scorer.predict_proba(feature_plan.transform(records[i], out=out))[0]
+        serve_seconds.append(time.perf_counter() - started)
+
+    bulk = scorer.predict_proba(feature_plan.transform_frame(sample))
+    return {
+        'rows': len(sample),
+        'score_p50_ms': percentile_ms(score_seconds, 50),
+        'score_p99_ms': percentile_ms(score_seconds, 99),
+        'serve_p50_ms': percentile_ms(serve_seconds, 50),
+        'serve_p99_ms': percentile_ms(serve_seconds, 99),
+        'score_golden': golden_check(scored, reference[:len(sample)], tolerance),
+        'serve_matches_bulk': golden_check(served, bulk, tolerance),
+        'serve_digest': digest(served)
+    }
+
+
+def measure_batches(loaded, test, reference, batch_sizes, repeat, tolerance):
+    """Rows/s over the whole file at each batch size, preprocessing included (best of repeat)."""
+    feature_plan, scorer = loaded.feature_plan, loaded.scorer
+    results = []
+    for batch_size in batch_sizes:
+        best_seconds = None
+        for _ in range(repeat):
+            parts = []
+            started = time.perf_counter()
+            for start in range(0, len(test), batch_size):
+                parts.append(scorer.predict_proba(feature_plan.encode_frame(test.iloc[start:start + batch_size])))
+            seconds = time.perf_counter() - started
+            best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+        probabilities = np.vstack(parts)
+        results.append({
+            'batch_size': batch_size,
+            'rows': len(test),
+            'seconds': best_seconds,
+            'rows_per_second': len(test) / best_seconds if best_seconds else 0.0,
+            'golden': golden_check(probabilities, reference, tolerance)
+        })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    test = pd.read_csv(args.data)
+    submission = pd.read_csv(args.golden)
+    if not test['id'].equals(submission['id']):
+        raise SystemExit(f"{args.data} and {args.golden} do not list the same ids in the same order")
+
+    import xgboost
+    results = {
+        'created_at': datetime.utcnow().isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'xgboost': xgboost.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'tolerance': args.tolerance,
+        'backends': {}
+    }
+    for backend in args.backends.split(','):
+        loaded = ModelStore(model_dir=BACKEND_DIR, backend=backend).load()
+        columns = [f'Status_{label}' for label in loaded.feature_plan.class_labels]
+        reference = submission[columns].to_numpy(dtype=np.float64)
+        results['model_version'] = loaded.version
+        print(f"Benchmarking {backend} backend...", file=sys.stderr)
+        results['backends'][backend] = {
+            'load': measure_load(backend, args.repeat),
+            'single_row': measure_single(loaded, test, reference, args.single_rows, args.tolerance),
+            'batches': measure_batches(loaded, test, reference,
+                                       [int(size) for size in args.batch_sizes.split(',')], args.repeat,
+                                       args.tolerance)
+        }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    failed = []
+    print(f"{'backend':<9} {'load ms':>8} {'RSS MB':>7} {'p50 ms':>7} {'p99 ms':>7} {'serve p99':>9}  rows/s by batch size")
+    for backend, result in results['backends'].items():
+        single = result['single_row']
+        throughput = ' '.join(f"{batch['batch_size']}:{batch['rows_per_second']:.0f}" for batch in result['batches'])
+        print(f"{backend:<9} {result['load']['load_ms']:>8.0f} {result['load']['peak_rss_mb']:>7.1f} "
+              f"{single['score_p50_ms']:>7.3f} {single['score_p99_ms']:>7.3f} {single['serve_p99_ms']:>9.3f}  "
+              f"{throughput}")
+        checks = [('single_row', single['score_golden']), ('serve_vs_bulk', single['serve_matches_bulk'])]
+        checks += [(f"batch_{batch['batch_size']}", batch['golden']) for batch in result['batches']]
+        failed += [f"{backend} {name} (max diff {check['max_abs_diff']:.3g})"
+                   for name, check in checks if not check['passed']]
+    print(f"Wrote {args.output}")
+    if failed:
+        raise SystemExit(f"Probabilities outside tolerance {args.tolerance:g}: {', '.join(failed)}")
+    print(f"All probabilities within {args.tolerance:g} of {args.golden}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark inference latency, throughput and load time '
+                                                 'with golden checks against submission.csv')
+    parser.add_argument('--data', default=os.path.join(BACKEND_DIR, '..', 'data', 'test.csv'))
+    parser.add_argument('--golden', default=os.path.join(BACKEND_DIR, '..', 'submission.csv'))
+    parser.add_argument('--backends', default=','.join(INFERENCE_BACKENDS))
+    parser.add_argument('--batch-sizes', default=DEFAULT_BATCH_SIZES)
+    parser.add_argument('--single-rows', type=int, default=2000, help='Rows timed one at a time')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=1e-6)
+    parser.add_argument('--output', default='benchmark_results.json')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
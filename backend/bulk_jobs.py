@@ -0,0 +1,462 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor
+from bson import ObjectId
+from model_store import ModelLoadError, ModelStore, load_bundle
+from table_io import iter_table_chunks
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_FILE = 'jobs.sqlite3'
+UPLOADS_DIR = 'uploads'
+ACTIVE_STATUSES = ('queued', 'running')
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    filename TEXT,
+    status TEXT NOT NULL,
+    skip_invalid INTEGER NOT NULL DEFAULT 0,
+    input_format TEXT NOT NULL DEFAULT 'csv',
+    processed_rows INTEGER NOT NULL DEFAULT 0,
+    persisted_rows INTEGER NOT NULL DEFAULT 0,
+    failed_writes INTEGER NOT NULL DEFAULT 0,
+    chunks_done INTEGER NOT NULL DEFAULT 0,
+    model_version TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT NOT NULL,
+    row_number INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (job_id, row_number)
+);
+CREATE TABLE IF NOT EXISTS job_errors (
+    job_id TEXT NOT NULL,
+    row_number INTEGER NOT NULL,
+    field TEXT,
+    message TEXT NOT NULL,
+    PRIMARY KEY (job_id, row_number, message)
+);
+"""
+
+# Columns added after the first release, applied to existing job stores on open
+COLUMN_MIGRATIONS = [
+    ('persisted_rows', 'INTEGER NOT NULL DEFAULT 0'),
+    ('failed_writes', 'INTEGER NOT NULL DEFAULT 0'),
+    ('skip_invalid', 'INTEGER NOT NULL DEFAULT 0'),
+    ('input_format', "TEXT NOT NULL DEFAULT 'csv'"),
+]
+
+def job_record_id(job_id, created_at, row_number):
+    """The prediction record _id of one file row of a job.
+
+    The same row always gets the same id, so a resumed job that scores a
+    chunk again hits a duplicate key instead of storing it twice. The first
+    four bytes are the job's creation time, as in a generated ObjectId.
+    """
+    seconds = int(created_at.replace(tzinfo=timezone.utc).timestamp())
+    digest = hashlib.blake2b(f'{job_id}:{int(row_number)}'.encode(), digest_size=8).digest()
+    return ObjectId(seconds.to_bytes(4, 'big') + digest)
+
+
+# Set in each pool process by _init_worker; the model is loaded once per process
+_worker_store = None
+# A bundle version other than the one on disk at start-up, by model version, loaded when a job asks for it
+_worker_pinned = {}
+
+
+def _init_worker(model_dir, bundle_dir, backend):
+    global _worker_store
+    _worker_store = ModelStore(model_dir=model_dir, bundle_dir=bundle_dir, backend=backend, nthread=1)
+    _worker_store.load()
+
+
+def _worker_model(model_version, bundle_path):
+    """The model a job asked for: the one loaded at start-up, or the bundle version the web process serves.
+
+    A different version is loaded from bundle_path once and kept, so the
+    chunks of a job whose web process serves another model than the one on
+    disk are not each paying for a reload.
+    """
+    loaded = _worker_store.get()
+    if model_version is None or loaded.version == model_version:
+        return loaded
+    if model_version not in _worker_pinned:
+        if bundle_path is None:
+            raise ModelLoadError(f"Bulk workers have model {loaded.version}, not the {model_version} "
+                                 f"being served, which was not loaded from a bundle")
+        pinned = load_bundle(bundle_path, _worker_store.backend, nthread=1)
+        if pinned.version != model_version:
+            raise ModelLoadError(f"{bundle_path} holds model {pinned.version}, not {model_version}")
+        _worker_pinned.clear()
+        _worker_pinned[model_version] = pinned
+    return _worker_pinned[model_version]
+
+
+def _score_chunk(chunk, model_version=None, bundle_path=None):
+    """Score one prepared chunk in a pool process with the model version the job was started with."""
+    loaded = _worker_model(model_version, bundle_path)
+    started = time.perf_counter()
+    probabilities = loaded.scorer.predict_proba(loaded.feature_plan.transform_frame(chunk))
+    latency_ms = (time.perf_counter() - started) * 1000
+    return probabilities, loaded.feature_plan.class_labels, loaded.version, latency_ms
+
+
+class JobStore:
+    """Bulk job state and results in a local SQLite file.
+
+    Lives next to the uploaded files in ``job_dir`` so a restarted web worker
+    can report on, page through and resume the jobs it had accepted.
+    """
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.uploads_dir = os.path.join(job_dir, UPLOADS_DIR)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        self.path = os.path.join(job_dir, JOB_DB_FILE)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, definition in COLUMN_MIGRATIONS:
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def upload_path(self, job_id, input_format='csv'):
+        return os.path.join(self.uploads_dir, f'{job_id}.{input_format}')
+
+    def create(self, job_id, user_id, filename, skip_invalid=False, input_format='csv'):
+        now = datetime.utcnow().isoformat()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO jobs (id, user_id, filename, status, skip_invalid, input_format, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, user_id, filename, 'queued', int(skip_invalid), input_format, now, now)
+            )
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self, job_id, owner, stale_seconds):
+        """Take ownership of an active job nobody else has touched recently."""
+        now = datetime.utcnow()
+        stale_before = (now - timedelta(seconds=stale_seconds)).isoformat()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET owner = ?, status = 'running', updated_at = ? "
+                "WHERE id = ? AND status IN ('queued', 'running') AND cancel_requested = 0 "
+                "AND (owner IS NULL OR owner = ? OR updated_at < ?)",
+                (owner, now.isoformat(), job_id, owner, stale_before)
+            )
+            return cursor.rowcount == 1
+
+    def resumable(self, stale_seconds):
+        stale_before = (datetime.utcnow() - timedelta(seconds=stale_seconds)).isoformat()
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') AND cancel_requested = 0 "
+                "AND (owner IS NULL OR updated_at < ?) ORDER BY created_at",
+                (stale_before,)
+            ).fetchall()
+        return [row['id'] for row in rows]
+
+    def add_results(self, job_id, row_numbers, predictions, processed_rows, model_version, persisted=0, failed=0):
+        """Store one chunk's rows and stored-record counts and advance progress in a single transaction.
+
+        row_numbers are the 1-based file rows of predictions; processed_rows
+        counts every file row read so far, skipped ones included.
+        """
+        now = datetime.utcnow().isoformat()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO job_results (job_id, row_number, payload) VALUES (?, ?, ?)',
+                [(job_id, int(row_number), json.dumps(row, default=str))
+                 for row_number, row in zip(row_numbers, predictions)]
+            )
+            conn.execute(
+                'UPDATE jobs SET processed_rows = ?, chunks_done = chunks_done + 1, '
+                'persisted_rows = persisted_rows + ?, failed_writes = failed_writes + ?, '
+                'model_version = COALESCE(?, model_version), updated_at = ? WHERE id = ?',
+                (processed_rows, persisted, failed, model_version, now, job_id)
+            )
+
+    def add_errors(self, job_id, errors):
+        """Store rows of a validation error table (row, field, message)."""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO job_errors (job_id, row_number, field, message) VALUES (?, ?, ?, ?)',
+                [(job_id, int(error.row), error.field, error.message) for error in errors.itertuples(index=False)]
+            )
+
+    def errors(self, job_id, offset=0, limit=500):
+        """Error lines for up to limit invalid rows from file row offset on."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT row_number, field, message FROM job_errors WHERE job_id = ? AND row_number IN ('
+                'SELECT DISTINCT row_number FROM job_errors WHERE job_id = ? AND row_number >= ? '
+                'ORDER BY row_number LIMIT ?) ORDER BY row_number, rowid',
+                (job_id, job_id, offset, limit)
+            ).fetchall()
+        return [{'row': row['row_number'], 'field': row['field'], 'message': row['message']} for row in rows]
+
+    def invalid_rows(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT COUNT(DISTINCT row_number) AS invalid FROM job_errors WHERE job_id = ?', (job_id,)
+            ).fetchone()
+        return row['invalid']
+
+    def results(self, job_id, offset=0, limit=500):
+        """Scored rows from file row offset on, each tagged with its 'row' number."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT row_number, payload FROM job_results WHERE job_id = ? AND row_number >= ? '
+                'ORDER BY row_number LIMIT ?',
+                (job_id, offset, limit)
+            ).fetchall()
+        return [{'row': row['row_number'], **json.loads(row['payload'])} for row in rows]
+
+    def request_cancel(self, job_id):
+        """Flag a job for cancellation; a queued job is cancelled at once."""
+        now = datetime.utcnow().isoformat()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                (now, job_id)
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (now, job_id)
+            )
+
+    def cancel_requested(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row is None or bool(row['cancel_requested'])
+
+    def finish(self, job_id, status, error=None):
+        now = datetime.utcnow().isoformat()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, owner = NULL, updated_at = ?, finished_at = ? WHERE id = ?',
+                (status, error, now, now, job_id)
+            )
+            row = conn.execute('SELECT input_format FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        upload_path = self.upload_path(job_id, row['input_format'] if row is not None else 'csv')
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+
+    def purge(self, older_than_days):
+        """Drop finished jobs, and their results, older than the retention window."""
+        cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).isoformat()
+        with closing(self._connect()) as conn, conn:
+            expired = [row['id'] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({', '.join('?' * len(FINAL_STATUSES))}) AND finished_at < ?",
+                (*FINAL_STATUSES, cutoff)
+            )]
+            conn.executemany('DELETE FROM job_results WHERE job_id = ?', [(job_id,) for job_id in expired])
+            conn.executemany('DELETE FROM job_errors WHERE job_id = ?', [(job_id,) for job_id in expired])
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in expired])
+        return len(expired)
+
+
+class BulkJobManager:
+    """Runs bulk scoring jobs on a pool of model-holding worker processes.
+
+    The web process reads the upload in chunks, validates each one with
+    ``prepare_chunk(chunk, row_offset, skip_invalid) -> (chunk, errors,
+    message)`` and sends the valid rows to the pool. Validation errors are
+    kept with the job; a message stops the job. Up to ``max_in_flight`` chunks are scored in parallel; results are
+    handled in file order by ``save_chunk(user_id, chunk, probabilities,
+    class_labels, model_version, latency_ms, timestamp, record_ids) -> (rows,
+    write)``. ``write`` is a Future for the chunk's WriteResult; once it has
+    resolved, the rows, stored-row counts and progress are kept in the
+    JobStore together, in file order, and a job is only marked done once
+    every write has. Progress only ever covers a complete prefix of stored
+    chunks, and records get their _id from job_record_id(), so a restarted
+    worker resumes a job where it stopped: a chunk whose write finished
+    before the restart but was not yet recorded is stored again as
+    duplicate keys, which the writer counts as already stored.
+    """
+
+    def __init__(self, job_store, model_store, prepare_chunk, save_chunk, max_workers=None,
+                 chunk_size=1000, stale_seconds=60):
+        self.job_store = job_store
+        self.model_store = model_store
+        self.prepare_chunk = prepare_chunk
+        self.save_chunk = save_chunk
+        self.max_workers = max(1, int(max_workers or os.cpu_count() or 1))
+        self.max_in_flight = self.max_workers * 2
+        self.chunk_size = int(chunk_size)
+        self.stale_seconds = float(stale_seconds)
+        self.owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._threads = {}
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn: the web process has live threads that fork would copy mid-state
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.model_store.model_dir, self.model_store.bundle_dir, self.model_store.backend)
+                )
+                logger.info(f"Started bulk scoring pool with {self.max_workers} worker processes")
+            return self._pool
+
+    def submit(self, user_id, filename, stream, skip_invalid=False, input_format='csv'):
+        """Save an upload (any table_io input format) and queue it; returns the new job id."""
+        job_id = uuid.uuid4().hex
+        with open(self.job_store.upload_path(job_id, input_format), 'wb') as upload:
+            while True:
+                block = stream.read(1024 * 1024)
+                if not block:
+                    break
+                upload.write(block)
+        self.job_store.create(job_id, user_id, filename, skip_invalid, input_format)
+        self._start(job_id)
+        return job_id
+
+    def resume(self):
+        """Pick up jobs left active by a worker that stopped; returns their ids."""
+        job_ids = self.job_store.resumable(self.stale_seconds)
+        for job_id in job_ids:
+            self._start(job_id)
+        if job_ids:
+            logger.info(f"Resuming {len(job_ids)} bulk jobs")
+        return job_ids
+
+    def cancel(self, job_id):
+        self.job_store.request_cancel(job_id)
+
+    def _start(self, job_id):
+        if not self.job_store.claim(job_id, self.owner, self.stale_seconds):
+            return False
+        thread = threading.Thread(target=self._run, args=(job_id,), name=f'bulk-job-{job_id[:8]}', daemon=True)
+        self._threads[job_id] = thread
+        thread.start()
+        return True
+
+    def _run(self, job_id):
+        job = self.job_store.get(job_id)
+        timestamp = datetime.fromisoformat(job['created_at'])
+        row_offset = job['processed_rows']
+        pending = deque()
+        writes = deque()
+        try:
+            serving = self.model_store.get()
+            model_version, bundle_path = serving.version, serving.bundle_path
+            pool = self._executor()
+            chunks = iter_table_chunks(
+                self.job_store.upload_path(job_id, job['input_format']),
+                job['input_format'],
+                self.chunk_size,
+                skip_rows=row_offset
+            )
+            next_row = row_offset
+            with closing(chunks):
+                for raw_chunk in chunks:
+                    chunk, errors, message = self.prepare_chunk(raw_chunk, next_row, bool(job['skip_invalid']))
+                    if not errors.empty:
+                        self.job_store.add_errors(job_id, errors)
+                    if message:
+                        self._drain(job_id, job['user_id'], timestamp, pending, writes)
+                        self._record_writes(job_id, writes, wait=True)
+                        self.job_store.finish(job_id, 'failed', message)
+                        return
+                    next_row += len(raw_chunk)
+                    future = pool.submit(_score_chunk, chunk, model_version, bundle_path) if len(chunk) else None
+                    pending.append((next_row, chunk, future))
+                    while len(pending) >= self.max_in_flight:
+                        self._collect(job_id, job['user_id'], timestamp, pending, writes)
+                    if self.job_store.cancel_requested(job_id):
+                        break
+                self._drain(job_id, job['user_id'], timestamp, pending, writes)
+            self._record_writes(job_id, writes, wait=True)
+            if self.job_store.cancel_requested(job_id):
+                self.job_store.finish(job_id, 'cancelled')
+                logger.info(f"Bulk job {job_id} cancelled")
+            else:
+                self.job_store.finish(job_id, 'completed')
+                logger.info(f"Bulk job {job_id} completed: {self.job_store.get(job_id)['processed_rows']} rows")
+        except Exception as e:
+            for _, _, future in pending:
+                if future is not None:
+                    future.cancel()
+            logger.error(f"Bulk job {job_id} failed: {str(e)}")
+            self._record_writes(job_id, writes, wait=True)
+            self.job_store.finish(job_id, 'failed', str(e) if isinstance(e, ModelLoadError) else 'Failed to process CSV file')
+        finally:
+            self._threads.pop(job_id, None)
+
+    def _collect(self, job_id, user_id, timestamp, pending, writes):
+        processed_rows, chunk, future = pending.popleft()
+        if future is None:
+            # Every row of the chunk was skipped as invalid
+            writes.append((None, [], [], processed_rows, None))
+        else:
+            probabilities, class_labels, version, latency_ms = future.result()
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            record_ids = [job_record_id(job_id, timestamp, row_number) for row_number in chunk.index]
+            predictions, write = self.save_chunk(user_id, chunk, probabilities, class_labels, version, latency_ms,
+                                                 timestamp, record_ids)
+            writes.append((write, chunk.index, predictions, processed_rows, version))
+        self._record_writes(job_id, writes)
+
+    def _drain(self, job_id, user_id, timestamp, pending, writes):
+        if self.job_store.cancel_requested(job_id):
+            for _, _, future in pending:
+                if future is not None:
+                    future.cancel()
+            pending.clear()
+        while pending:
+            self._collect(job_id, user_id, timestamp, pending, writes)
+
+    def _record_writes(self, job_id, writes, wait=False):
+        """Keep the rows of chunks whose writes have finished and advance progress past them, oldest first."""
+        while writes and (wait or writes[0][0] is None or writes[0][0].done()):
+            write, row_numbers, predictions, processed_rows, version = writes.popleft()
+            persisted = failed = 0
+            if write is not None:
+                try:
+                    result = write.result()
+                    persisted, failed = result.persisted, result.failed
+                except Exception as e:
+                    logger.error(f"Bulk job {job_id} write failed: {str(e)}")
+                    failed = len(predictions)
+            self.job_store.add_results(job_id, row_numbers, predictions, processed_rows, version, persisted, failed)
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'pool_started': self._pool is not None,
+            'running_jobs': len(self._threads)
+        }
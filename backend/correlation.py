@@ -0,0 +1,348 @@
+import os
+import atexit
+import logging
+import argparse
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from pymongo.errors import DuplicateKeyError
+from analytics import ANALYSIS_FEATURES
+
+logger = logging.getLogger(__name__)
+
+TOTAL_ID = 'all'
+DAY_PREFIX = 'day:'
+MAX_UPDATE_ATTEMPTS = 10
+
+
+def numeric_matrix(inputs, features):
+    """(n, k) float64 matrix of input_data records, NaN where a value is missing, not numeric or infinite."""
+    frame = pd.DataFrame.from_records([data or {} for data in inputs])
+    values = np.full((len(frame), len(features)), np.nan)
+    for column, feature in enumerate(features):
+        if feature in frame.columns:
+            feature_values = pd.to_numeric(frame[feature], errors='coerce').to_numpy(dtype=np.float64)
+            values[:, column] = np.where(np.isfinite(feature_values), feature_values, np.nan)
+    return values
+
+
+class PairwiseMoments:
+    """Pairwise-complete counts, means, second moments and co-moments of k features.
+
+    Each pair (i, j) only covers rows where both features are present, the
+    same rows DataFrame.corr() uses: n[i, j] rows, mean[i, j] and m2[i, j]
+    (sum of squared deviations) of feature i over them, and comoment[i, j].
+    Sets of moments merge exactly with Chan et al.'s parallel form of
+    Welford's update, so batches can be added, or removed again, in any order.
+    """
+
+    FIELDS = ('n', 'mean', 'm2', 'comoment')
+
+    def __init__(self, k):
+        self.n = np.zeros((k, k))
+        self.mean = np.zeros((k, k))
+        self.m2 = np.zeros((k, k))
+        self.comoment = np.zeros((k, k))
+
+    @classmethod
+    def from_values(cls, values):
+        """Moments of an (n, k) matrix with NaN for missing values, computed around the column means."""
+        moments = cls(values.shape[1])
+        present = ~np.isnan(values)
+        if not present.any():
+            return moments
+        # Shifting by the batch mean keeps the sums of squares well conditioned
+        shift = np.nanmean(np.where(present.any(axis=0), values, 0.0), axis=0)
+        shifted = np.where(present, values - shift, 0.0)
+        mask = present.astype(np.float64)
+        n = mask.T @ mask
+        sums = shifted.T @ mask
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shifted_mean = np.where(n > 0, sums / n, 0.0)
+        moments.n = n
+        moments.mean = np.where(n > 0, shifted_mean + shift[:, None], 0.0)
+        moments.m2 = np.maximum((shifted * shifted).T @ mask - sums * shifted_mean, 0.0)
+        moments.comoment = shifted.T @ shifted - sums * shifted_mean.T
+        return moments
+
+    def merge(self, other, sign=1):
+        """Add other's rows to these moments, or remove them with sign=-1 (they must have been added before)."""
+        if sign > 0:
+            n = self.n + other.n
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = other.mean - self.mean
+                weight = np.where(n > 0, self.n * other.n / n, 0.0)
+                self.mean = np.where(n > 0, self.mean + delta * other.n / n, 0.0)
+            self.m2 = self.m2 + other.m2 + delta * delta * weight
+            self.comoment = self.comoment + other.comoment + delta * delta.T * weight
+        else:
+            n = self.n - other.n
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(n > 0, (self.n * self.mean - other.n * other.mean) / n, 0.0)
+                delta = other.mean - mean
+                weight = np.where(n > 0, n * other.n / self.n, 0.0)
+            self.mean = mean
+            self.m2 = np.where(n > 0, np.maximum(self.m2 - other.m2 - delta * delta * weight, 0.0), 0.0)
+            self.comoment = np.where(n > 0, self.comoment - other.comoment - delta * delta.T * weight, 0.0)
+            n = np.maximum(n, 0.0)
+        self.n = n
+        return self
+
+    def correlation(self):
+        """Pearson correlation matrix, NaN for pairs with fewer than two rows or no variance."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = self.comoment / np.sqrt(self.m2 * self.m2.T)
+        correlation[(self.n < 2) | ~np.isfinite(correlation)] = np.nan
+        return np.clip(correlation, -1.0, 1.0)
+
+    def to_document(self):
+        return {field: getattr(self, field).tolist() for field in self.FIELDS}
+
+    @classmethod
+    def from_document(cls, document, k):
+        moments = cls(k)
+        for field in cls.FIELDS:
+            setattr(moments, field, np.array(document[field], dtype=np.float64).reshape(k, k))
+        return moments
+
+
+class CorrelationStore:
+    """Pairwise moments of the analysis features, kept current as predictions are stored and deleted.
+
+    There is one document per UTC day of prediction timestamps plus a running
+    total, so the all-time matrix is a single document read and a date
+    window merges one document per day in it, however many predictions
+    there are. record() and remove() only merge into in-memory pending
+    moments; a background thread writes them every ``flush_interval``
+    seconds (or on every call when it is 0) with a revision check, so
+    several API processes can update the same documents. close(), also
+    run at interpreter exit, stops the thread and writes what is still
+    pending. rebuild()
+    recomputes everything from the predictions collection if the store has
+    drifted, for example after a crash lost pending updates, and
+    rebuild_if_missing() starts one when a database that predates the
+    store (or was built for other features) has predictions but no total.
+    """
+
+    def __init__(self, collection, features=ANALYSIS_FEATURES, flush_interval=2.0):
+        self.collection = collection
+        self.features = list(features)
+        self.flush_interval = float(flush_interval)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self.flushes = 0
+        self.conflicts = 0
+        self.failed_updates = 0
+        self.last_rebuild = None
+        self._stop = threading.Event()
+        if self.flush_interval > 0:
+            self._thread = threading.Thread(target=self._run, name='correlation-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def record(self, inputs, timestamps):
+        """Add stored predictions, given their input_data and timestamps."""
+        self._add(inputs, timestamps, 1)
+
+    def remove(self, inputs, timestamps):
+        """Take deleted predictions back out; they must have been recorded (or rebuilt) before."""
+        self._add(inputs, timestamps, -1)
+
+    def _add(self, inputs, timestamps, sign):
+        inputs, timestamps = list(inputs), list(timestamps)
+        if not inputs:
+            return
+        values = numeric_matrix(inputs, self.features)
+        days = pd.Series([timestamp.strftime('%Y-%m-%d') if isinstance(timestamp, datetime) else None
+                          for timestamp in timestamps])
+        batches = [(TOTAL_ID, PairwiseMoments.from_values(values))]
+        for day, rows in days.groupby(days).groups.items():
+            batches.append((DAY_PREFIX + day, PairwiseMoments.from_values(values[np.asarray(rows)])))
+        with self._lock:
+            for document_id, moments in batches:
+                pending = self._pending.get((document_id, sign))
+                self._pending[(document_id, sign)] = moments if pending is None else pending.merge(moments)
+        if self.flush_interval <= 0 or self._stop.is_set():
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush correlation statistics: {str(e)}")
+
+    def close(self):
+        """Stop the background flush thread and write the pending moments; later updates are written directly."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self.flush_interval > 0:
+            self._thread.join()
+            atexit.unregister(self.close)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush correlation statistics: {str(e)}")
+
+    def flush(self):
+        """Write the pending moments; additions go first so removals never take a count below zero."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for (document_id, sign), moments in sorted(pending.items(), key=lambda item: -item[0][1]):
+                self._apply(document_id, moments, sign)
+            if pending:
+                self.flushes += 1
+
+    def _load(self, document):
+        k = len(self.features)
+        if document is None or document.get('features') != self.features:
+            return PairwiseMoments(k)
+        return PairwiseMoments.from_document(document, k)
+
+    def _apply(self, document_id, moments, sign):
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            document = self.collection.find_one({'_id': document_id})
+            merged = self._load(document).merge(moments, sign)
+            update = {
+                **merged.to_document(),
+                'features': self.features,
+                'revision': (document or {}).get('revision', 0) + 1,
+                'updated_at': datetime.utcnow()
+            }
+            if document is None:
+                try:
+                    self.collection.insert_one({'_id': document_id, **update})
+                    return
+                except DuplicateKeyError:
+                    pass
+            elif self.collection.replace_one({'_id': document_id, 'revision': document.get('revision', 0)},
+                                             update).matched_count:
+                return
+            self.conflicts += 1
+        self.failed_updates += 1
+        logger.error(f"Gave up updating correlation statistics {document_id}; rebuild the store to repair it")
+
+    def missing(self, predictions):
+        """True if there are predictions but no running total for these features."""
+        document = self.collection.find_one({'_id': TOTAL_ID}, {'features': 1})
+        if document is not None and document.get('features') == self.features:
+            return False
+        return predictions.find_one({}, {'_id': 1}) is not None
+
+    def rebuild_if_missing(self, predictions):
+        """Rebuild in a background thread if missing(); returns the thread, or None.
+
+        Until it finishes, read() returns what has been recorded since, and
+        deletes of older predictions are taken out of moments that never
+        counted them; the rebuild replaces both.
+        """
+        if not self.missing(predictions):
+            return None
+
+        def rebuild():
+            try:
+                self.rebuild(predictions)
+            except Exception as e:
+                logger.error(f"Correlation statistics rebuild failed: {str(e)}")
+
+        logger.info('No correlation statistics for the stored predictions yet; rebuilding them')
+        thread = threading.Thread(target=rebuild, name='correlation-rebuild', daemon=True)
+        thread.start()
+        return thread
+
+    def read(self, date_from=None, date_to=None):
+        """Moments of all predictions, or of the UTC days from date_from to date_to ('YYYY-MM-DD', inclusive)."""
+        if date_from is None and date_to is None:
+            return self._load(self.collection.find_one({'_id': TOTAL_ID}))
+        day_range = {'$gte': DAY_PREFIX + (date_from or ''), '$lte': DAY_PREFIX + (date_to or '9999-12-31')}
+        moments = PairwiseMoments(len(self.features))
+        for document in self.collection.find({'_id': day_range}):
+            moments.merge(self._load(document))
+        return moments
+
+    def rebuild(self, predictions, chunk_size=10000):
+        """Recompute every document from the predictions collection and replace the stored ones.
+
+        Predictions stored while the rebuild runs may be counted twice or
+        not at all; run it when writes are quiet. Returns the number of
+        predictions read.
+        """
+        with self._rebuild_lock:
+            totals = {}
+            count = 0
+            inputs, timestamps = [], []
+
+            def add_chunk():
+                values = numeric_matrix(inputs, self.features)
+                days = pd.Series([timestamp.strftime('%Y-%m-%d') if isinstance(timestamp, datetime) else None
+                                  for timestamp in timestamps])
+                batches = [(TOTAL_ID, values)] + [
+                    (DAY_PREFIX + day, values[np.asarray(rows)]) for day, rows in days.groupby(days).groups.items()
+                ]
+                for document_id, batch in batches:
+                    moments = PairwiseMoments.from_values(batch)
+                    totals[document_id] = moments if document_id not in totals else totals[document_id].merge(moments)
+
+            for record in predictions.find({}, {'input_data': 1, 'timestamp': 1}, batch_size=chunk_size):
+                inputs.append(record.get('input_data'))
+                timestamps.append(record.get('timestamp'))
+                if len(inputs) >= chunk_size:
+                    add_chunk()
+                    count += len(inputs)
+                    inputs, timestamps = [], []
+            if inputs:
+                add_chunk()
+                count += len(inputs)
+
+            with self._flush_lock:
+                with self._lock:
+                    self._pending.clear()
+                self.collection.delete_many({})
+                now = datetime.utcnow()
+                documents = [
+                    {'_id': document_id, **moments.to_document(), 'features': self.features, 'revision': 0,
+                     'updated_at': now}
+                    for document_id, moments in totals.items()
+                ]
+                if documents:
+                    self.collection.insert_many(documents, ordered=False)
+            self.last_rebuild = {'finished_at': now.isoformat(), 'predictions': count, 'documents': len(documents)}
+            logger.info(f"Rebuilt correlation statistics from {count} predictions ({len(documents)} documents)")
+            return count
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'flush_interval_seconds': self.flush_interval,
+            'pending_documents': pending,
+            'flushes': self.flushes,
+            'conflicts': self.conflicts,
+            'failed_updates': self.failed_updates,
+            'rebuilding': self._rebuild_lock.locked(),
+            'last_rebuild': self.last_rebuild
+        }
+
+
+def main():
+    from pymongo import MongoClient
+    parser = argparse.ArgumentParser(description='Rebuild the correlation statistics from the predictions collection')
+    parser.add_argument('--mongo-uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='liverlens_db')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri)[args.database]
+    store = CorrelationStore(db['correlation_stats'], flush_interval=0)
+    count = store.rebuild(db['predictions'], args.chunk_size)
+    print(f"Rebuilt correlation statistics from {count} predictions "
+          f"({store.last_rebuild['documents']} documents)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+import numpy as np
+import pandas as pd
+
+NUMERICAL_FEATURES = [
+    'N_Days', 'Age', 'Bilirubin', 'Cholesterol', 'Albumin', 'Copper',
+    'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin', 'Stage'
+]
+CATEGORICAL_FEATURES = ['Drug', 'Sex', 'Ascites', 'Hepatomegaly', 'Spiders', 'Edema']
+MISSING_VALUES = [None, '', 'null']
+
+
+class FeaturePlan:
+    """Preprocessing compiled from preprocessing_components into plain lookups.
+
+    Produces the same feature vector as the training preprocessing (median
+    imputation and LabelEncoder codes), without building a DataFrame or
+    calling into sklearn for each request.
+    """
+
+    def __init__(self, feature_names, medians, categorical_classes, class_labels):
+        self.feature_names = tuple(feature_names)
+        self.n_features = len(self.feature_names)
+        column_index = {name: i for i, name in enumerate(self.feature_names)}
+
+        self.numerical = tuple(
+            (feature, column_index[feature], float(medians[feature]))
+            for feature in NUMERICAL_FEATURES
+            if feature in column_index and feature in medians
+        )
+        self.categorical = tuple(
+            (
+                feature,
+                column_index[feature],
+                {str(label): float(code) for code, label in enumerate(categorical_classes[feature])}
+                if feature in categorical_classes else None
+            )
+            for feature in CATEGORICAL_FEATURES
+            if feature in column_index
+        )
+        self.medians = np.array([median for _, _, median in self.numerical], dtype=np.float32)
+        self.class_labels = tuple(str(label) for label in class_labels)
+        self._local = threading.local()
+
+    @classmethod
+    def from_components(cls, components):
+        imputer = components['imputer']
+        imputed_features = getattr(imputer, 'feature_names_in_', NUMERICAL_FEATURES)
+        encoders = components.get('categorical_encoders', {})
+        return cls(
+            components['feature_names'],
+            dict(zip(imputed_features, imputer.statistics_)),
+            {feature: list(encoder.classes_) for feature, encoder in encoders.items()},
+            components['label_encoder'].classes_
+        )
+
+    def categorical_classes(self):
+        return {
+            feature: sorted(lookup, key=lookup.get)
+            for feature, _, lookup in self.categorical
+            if lookup is not None
+        }
+
+    def _buffer(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = np.zeros((1, self.n_features), dtype=np.float32)
+            self._local.buffer = buffer
+        return buffer
+
+    def transform(self, data, out=None):
+        """Fill a (1, n_features) float32 row from a raw input dict.
+
+        Without ``out`` the row is a per-thread buffer that is reused by the
+        next call on the same thread, so score it before transforming again.
+        """
+        row = self._buffer() if out is None else out
+        values = row[0]
+        values[:] = 0
+        for feature, index, median in self.numerical:
+            value = data.get(feature)
+            if value in MISSING_VALUES:
+                values[index] = median
+                continue
+            try:
+                value = float(value)
+            except (ValueError, TypeError):
+                value = median
+            values[index] = median if value != value else value
+        for feature, index, lookup in self.categorical:
+            value = data.get(feature)
+            code = 'N' if value in MISSING_VALUES else str(value).upper()[0]
+            if lookup is not None:
+                # Unknown codes fall back to the first class, as the sklearn preprocessing did
+                values[index] = lookup.get(code, 0.0)
+        return row
+
+    def transform_frame(self, df):
+        """Column-wise transform of a raw DataFrame into an (n, n_features) float32 matrix."""
+        out = np.zeros((len(df), self.n_features), dtype=np.float32)
+        for feature, index, median in self.numerical:
+            if feature not in df.columns:
+                out[:, index] = median
+                continue
+            values = pd.to_numeric(df[feature], errors='coerce').to_numpy(dtype=np.float64)
+            out[:, index] = np.where(np.isnan(values), median, values)
+        for feature, index, lookup in self.categorical:
+            if lookup is None:
+                continue
+            if feature not in df.columns:
+                out[:, index] = lookup.get('N', 0.0)
+                continue
+            column = df[feature].astype(object)
+            missing = column.isna() | column.isin(['', 'null'])
+            codes = column.astype(str).str.upper().str[0].where(~missing, 'N')
+            out[:, index] = codes.map(lookup).fillna(0.0).to_numpy(dtype=np.float32)
+        return out
+
+    def encode_frame(self, df):
+        """Encode a DataFrame in the data/test.csv schema exactly as the training notebook did.
+
+        Unlike transform_frame, which follows the API's first-letter rule,
+        categories are matched by their full string with missing values as
+        'nan', the same as LabelEncoder on ``astype(str)``. Unknown
+        categories raise ValueError instead of falling back to a default.
+        """
+        out = np.zeros((len(df), self.n_features), dtype=np.float32)
+        for feature, index, median in self.numerical:
+            values = pd.to_numeric(df[feature], errors='coerce').to_numpy(dtype=np.float64)
+            out[:, index] = np.where(np.isnan(values), median, values)
+        for feature, index, lookup in self.categorical:
+            if lookup is None:
+                continue
+            column = df[feature].astype(object)
+            codes = column.where(column.notna(), 'nan').astype(str).map(lookup)
+            if codes.isna().any():
+                unknown = sorted(set(column[codes.isna()].astype(str)))
+                raise ValueError(f"Unknown {feature} values: {', '.join(unknown[:5])}")
+            out[:, index] = codes.to_numpy(dtype=np.float32)
+        return out
+
+
+INFERENCE_BACKENDS = ('sklearn', 'booster', 'compiled')
+
+
+def iteration_range(model, booster):
+    """The boosting rounds predict_proba uses: up to best_iteration when early stopping set one."""
+    best_iteration = getattr(model if model is not None else booster, 'best_iteration', None)
+    if best_iteration is not None:
+        return (0, int(best_iteration) + 1)
+    return (0, booster.num_boosted_rounds())
+
+
+class SklearnScorer:
+    """Scores through the XGBClassifier wrapper's predict_proba."""
+
+    name = 'sklearn'
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict_proba(self, features):
+        return self.model.predict_proba(features)
+
+
+class BoosterScorer:
+    """Scores NumPy rows directly on the native booster with inplace_predict.
+
+    Skips the wrapper's input checks and DMatrix construction. The iteration
+    range is pinned to the one predict_proba would use, so the probabilities
+    are identical.
+    """
+
+    name = 'booster'
+
+    def __init__(self, model, nthread=None):
+        self.booster = model.get_booster()
+        if nthread:
+            self.booster.set_param({'nthread': int(nthread)})
+        self.iteration_range = iteration_range(model, self.booster)
+
+    def predict_proba(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        return self.booster.inplace_predict(
+            features,
+            iteration_range=self.iteration_range,
+            predict_type='value',
+            missing=np.nan,
+            validate_features=False
+        )
+
+
+def build_scorer(model, backend='booster', nthread=None):
+    if backend == 'sklearn':
+        return SklearnScorer(model)
+    if backend == 'booster':
+        return BoosterScorer(model, nthread=nthread)
+    if backend == 'compiled':
+        from tree_evaluator import CompiledForest
+        booster = model.get_booster()
+        return CompiledForest.from_booster(booster, iteration_range(model, booster))
+    raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+
+class _PendingPrediction:
+    __slots__ = ('features', 'scorer', 'enqueued_at', 'done', 'result', 'error')
+
+    def __init__(self, features, scorer):
+        self.features = features
+        self.scorer = scorer
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PredictionBatcher:
+    """Coalesces concurrent single-row requests into one scoring call.
+
+    Requests that arrive within ``max_wait_ms`` of the first queued request,
+    up to ``max_batch_size`` rows, are stacked and scored together by a
+    background thread. Each caller blocks until its own row is ready. Rows
+    are only stacked with rows for the same scorer, so a model swap never
+    scores one version's features with another version's model.
+    """
+
+    def __init__(self, max_batch_size=64, max_wait_ms=2.0):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._rows = 0
+        self._max_batch_seen = 0
+        self._batch_sizes = defaultdict(int)
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._worker = threading.Thread(target=self._run, name='prediction-batcher', daemon=True)
+        self._worker.start()
+
+    def predict_proba(self, features, scorer):
+        """Score a (1, n_features) row with scorer and return its probability vector."""
+        pending = _PendingPrediction(np.array(features, dtype=np.float32).reshape(-1), scorer)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            groups = defaultdict(list)
+            for pending in batch:
+                groups[id(pending.scorer)].append(pending)
+            for group in groups.values():
+                try:
+                    probabilities = group[0].scorer.predict_proba(np.vstack([pending.features for pending in group]))
+                    for pending, row in zip(group, probabilities):
+                        pending.result = row
+                except Exception as e:
+                    for pending in group:
+                        pending.error = e
+            self._record(batch, started)
+            for pending in batch:
+                pending.done.set()
+
+    def _record(self, batch, started):
+        waits = [started - pending.enqueued_at for pending in batch]
+        with self._lock:
+            self._batches += 1
+            self._rows += len(batch)
+            self._max_batch_seen = max(self._max_batch_seen, len(batch))
+            self._batch_sizes[len(batch)] += 1
+            self._queue_wait_total += sum(waits)
+            self._queue_wait_max = max(self._queue_wait_max, max(waits))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': self._batches,
+                'rows': self._rows,
+                'avg_batch_size': self._rows / self._batches if self._batches else 0,
+                'max_batch_seen': self._max_batch_seen,
+                'batch_size_counts': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'avg_queue_wait_ms': self._queue_wait_total / self._rows * 1000.0 if self._rows else 0,
+                'max_queue_wait_ms': self._queue_wait_max * 1000.0,
+                'queue_depth': self._queue.qsize()
+            }
+
+
+class PredictionCache:
+    """Bounded LRU cache of per-row arrays (probability vectors) with a per-entry TTL.
+
+    Keys are a digest of the preprocessed float32 feature row, so inputs that
+    differ only in formatting ('1', 1.0, ...) share an entry. Entries belong
+    to one model version; seeing a different version clears the cache.
+    """
+
+    def __init__(self, max_size=4096, ttl_seconds=300.0):
+        self.max_size = int(max_size)
+        self.ttl = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(features):
+        row = np.ascontiguousarray(features, dtype=np.float32)
+        return hashlib.blake2b(row.tobytes(), digest_size=16).digest()
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(self, features, version):
+        key = self.key(features)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, probabilities = entry
+            if self.ttl > 0 and expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return probabilities
+
+    def put(self, features, version, probabilities):
+        key = self.key(features)
+        probabilities = np.array(probabilities, dtype=np.float32)
+        probabilities.setflags(write=False)
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (time.monotonic() + self.ttl, probabilities)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'model_version': self._version,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+
+class ContributionExplainer:
+    """Per-row SHAP contributions from the booster's native pred_contribs output.
+
+    explain() returns an (n, n_classes, n_features + 1) float32 array of
+    log-odds contributions; the last column is each class's base value, and
+    a row's columns sum to its raw margin. Rows are looked up in a
+    PredictionCache by feature digest and model version first, and the
+    remaining distinct rows are scored in one DMatrix, since TreeSHAP costs
+    far more per call than predict_proba.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self.rows = 0
+        self.computed_rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def explain(self, loaded, features):
+        features = np.ascontiguousarray(features, dtype=np.float32).reshape(-1, loaded.feature_plan.n_features)
+        n_classes = len(loaded.feature_plan.class_labels)
+        contributions = np.zeros((len(features), n_classes, features.shape[1] + 1), dtype=np.float32)
+        pending = OrderedDict()
+        for i, row in enumerate(features):
+            cached = self.cache.get(row, loaded.version) if self.cache is not None else None
+            if cached is not None:
+                contributions[i] = cached
+            else:
+                pending.setdefault(PredictionCache.key(row), []).append(i)
+
+        if pending:
+            started = time.perf_counter()
+            first_rows = [rows[0] for rows in pending.values()]
+            computed = self._contributions(loaded, features[first_rows]).reshape(len(first_rows), n_classes, -1)
+            for rows, values in zip(pending.values(), computed):
+                contributions[rows] = values
+                if self.cache is not None:
+                    self.cache.put(features[rows[0]], loaded.version, values)
+            with self._lock:
+                self.batches += 1
+                self.computed_rows += len(first_rows)
+                self.seconds += time.perf_counter() - started
+        with self._lock:
+            self.rows += len(features)
+        return contributions
+
+    @staticmethod
+    def _contributions(loaded, features):
+        import xgboost
+        booster = loaded.booster()
+        matrix = xgboost.DMatrix(features, missing=np.nan, feature_names=list(loaded.feature_plan.feature_names))
+        return booster.predict(matrix, pred_contribs=True, iteration_range=iteration_range(loaded.model, booster),
+                               validate_features=False).astype(np.float32)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rows': self.rows,
+                'computed_rows': self.computed_rows,
+                'batches': self.batches,
+                'avg_batch_rows': self.computed_rows / self.batches if self.batches else 0,
+                'avg_ms_per_computed_row': self.seconds / self.computed_rows * 1000.0 if self.computed_rows else 0,
+                'cache': self.cache.stats() if self.cache is not None else None
+            }
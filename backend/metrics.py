@@ -0,0 +1,244 @@
+import time
+import math
+import threading
+from contextlib import contextmanager
+from flask import Response, g, request
+from pymongo import monitoring
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; requests span sub-millisecond cache hits to multi-second bulk uploads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+MONGO_READ_COMMANDS = {'find', 'getMore', 'aggregate', 'count', 'distinct', 'listIndexes'}
+MONGO_WRITE_COMMANDS = {'insert', 'update', 'delete', 'findAndModify', 'createIndexes'}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {', '.join(self.labelnames) or '(none)'}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, list(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for name, labels, value in self._samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + [('le', _format_value(float(bound)))], cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Metrics of one service, rendered in the Prometheus text format.
+
+    Kept in-process with no client library: each metric is a dict of label
+    values under a lock, and render() formats the current values on scrape.
+    """
+
+    def __init__(self, namespace='liverlens'):
+        self.namespace = namespace
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(f'{self.namespace}_{name}', documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(f'{self.namespace}_{name}', documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(f'{self.namespace}_{name}', documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def response(self):
+        return Response(self.render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+def instrument_app(app, registry):
+    """Record latency, in-flight requests and errors for every route of a Flask app.
+
+    Endpoints are labelled by their URL rule (``/history/<prediction_id>``),
+    not the raw path, to keep label cardinality bounded. Streamed responses
+    are timed up to the point the body starts streaming.
+    """
+    requests_total = registry.counter('http_requests_total', 'HTTP requests by endpoint, method and status',
+                                      ['endpoint', 'method', 'status'])
+    request_errors = registry.counter('http_request_errors_total', 'HTTP responses with a 4xx/5xx status',
+                                      ['endpoint', 'method', 'status'])
+    request_seconds = registry.histogram('http_request_duration_seconds', 'HTTP request latency',
+                                         ['endpoint', 'method'])
+    in_flight = registry.gauge('http_requests_in_flight', 'Requests currently being handled', ['endpoint'])
+
+    def endpoint():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_endpoint = endpoint()
+        in_flight.inc(endpoint=g.metrics_endpoint)
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_started' in g:
+            labels = {'endpoint': g.metrics_endpoint, 'method': request.method}
+            request_seconds.observe(time.perf_counter() - g.metrics_started, **labels)
+            requests_total.inc(status=response.status_code, **labels)
+            if response.status_code >= 400:
+                request_errors.inc(status=response.status_code, **labels)
+            g.metrics_recorded = True
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        if 'metrics_started' not in g:
+            return
+        in_flight.dec(endpoint=g.metrics_endpoint)
+        if not g.get('metrics_recorded'):
+            # An unhandled exception skipped after_request
+            labels = {'endpoint': g.metrics_endpoint, 'method': request.method}
+            request_seconds.observe(time.perf_counter() - g.metrics_started, **labels)
+            requests_total.inc(status=500, **labels)
+            request_errors.inc(status=500, **labels)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo command listener timing every Mongo command, split into reads and writes.
+
+    Pass it to MongoClient(event_listeners=[...]); the durations come from
+    the driver, so no call site needs wrapping.
+    """
+
+    def __init__(self, registry):
+        self.command_seconds = registry.histogram('mongo_command_duration_seconds', 'MongoDB command latency',
+                                                  ['operation', 'command'], STAGE_BUCKETS)
+        self.command_errors = registry.counter('mongo_command_errors_total', 'Failed MongoDB commands',
+                                               ['operation', 'command'])
+
+    @staticmethod
+    def operation(command_name):
+        if command_name in MONGO_READ_COMMANDS:
+            return 'read'
+        if command_name in MONGO_WRITE_COMMANDS:
+            return 'write'
+        return 'other'
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.command_seconds.observe(event.duration_micros / 1e6, operation=self.operation(event.command_name),
+                                     command=event.command_name)
+
+    def failed(self, event):
+        operation = self.operation(event.command_name)
+        self.command_seconds.observe(event.duration_micros / 1e6, operation=operation, command=event.command_name)
+        self.command_errors.inc(operation=operation, command=event.command_name)
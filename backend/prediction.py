@@ -1,16 +1,36 @@
+import io
 import os
+import csv
+import hmac
+import json
+import time
+import shutil
+import tempfile
 import logging
-import joblib
+import threading
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from flask import Flask, request, jsonify, session
-from pymongo import MongoClient
+from flask import Flask, Response, request, jsonify, session, send_file
+from pymongo import MongoClient, UpdateOne
 from bson import ObjectId
 from bson.errors import InvalidId
 from dotenv import load_dotenv
 from functools import wraps
-from collections import defaultdict
+from inference import ContributionExplainer, PredictionBatcher, PredictionCache
+from model_store import ModelStore
+from shadow import ShadowScorer, comparison_pipeline
+from bulk_jobs import BulkJobManager, JobStore
+from record_writer import RecordWriter, WriteResult, parse_write_concern
+from table_io import (OUTPUT_FORMATS, UnsupportedFormatError, check_output_format, detect_format,
+                      iter_table_chunks, read_columns, read_table, write_table)
+from metrics import BATCH_SIZE_BUCKETS, STAGE_BUCKETS, MetricsRegistry, MongoCommandMetrics, instrument_app
+from profiling import DOWNLOAD_MIMETYPES, RequestProfiler
+from correlation import CorrelationStore
+from rollups import RollupStore
+from analytics import (ANALYSIS_FEATURES, BINNING_METHODS, MAX_BINS, SUBGROUP_DIMENSIONS, SUBGROUP_METRICS,
+                       TREND_BREAKDOWNS, TREND_GRANULARITIES, feature_distributions, localize_timestamp_filter,
+                       parse_analysis_filters, parse_timezone, subgroup_comparison, temporal_trends)
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -25,32 +45,151 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'default-secret-key')
 
+# Prometheus metrics, served on /metrics
+metrics = MetricsRegistry()
+instrument_app(app, metrics)
+stage_seconds = metrics.histogram('stage_duration_seconds', 'Time spent per prediction stage',
+                                  ['stage', 'model_version'], STAGE_BUCKETS)
+bulk_batch_rows = metrics.histogram('bulk_batch_rows', 'Rows per scored bulk chunk',
+                                    ['source', 'model_version'], BATCH_SIZE_BUCKETS)
+prediction_errors = metrics.counter('prediction_errors_total', 'Predictions rejected by validation or failed',
+                                    ['reason', 'model_version'])
+model_load_seconds = metrics.gauge('model_load_seconds', 'Time taken to load the serving model',
+                                   ['model_version', 'backend', 'source'])
+model_reloads = metrics.gauge('model_reloads', 'Successful model reloads since start-up')
+bulk_jobs_running = metrics.gauge('bulk_jobs_running', 'Bulk jobs currently being scored')
+record_writer_pending = metrics.gauge('record_writer_pending_rows', 'Bulk prediction records waiting to be stored')
+
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
-client = MongoClient(MONGO_URI)
+client = MongoClient(MONGO_URI, event_listeners=[MongoCommandMetrics(metrics)])
 db = client["liverlens_db"]
 users_collection = db["users"]
 predictions_collection = db["predictions"]
+# Serves /history, /stats and finding a user's next latest prediction after a delete
+predictions_collection.create_index([('user_id', 1), ('timestamp', -1)])
+# Serves date ranges of the analysis endpoints
+predictions_collection.create_index('timestamp')
+
+PREDICTION_BATCH_WINDOW_MS = float(os.getenv('PREDICTION_BATCH_WINDOW_MS', '0'))
+PREDICTION_MAX_BATCH_SIZE = int(os.getenv('PREDICTION_MAX_BATCH_SIZE', '64'))
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '4096'))
+PREDICTION_CACHE_TTL_SECONDS = float(os.getenv('PREDICTION_CACHE_TTL_SECONDS', '300'))
+MODEL_WATCH_INTERVAL_SECONDS = float(os.getenv('MODEL_WATCH_INTERVAL_SECONDS', '0'))
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+CHALLENGER_MODEL_DIR = os.getenv('CHALLENGER_MODEL_DIR')
+CHALLENGER_BUNDLE_DIR = os.getenv('CHALLENGER_BUNDLE_DIR')
+SHADOW_MAX_WORKERS = int(os.getenv('SHADOW_MAX_WORKERS', '1'))
+SHADOW_MAX_PENDING = int(os.getenv('SHADOW_MAX_PENDING', '64'))
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '1000'))
+BULK_JOB_DIR = os.getenv('BULK_JOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bulk_job_data'))
+BULK_JOB_WORKERS = int(os.getenv('BULK_JOB_WORKERS', '0')) or None
+BULK_JOB_RETENTION_DAYS = float(os.getenv('BULK_JOB_RETENTION_DAYS', '7'))
+BULK_WRITE_BATCH_SIZE = int(os.getenv('BULK_WRITE_BATCH_SIZE', '500'))
+BULK_WRITE_CONCERN = os.getenv('BULK_WRITE_CONCERN')
+BULK_WRITE_RETRIES = int(os.getenv('BULK_WRITE_RETRIES', '3'))
+BULK_WRITE_WORKERS = int(os.getenv('BULK_WRITE_WORKERS', '2'))
+BULK_MAX_REPORTED_ERRORS = int(os.getenv('BULK_MAX_REPORTED_ERRORS', '1000'))
+EXPLANATION_CACHE_SIZE = int(os.getenv('EXPLANATION_CACHE_SIZE', '8192'))
+STORE_EXPLANATIONS = os.getenv('STORE_EXPLANATIONS', 'false').lower() == 'true'
+EXPLANATION_MAX_IDS = int(os.getenv('EXPLANATION_MAX_IDS', '1000'))
+FEATURE_IMPORTANCE_SAMPLE_SIZE = int(os.getenv('FEATURE_IMPORTANCE_SAMPLE_SIZE', '2000'))
+CORRELATION_FLUSH_SECONDS = float(os.getenv('CORRELATION_FLUSH_SECONDS', '2'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MAX_STORED = int(os.getenv('PROFILE_MAX_STORED', '100'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+
+# Opt-in request profiling: X-Profile with an admin token, or PROFILE_SAMPLE_RATE
+request_profiler = RequestProfiler(
+    PROFILE_DIR,
+    admin_token=ADMIN_TOKEN,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    max_profiles=PROFILE_MAX_STORED,
+    sample_interval_ms=PROFILE_SAMPLE_INTERVAL_MS,
+    excluded_paths=('/admin/profiles', '/metrics', '/health')
+)
+request_profiler.install(app)
+
+# The model is loaded on first use (or by model_store.load() at start-up),
+# so importing this module stays cheap for tests and tooling.
+model_store = ModelStore.from_env()
+if MODEL_WATCH_INTERVAL_SECONDS > 0:
+    model_store.watch(MODEL_WATCH_INTERVAL_SECONDS)
+
+# Optional challenger model, scored in the background next to the champion
+shadow_scorer = None
+if CHALLENGER_MODEL_DIR or CHALLENGER_BUNDLE_DIR:
+    challenger_store = ModelStore(
+        model_dir=CHALLENGER_MODEL_DIR or CHALLENGER_BUNDLE_DIR,
+        bundle_dir=CHALLENGER_BUNDLE_DIR,
+        backend=os.getenv('INFERENCE_BACKEND', 'booster'),
+        nthread=os.getenv('INFERENCE_NTHREAD')
+    )
+    shadow_scorer = ShadowScorer(challenger_store, predictions_collection, SHADOW_MAX_WORKERS, SHADOW_MAX_PENDING)
+    logger.info(f"Shadow scoring enabled for challenger in {CHALLENGER_BUNDLE_DIR or CHALLENGER_MODEL_DIR}")
+
+# Bulk prediction records are stored in the background while the next chunk is scored
+record_writer = RecordWriter(
+    predictions_collection,
+    batch_size=BULK_WRITE_BATCH_SIZE,
+    write_concern=parse_write_concern(BULK_WRITE_CONCERN),
+    max_retries=BULK_WRITE_RETRIES,
+    max_workers=BULK_WRITE_WORKERS
+)
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL_SECONDS) if PREDICTION_CACHE_SIZE > 0 else None
 
-model = None
-preprocessing_components = None
+# Per-prediction feature contributions (?explain=true); they only change with the model, so entries never expire
+explainer = ContributionExplainer(PredictionCache(EXPLANATION_CACHE_SIZE, 0) if EXPLANATION_CACHE_SIZE > 0 else None)
 
-def load_model_and_components():
-    global model, preprocessing_components
+# Running pairwise moments behind the correlation heatmap, updated as predictions are stored and deleted
+correlation_store = CorrelationStore(db['correlation_stats'], flush_interval=CORRELATION_FLUSH_SECONDS)
+
+# Global and per-user prediction counts behind the summary, outcomes and /stats
+rollup_store = RollupStore(db['prediction_rollups'])
+
+# On a database from before these statistics, build them from the stored predictions once
+correlation_store.rebuild_if_missing(predictions_collection)
+rollup_store.rebuild_if_missing(predictions_collection)
+
+def predictions_stored(records, written=None):
+    """Update the derived statistics for newly stored prediction records.
+
+    written is the WriteResult of a background insert; the records it
+    skipped (not stored, or stored before) are left out.
+    """
+    if written is not None and written.skipped:
+        skipped = set(written.skipped)
+        records = [record for index, record in enumerate(records) if index not in skipped]
+    if not records:
+        return
     try:
-        model_path = os.path.join(os.getcwd(), 'final_xgb_model.pkl')
-        model = joblib.load(model_path)
-        logger.info("XGBoost model loaded successfully")
-        preprocessing_path = os.path.join(os.getcwd(), 'preprocessing_components.pkl')
-        preprocessing_components = joblib.load(preprocessing_path)
-        logger.info("Preprocessing components loaded successfully")
-    except FileNotFoundError as e:
-        logger.error(f"Model files not found: {e}")
-        raise
+        correlation_store.record([record.get('input_data') for record in records],
+                                 [record.get('timestamp') for record in records])
     except Exception as e:
-        logger.error(f"Error loading model: {e}")
-        raise
+        logger.error(f"Failed to update correlation statistics: {str(e)}")
+    try:
+        rollup_store.record(records)
+    except Exception as e:
+        logger.error(f"Failed to update prediction rollups: {str(e)}")
 
-load_model_and_components()
+def predictions_deleted(records):
+    """Take deleted prediction records back out of the derived statistics."""
+    try:
+        correlation_store.remove([record.get('input_data') for record in records],
+                                 [record.get('timestamp') for record in records])
+    except Exception as e:
+        logger.error(f"Failed to update correlation statistics: {str(e)}")
+    try:
+        rollup_store.remove(records, predictions_collection)
+    except Exception as e:
+        logger.error(f"Failed to update prediction rollups: {str(e)}")
+
+# Micro-batching is opt-in: a zero window scores every request on its own thread
+batcher = None
+if PREDICTION_BATCH_WINDOW_MS > 0:
+    batcher = PredictionBatcher(PREDICTION_MAX_BATCH_SIZE, PREDICTION_BATCH_WINDOW_MS)
+    logger.info(f"Prediction micro-batching enabled ({PREDICTION_BATCH_WINDOW_MS} ms window, up to {PREDICTION_MAX_BATCH_SIZE} rows)")
 
 @app.after_request
 def add_cors_headers(response):
@@ -65,6 +204,8 @@ def add_cors_headers(response):
 @app.route('/predict-only', methods=['OPTIONS'])
 @app.route('/history', methods=['OPTIONS'])
 @app.route('/history/<prediction_id>', methods=['OPTIONS'])
+@app.route('/history/<prediction_id>/explanation', methods=['OPTIONS'])
+@app.route('/history/explanations', methods=['OPTIONS'])
 @app.route('/stats', methods=['OPTIONS'])
 @app.route('/predict/bulk', methods=['OPTIONS'])
 @app.route('/api/explore', methods=['OPTIONS'])
@@ -75,6 +216,7 @@ def add_cors_headers(response):
 @app.route('/api/analysis/feature-importance', methods=['OPTIONS'])
 @app.route('/api/analysis/temporal-trends', methods=['OPTIONS'])
 @app.route('/api/analysis/subgroup-comparison', methods=['OPTIONS'])
+@app.route('/api/analysis/shadow-comparison', methods=['OPTIONS'])
 def options_handler(prediction_id=None):
     return '', 200
 
@@ -82,6 +224,15 @@ def options_handler(prediction_id=None):
 def options_bulk_delete():
     return '', 200
 
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'error': 'Admin token required'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -125,50 +276,14 @@ def validate_input_data(data):
     
     return True, "Valid input data"
 
-def preprocess_input(data):
-    try:
-        processed_data = data.copy()        
-        for key in processed_data:
-            if processed_data[key] in [None, '', 'null']:
-                processed_data[key] = np.nan        
-        numerical_features = [
-            'N_Days', 'Age', 'Bilirubin', 'Cholesterol', 'Albumin', 'Copper',
-            'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin', 'Stage'
-        ]        
-        for feature in numerical_features:
-            if feature in processed_data:
-                try:
-                    processed_data[feature] = float(processed_data[feature])
-                except (ValueError, TypeError):
-                    processed_data[feature] = np.nan        
-        categorical_features = ['Drug', 'Sex', 'Ascites', 'Hepatomegaly', 'Spiders', 'Edema']
-        for feature in categorical_features:
-            if feature in processed_data and processed_data[feature] not in [None, '', 'null']:
-                processed_data[feature] = str(processed_data[feature]).upper()[0]
-            else:
-                processed_data[feature] = 'N'        
-        df = pd.DataFrame([processed_data])        
-        imputer = preprocessing_components['imputer']
-        df[numerical_features] = imputer.transform(df[numerical_features])        
-        categorical_encoders = preprocessing_components.get('categorical_encoders', {})
-        for feature in categorical_features:
-            if feature in categorical_encoders and feature in df.columns:
-                encoder = categorical_encoders[feature]
-                try:
-                    df[feature] = encoder.transform(df[feature].astype(str))
-                except ValueError:
-                    df[feature] = encoder.transform([encoder.classes_[0]])[0] 
-
-        feature_names = preprocessing_components['feature_names']
-        for feature in feature_names:
-            if feature not in df.columns:
-                df[feature] = 0        
-        df = df[feature_names]
-        logger.info(f"Preprocessed data shape: {df.shape}")
-        return df
-    except Exception as e:
-        logger.error(f"Preprocessing error: {e}")
-        raise
+INPUT_DEFAULTS = {
+    'Ascites': 'N',
+    'Hepatomegaly': 'N',
+    'Spiders': 'N',
+    'Edema': 'N',
+    'Drug': 'Placebo',
+    'Tryglicerides': 100
+}
 
 def get_status_description(status):
     descriptions = {
@@ -182,38 +297,393 @@ def get_risk_level(status):
     risk_levels = {'C': 'Low', 'CL': 'Medium', 'D': 'High'}
     return risk_levels.get(status, 'Unknown')
 
-def make_prediction(data):
+def format_prediction(probabilities, class_labels, model_version=None):
+    predicted_status = class_labels[int(np.argmax(probabilities))]
+    return {
+        'predicted_status': predicted_status,
+        'status_description': get_status_description(predicted_status),
+        'probabilities': {label: float(prob) for label, prob in zip(class_labels, probabilities)},
+        'risk_level': get_risk_level(predicted_status),
+        'model_version': model_version,
+        'disclaimer': 'This prediction is not a medical diagnosis.'
+    }
+
+def format_explanation(contributions, feature_plan, model_version):
+    """JSON-ready feature contributions for one row, largest first for each class.
+
+    Values are in log-odds: a class's base_value plus its contributions is
+    the raw margin that softmax turns into the class probability.
+    """
+    return {
+        'model_version': model_version,
+        'units': 'log_odds',
+        'classes': {
+            label: {
+                'base_value': float(row[-1]),
+                'contributions': [
+                    {'feature': feature_plan.feature_names[i], 'contribution': float(row[i])}
+                    for i in np.argsort(-np.abs(row[:-1]), kind='stable')
+                ]
+            }
+            for label, row in zip(feature_plan.class_labels, contributions)
+        }
+    }
+
+def explain_requested():
+    return request.args.get('explain', 'false').lower() == 'true'
+
+def current_model_version():
+    """Model version label for metrics recorded before (or without) a model load."""
+    return model_store.get().version if model_store.loaded else 'none'
+
+def make_prediction(data, explain=False):
     try:
         logger.info("Starting prediction process")        
-        data.setdefault('Ascites', 'N')
-        data.setdefault('Hepatomegaly', 'N')
-        data.setdefault('Spiders', 'N')
-        data.setdefault('Edema', 'N')
-        data.setdefault('Drug', 'Placebo')
-        data.setdefault('Tryglicerides', 100)        
-        is_valid, message = validate_input_data(data)
+        for feature, default in INPUT_DEFAULTS.items():
+            data.setdefault(feature, default)
+        with stage_seconds.time(stage='validation', model_version=current_model_version()):
+            is_valid, message = validate_input_data(data)
         if not is_valid:
             logger.error(f"Input validation failed: {message}")
+            prediction_errors.inc(reason='validation', model_version=current_model_version())
             return None, message        
-        processed_data = preprocess_input(data)
-        probabilities = model.predict_proba(processed_data)[0]
-        predicted_class_idx = np.argmax(probabilities)
-        label_encoder = preprocessing_components['label_encoder']
-        predicted_status = label_encoder.inverse_transform([predicted_class_idx])[0]
-        
-        prob_dict = {label_encoder.inverse_transform([i])[0]: float(prob) for i, prob in enumerate(probabilities)}
-        
-        return {
-            'predicted_status': predicted_status,
-            'status_description': get_status_description(predicted_status),
-            'probabilities': prob_dict,
-            'risk_level': get_risk_level(predicted_status),
-            'disclaimer': 'This prediction is not a medical diagnosis.'
-        }, None
+        loaded = model_store.get()
+        with stage_seconds.time(stage='preprocessing', model_version=loaded.version):
+            features = loaded.feature_plan.transform(data)
+        with stage_seconds.time(stage='inference', model_version=loaded.version):
+            probabilities = None
+            if prediction_cache is not None:
+                probabilities = prediction_cache.get(features, loaded.version)
+            if probabilities is None:
+                if batcher is not None:
+                    probabilities = batcher.predict_proba(features, loaded.scorer)
+                else:
+                    probabilities = loaded.scorer.predict_proba(features)[0]
+                if prediction_cache is not None:
+                    prediction_cache.put(features, loaded.version, probabilities)
+        response_data = format_prediction(probabilities, loaded.feature_plan.class_labels, loaded.version)
+        if explain:
+            with stage_seconds.time(stage='explanation', model_version=loaded.version):
+                contributions = explainer.explain(loaded, features)[0]
+            response_data['explanation'] = format_explanation(contributions, loaded.feature_plan, loaded.version)
+        return response_data, None
     except Exception as e:
         logger.error(f"Prediction error: {str(e)}")
+        prediction_errors.inc(reason='failure', model_version=current_model_version())
         return None, f'Prediction failed: {str(e)}'
 
+def validate_input_frame(df, row_offset=0):
+    """Column-wise validate_input_data for every row of df in one pass.
+
+    Returns a table with one (row, field, message) line per failed check,
+    rows numbered from row_offset + 1. Lines for a row keep the order
+    validate_input_data checks in, so its first line is the message the
+    single-row check would give. Unlike the single-row check, names and
+    IDs that come through as NaN count as blank and are rejected.
+    """
+    rows = np.arange(row_offset + 1, row_offset + 1 + len(df))
+    checks = []
+    missing_fields = [field for field in BULK_REQUIRED_COLUMNS if field not in df.columns]
+    if missing_fields:
+        checks.append((None, np.ones(len(df), dtype=bool), f"Missing required fields: {', '.join(missing_fields)}"))
+    else:
+        def blank(column):
+            return df[column].isna() | df[column].isin(['', 'null'])
+
+        def number(column):
+            missing = blank(column)
+            values = pd.to_numeric(df[column].where(~missing), errors='coerce')
+            return missing, values, ~missing & values.isna()
+
+        for field, message in (('Patient_Name', 'Patient Name is required'), ('Patient_ID', 'Patient ID is required')):
+            checks.append((field, df[field].isna() | df[field].isin(['', 0]), message))
+
+        age_missing, age, age_invalid = number('Age')
+        checks.append(('Age', age_invalid, 'Age must be a valid number'))
+        checks.append(('Age', ~age_missing & ((age <= 0) | (age > 150)), 'Age must be between 0 and 150 years'))
+
+        # Only None counts as a blank Sex, so an empty CSV cell (NaN) is rejected
+        # rather than encoded as a default sex
+        sex = df['Sex'].astype(str).str.upper()
+        sex_blank = np.equal(df['Sex'].to_numpy(dtype=object), None) | df['Sex'].isin(['', 'null'])
+        checks.append(('Sex', ~sex_blank & ~sex.isin(['M', 'F', 'MALE', 'FEMALE']),
+                       "Sex must be 'M', 'F', 'Male', or 'Female'"))
+
+        stage_missing, stage, stage_invalid = number('Stage')
+        checks.append(('Stage', stage_invalid, 'Stage must be a valid number'))
+        checks.append(('Stage', ~stage_missing & ((stage < 1) | (stage > 4)), 'Stage must be between 1 and 4'))
+
+    errors = []
+    for order, (field, failed, message) in enumerate(checks):
+        failed = np.asarray(failed, dtype=bool)
+        if failed.any():
+            errors.append(pd.DataFrame({'row': rows[failed], 'field': field, 'message': message, 'order': order}))
+    if not errors:
+        return pd.DataFrame(columns=['row', 'field', 'message'])
+    table = pd.concat(errors, ignore_index=True).sort_values(['row', 'order'], kind='stable')
+    return table.drop(columns='order').reset_index(drop=True)
+
+def first_error_message(errors):
+    first = errors.iloc[0]
+    return f"Error at row {first['row']}: {first['message']}"
+
+def error_report(errors, limit=BULK_MAX_REPORTED_ERRORS):
+    """JSON-ready summary of a validate_input_frame table, capped at limit lines."""
+    return {
+        'invalid_rows': int(errors['row'].nunique()),
+        'errors': errors.head(limit).astype(object).where(errors.head(limit).notna(), None).to_dict('records'),
+        'errors_truncated': len(errors) > limit
+    }
+
+def prepare_batch(df, row_offset=0, skip_invalid=False):
+    """Fill input defaults into a copy of df and validate every row.
+
+    Returns (df, errors, message). df is indexed by 1-based file row and,
+    with skip_invalid, holds only the valid rows; errors is the
+    validate_input_frame table. Without skip_invalid any invalid row makes
+    df None and message names the first one.
+    """
+    df = df.copy()
+    df.index = pd.RangeIndex(row_offset + 1, row_offset + 1 + len(df))
+    for feature, default in INPUT_DEFAULTS.items():
+        if feature not in df.columns:
+            df[feature] = default
+    with stage_seconds.time(stage='validation', model_version=current_model_version()):
+        errors = validate_input_frame(df, row_offset)
+    if errors.empty:
+        return df, errors, None
+    if not skip_invalid:
+        message = first_error_message(errors)
+        logger.error(f"Input validation failed: {message} ({errors['row'].nunique()} invalid rows)")
+        return None, errors, message
+    logger.info(f"Skipping {errors['row'].nunique()} invalid rows")
+    return df.drop(index=errors['row'].unique()), errors, None
+
+def score_frame(loaded, df, source, explain=False):
+    """transform_frame and predict_proba for one bulk chunk, recording stage metrics.
+
+    Returns (probabilities, contributions, latency_ms) where latency covers
+    preprocessing and inference. contributions is None unless explain is
+    set, in which case the whole chunk is explained in one batch.
+    """
+    started = time.perf_counter()
+    features = loaded.feature_plan.transform_frame(df)
+    transformed = time.perf_counter()
+    probabilities = loaded.scorer.predict_proba(features)
+    finished = time.perf_counter()
+    stage_seconds.observe(transformed - started, stage='preprocessing', model_version=loaded.version)
+    stage_seconds.observe(finished - transformed, stage='inference', model_version=loaded.version)
+    bulk_batch_rows.observe(len(df), source=source, model_version=loaded.version)
+    contributions = None
+    if explain:
+        with stage_seconds.time(stage='explanation', model_version=loaded.version):
+            contributions = explainer.explain(loaded, features)
+    return probabilities, contributions, (finished - started) * 1000
+
+def format_scored_frame(loaded, probabilities, contributions):
+    results = [format_prediction(row, loaded.feature_plan.class_labels, loaded.version) for row in probabilities]
+    if contributions is not None:
+        for result, row in zip(results, contributions):
+            result['explanation'] = format_explanation(row, loaded.feature_plan, loaded.version)
+    return results
+
+def score_batch(df, source='stream', explain=False):
+    """Score a prepared DataFrame with one predict_proba call.
+
+    Returns (results, latency_ms) with one make_prediction-style dict per row.
+    """
+    loaded = model_store.get()
+    if df.empty:
+        return [], 0.0
+    probabilities, contributions, latency_ms = score_frame(loaded, df, source, explain)
+    return format_scored_frame(loaded, probabilities, contributions), latency_ms
+
+BULK_REQUIRED_COLUMNS = [
+    'Patient_Name', 'Patient_ID', 'N_Days', 'Drug', 'Age', 'Sex', 'Ascites', 
+    'Hepatomegaly', 'Spiders', 'Edema', 'Bilirubin', 'Cholesterol', 'Albumin',
+    'Copper', 'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin', 'Stage'
+]
+BULK_RESULT_COLUMNS = [
+    'predicted_status', 'status_description', 'risk_level',
+    'probability_C', 'probability_CL', 'probability_D'
+]
+BULK_STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def save_bulk_results(df, results, user_id, timestamp, latency_ms, record_ids=None):
+    """Queue one scored upload (or chunk) for storage.
+
+    Returns (response rows, write) where write is a Future for the
+    WriteResult; the records are stored by record_writer in the background.
+    record_ids are the records' _id values; new ones are generated if not given.
+    """
+    if record_ids is None:
+        record_ids = [ObjectId() for _ in range(len(df))]
+    predictions_to_save = []
+    predictions = []
+    for data, response_data, record_id in zip(df.to_dict('records'), results, record_ids):
+        prediction_record = {
+            '_id': record_id,
+            'user_id': user_id,
+            'input_data': data,
+            'prediction': response_data['predicted_status'],
+            'probabilities': response_data['probabilities'],
+            'risk_level': response_data['risk_level'],
+            'model_version': response_data['model_version'],
+            'timestamp': timestamp
+        }
+        row = {
+            **data,
+            'predicted_status': response_data['predicted_status'],
+            'status_description': response_data['status_description'],
+            'risk_level': response_data['risk_level'],
+            'probability_C': response_data['probabilities'].get('C', 0),
+            'probability_CL': response_data['probabilities'].get('CL', 0),
+            'probability_D': response_data['probabilities'].get('D', 0),
+        }
+        if 'explanation' in response_data:
+            row['explanation'] = response_data['explanation']
+            if STORE_EXPLANATIONS:
+                prediction_record['explanation'] = response_data['explanation']
+        predictions_to_save.append(prediction_record)
+        predictions.append(row)
+
+    write = record_writer.submit(predictions_to_save)
+    write.add_done_callback(lambda future: predictions_stored(predictions_to_save, future.result()))
+    if shadow_scorer is not None and predictions_to_save:
+        record_ids = [record['_id'] for record in predictions_to_save]
+        champion_probabilities = [record['probabilities'] for record in predictions_to_save]
+        # Shadow results update the stored records, so wait until they exist
+        write.add_done_callback(lambda _: shadow_scorer.submit_batch(
+            record_ids, df, champion_probabilities, latency_ms / len(record_ids)
+        ))
+    return predictions, write
+
+def wait_for_writes(writes):
+    """Block until every queued write is done and return the combined WriteResult."""
+    persisted = failed = 0
+    for write in writes:
+        result = write.result()
+        persisted += result.persisted
+        failed += result.failed
+    return WriteResult(persisted, failed)
+
+def score_and_save_bulk(df, user_id, explain=False):
+    """Score a validated upload in BULK_CHUNK_SIZE slices, storing each slice while the next is scored."""
+    loaded = model_store.get()
+    timestamp = datetime.utcnow()
+    predictions = []
+    writes = []
+    for start in range(0, len(df), BULK_CHUNK_SIZE):
+        chunk = df.iloc[start:start + BULK_CHUNK_SIZE]
+        probabilities, contributions, latency_ms = score_frame(loaded, chunk, 'sync', explain)
+        results = format_scored_frame(loaded, probabilities, contributions)
+        rows, write = save_bulk_results(chunk, results, user_id, timestamp, latency_ms)
+        predictions.extend(rows)
+        writes.append(write)
+    return predictions, wait_for_writes(writes)
+
+def save_job_chunk(user_id, chunk, probabilities, class_labels, model_version, latency_ms, timestamp, record_ids):
+    """Queue a chunk scored by a bulk job worker process; returns (response rows, write)."""
+    # Timed in the worker process, so preprocessing and inference are one stage here
+    stage_seconds.observe(latency_ms / 1000, stage='job_scoring', model_version=model_version)
+    bulk_batch_rows.observe(len(chunk), source='job', model_version=model_version)
+    results = [format_prediction(row, class_labels, model_version) for row in probabilities]
+    return save_bulk_results(chunk, results, user_id, timestamp, latency_ms, record_ids)
+
+_job_manager = None
+
+def get_job_manager():
+    """Create the bulk job manager on first use and resume jobs a previous run left active."""
+    global _job_manager
+    if _job_manager is None:
+        job_store = JobStore(BULK_JOB_DIR)
+        job_store.purge(BULK_JOB_RETENTION_DAYS)
+        _job_manager = BulkJobManager(job_store, model_store, prepare_batch, save_job_chunk,
+                                      max_workers=BULK_JOB_WORKERS, chunk_size=BULK_CHUNK_SIZE)
+        _job_manager.resume()
+    return _job_manager
+
+def format_stream_rows(predictions, stream_format, columns, header=False):
+    if stream_format == 'ndjson':
+        return ''.join(json.dumps(row, default=str) + '\n' for row in predictions)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    if header:
+        writer.writeheader()
+    writer.writerows(predictions)
+    return buffer.getvalue()
+
+def format_stream_error(message, stream_format):
+    if stream_format == 'ndjson':
+        return json.dumps({'error': message}) + '\n'
+    return f'# Error: {message}\n'
+
+def stream_bulk_predictions(upload, first_chunk, first_errors, rows_read, chunks, stream_format, user_id,
+                            skip_invalid=False, explain=False):
+    """Yield scored rows chunk by chunk, queueing each chunk for storage as it goes.
+
+    Only one chunk of the upload is held in memory at a time. first_chunk
+    is already validated; later chunks that fail validation end the stream
+    with an error line, since the status code has already been sent. With
+    skip_invalid, invalid rows are reported as error lines and skipped.
+    upload is the temporary copy chunks read from; Flask closes the
+    request's own file before the stream finishes.
+    """
+    timestamp = datetime.utcnow()
+    columns = list(first_chunk.columns) + BULK_RESULT_COLUMNS
+    header = True
+    scored = 0
+    writes = []
+    chunk, errors = first_chunk, first_errors
+    try:
+        while True:
+            for error in errors.itertuples(index=False):
+                yield format_stream_error(f'Row {error.row}: {error.message}', stream_format)
+            results, latency_ms = score_batch(chunk, explain=explain)
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            predictions, write = save_bulk_results(chunk, results, user_id, timestamp, latency_ms)
+            writes.append(write)
+            yield format_stream_rows(predictions, stream_format, columns, header=header)
+            header = False
+            scored += len(predictions)
+
+            raw_chunk = next(chunks, None)
+            if raw_chunk is None:
+                break
+            chunk, errors, message = prepare_batch(raw_chunk, rows_read, skip_invalid)
+            rows_read += len(raw_chunk)
+            if message:
+                logger.error(f"Streaming bulk prediction stopped after {scored} rows: {message}")
+                yield format_stream_error(message, stream_format)
+                return
+        logger.info(f"Streaming bulk prediction completed: {scored} predictions")
+    except Exception as e:
+        logger.error(f"Streaming bulk prediction error after {scored} rows: {str(e)}")
+        yield format_stream_error('Failed to process CSV file', stream_format)
+    finally:
+        chunks.close()
+        upload.close()
+        written = wait_for_writes(writes)
+        logger.info(f"Streaming bulk prediction stored {written.persisted} records ({written.failed} failed)")
+
+def negotiate_output_format():
+    """Pick 'json', 'parquet' or 'arrow' from ?format= or the Accept header."""
+    requested = request.args.get('format')
+    if requested:
+        return requested.lower()
+    mimetypes = {mimetype: name for name, mimetype in OUTPUT_FORMATS.items()}
+    best = request.accept_mimetypes.best_match(['application/json'] + list(mimetypes))
+    return mimetypes.get(best, 'json')
+
+def table_response(rows, output_format, columns, headers=None):
+    body = write_table(rows, output_format, model_store.get().feature_plan, columns)
+    extension = 'parquet' if output_format == 'parquet' else 'arrow'
+    response = Response(body, mimetype=OUTPUT_FORMATS[output_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=predictions.{extension}'
+    for name, value in (headers or {}).items():
+        response.headers[name] = str(value)
+    return response
+
 @app.route('/predict/bulk', methods=['POST'])
 @login_required
 def predict_bulk():
@@ -224,65 +694,288 @@ def predict_bulk():
         return jsonify({'error': 'No CSV file provided'}), 400
 
     file = request.files['csv_file']
-    if file.filename == '' or not file.filename.lower().endswith('.csv'):
-        return jsonify({'error': 'Please upload a CSV file'}), 400
+    input_format = detect_format(file.filename)
+    if input_format is None:
+        return jsonify({'error': 'Please upload a CSV (optionally .gz or .zst), Parquet or Arrow file'}), 400
 
+    stream_format = request.args.get('stream')
+    if stream_format and stream_format not in BULK_STREAM_FORMATS:
+        return jsonify({'error': f'Unsupported stream format, use one of: {", ".join(BULK_STREAM_FORMATS)}'}), 400
+    output_format = negotiate_output_format()
+    if output_format != 'json' and output_format not in OUTPUT_FORMATS:
+        return jsonify({'error': f'Unsupported output format, use json or one of: {", ".join(OUTPUT_FORMATS)}'}), 400
+    if output_format != 'json':
+        # Before anything is scored and stored, not when the response is written
+        try:
+            check_output_format(output_format)
+        except UnsupportedFormatError as e:
+            return jsonify({'error': str(e)}), 415
+    skip_invalid = request.args.get('skip_invalid', 'false').lower() == 'true'
+    explain = explain_requested()
+    if explain and (output_format != 'json' or stream_format == 'csv'):
+        return jsonify({'error': 'explain=true is only available with JSON or NDJSON output'}), 400
+
+    upload = chunks = None
     try:
-        df = pd.read_csv(file)
-        required_columns = [
-            'Patient_Name', 'Patient_ID', 'N_Days', 'Drug', 'Age', 'Sex', 'Ascites', 
-            'Hepatomegaly', 'Spiders', 'Edema', 'Bilirubin', 'Cholesterol', 'Albumin',
-            'Copper', 'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin', 'Stage'
-        ]
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        if stream_format:
+            upload = tempfile.TemporaryFile()
+            shutil.copyfileobj(file.stream, upload)
+            upload.seek(0)
+            chunks = iter_table_chunks(upload, input_format, BULK_CHUNK_SIZE)
+            df = next(chunks, None)
+            if df is None:
+                return jsonify({'error': 'CSV file is empty'}), 400
+        else:
+            df = read_table(file.stream, input_format)
+        missing_columns = [col for col in BULK_REQUIRED_COLUMNS if col not in df.columns]
         if missing_columns:
             return jsonify({'error': f'Missing columns: {", ".join(missing_columns)}'}), 400
 
-        predictions_to_save = []
-        predictions = []
-        for index, row in df.iterrows():
-            data = row.to_dict()
-            response_data, error = make_prediction(data)
-            if error:
-                return jsonify({'error': f'Error at row {index + 1}: {error}'}), 400
-            prediction_record = {
-                'user_id': session['user_id'],
-                'input_data': data,
-                'prediction': response_data['predicted_status'],
-                'probabilities': response_data['probabilities'],
-                'risk_level': response_data['risk_level'],
-                'timestamp': datetime.utcnow()
-            }
-            predictions_to_save.append(prediction_record)
-            predictions.append({
-                **data,
-                'predicted_status': response_data['predicted_status'],
-                'status_description': response_data['status_description'],
-                'risk_level': response_data['risk_level'],
-                'probability_C': response_data['probabilities'].get('C', 0),
-                'probability_CL': response_data['probabilities'].get('CL', 0),
-                'probability_D': response_data['probabilities'].get('D', 0),
-            })
+        # The first chunk (or the whole file) is validated before anything is stored
+        rows_read = len(df)
+        df, errors, message = prepare_batch(df, skip_invalid=skip_invalid)
+        if message:
+            return jsonify({'error': message, **error_report(errors)}), 400
 
-        if predictions_to_save:
-            predictions_collection.insert_many(predictions_to_save)
+        if stream_format:
+            response = Response(
+                stream_bulk_predictions(upload, df, errors, rows_read, chunks, stream_format,
+                                        session['user_id'], skip_invalid, explain),
+                mimetype=BULK_STREAM_FORMATS[stream_format]
+            )
+            upload = None
+            return response
 
-        logger.info(f"Bulk prediction completed: {len(predictions)} predictions")
-        return jsonify({'predictions': predictions}), 200
+        predictions, written = score_and_save_bulk(df, session['user_id'], explain)
+        logger.info(f"Bulk prediction completed: {len(predictions)} predictions, "
+                    f"{written.persisted} stored, {written.failed} failed")
+        if output_format != 'json':
+            return table_response(predictions, output_format, list(df.columns) + BULK_RESULT_COLUMNS, {
+                'X-Persisted-Rows': written.persisted,
+                'X-Failed-Writes': written.failed,
+                'X-Invalid-Rows': errors['row'].nunique()
+            })
+        return jsonify({
+            'predictions': predictions,
+            'persisted': written.persisted,
+            'failed_writes': written.failed,
+            **error_report(errors)
+        }), 200
+    except UnsupportedFormatError as e:
+        return jsonify({'error': str(e)}), 415
     except Exception as e:
         logger.error(f"Bulk prediction error: {str(e)}")
         return jsonify({'error': 'Failed to process CSV file'}), 500
+    finally:
+        # Closed here unless it was handed to the streaming response
+        if upload is not None:
+            if chunks is not None:
+                chunks.close()
+            upload.close()
+
+def job_response(job):
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'skip_invalid': bool(job['skip_invalid']),
+        'input_format': job['input_format'],
+        'processed_rows': job['processed_rows'],
+        'invalid_rows': get_job_manager().job_store.invalid_rows(job['id']),
+        'persisted_rows': job['persisted_rows'],
+        'failed_writes': job['failed_writes'],
+        'model_version': job['model_version'],
+        'error': job['error'],
+        'cancel_requested': bool(job['cancel_requested']),
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+        'finished_at': job['finished_at']
+    }
+
+def get_user_job(job_id):
+    job = get_job_manager().job_store.get(job_id)
+    if job is None or job['user_id'] != session['user_id']:
+        return None
+    return job
+
+@app.route('/predict/bulk/jobs', methods=['POST'])
+@login_required
+def submit_bulk_job():
+    if session.get('role') != 'Doctor':
+        return jsonify({'error': 'Access denied. Only available to doctors.'}), 403
+
+    if 'csv_file' not in request.files:
+        return jsonify({'error': 'No CSV file provided'}), 400
+
+    file = request.files['csv_file']
+    input_format = detect_format(file.filename)
+    if input_format is None:
+        return jsonify({'error': 'Please upload a CSV (optionally .gz or .zst), Parquet or Arrow file'}), 400
+
+    try:
+        columns = read_columns(file.stream, input_format)
+        missing_columns = [col for col in BULK_REQUIRED_COLUMNS if col not in columns]
+        if missing_columns:
+            return jsonify({'error': f'Missing columns: {", ".join(missing_columns)}'}), 400
+
+        skip_invalid = request.args.get('skip_invalid', 'false').lower() == 'true'
+        job_id = get_job_manager().submit(session['user_id'], file.filename, file.stream, skip_invalid, input_format)
+        logger.info(f"Bulk job {job_id} queued for {file.filename}")
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+    except pd.errors.EmptyDataError:
+        return jsonify({'error': 'CSV file is empty'}), 400
+    except UnsupportedFormatError as e:
+        return jsonify({'error': str(e)}), 415
+    except Exception as e:
+        logger.error(f"Bulk job submission error: {str(e)}")
+        return jsonify({'error': 'Failed to queue CSV file'}), 500
+
+@app.route('/predict/bulk/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_bulk_job(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_response(job)), 200
+
+@app.route('/predict/bulk/jobs/<job_id>/results', methods=['GET'])
+@login_required
+def get_bulk_job_results(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', 500))), 5000)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    output_format = negotiate_output_format()
+    if output_format != 'json' and output_format not in OUTPUT_FORMATS:
+        return jsonify({'error': f'Unsupported output format, use json or one of: {", ".join(OUTPUT_FORMATS)}'}), 400
+
+    predictions = get_job_manager().job_store.results(job_id, offset, limit)
+    next_offset = predictions[-1]['row'] + 1 if predictions else None
+    if next_offset is not None and next_offset > job['processed_rows']:
+        next_offset = None
+    if output_format != 'json':
+        try:
+            return table_response(predictions, output_format, None, {
+                'X-Job-Status': job['status'],
+                'X-Next-Offset': next_offset if next_offset is not None else ''
+            })
+        except UnsupportedFormatError as e:
+            return jsonify({'error': str(e)}), 415
+    return jsonify({
+        **job_response(job),
+        'offset': offset,
+        'predictions': predictions,
+        'next_offset': next_offset
+    }), 200
+
+@app.route('/predict/bulk/jobs/<job_id>/errors', methods=['GET'])
+@login_required
+def get_bulk_job_errors(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', 500))), 5000)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+
+    errors = get_job_manager().job_store.errors(job_id, offset, limit)
+    return jsonify({
+        'job_id': job_id,
+        'offset': offset,
+        'errors': errors,
+        'next_offset': errors[-1]['row'] + 1 if len({error['row'] for error in errors}) == limit else None
+    }), 200
+
+@app.route('/predict/bulk/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_bulk_job(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] not in ('queued', 'running'):
+        return jsonify({'error': f"Job is already {job['status']}"}), 409
+    get_job_manager().cancel(job_id)
+    return jsonify(job_response(get_job_manager().job_store.get(job_id))), 202
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
         'service': 'LiverLens Prediction API',
-        'model_loaded': model is not None,
-        'preprocessing_loaded': preprocessing_components is not None,
+        'model_loaded': model_store.loaded,
+        'preprocessing_loaded': model_store.loaded,
+        'model': model_store.get().describe() if model_store.loaded else None,
+        'batching': batcher.stats() if batcher is not None else None,
+        'prediction_cache': prediction_cache.stats() if prediction_cache is not None else None,
+        'bulk_jobs': _job_manager.stats() if _job_manager is not None else None,
+        'record_writer': record_writer.stats(),
+        'explanations': explainer.stats(),
+        'correlation_stats': correlation_store.stats(),
+        'rollups': rollup_store.stats(),
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Values owned by other components are read at scrape time
+    model_load_seconds.clear()
+    if model_store.loaded:
+        loaded = model_store.get()
+        model_load_seconds.set(loaded.load_seconds, model_version=loaded.version, backend=loaded.scorer.name,
+                               source=loaded.source)
+    model_reloads.set(model_store.reload_count)
+    bulk_jobs_running.set(_job_manager.stats()['running_jobs'] if _job_manager is not None else 0)
+    record_writer_pending.set(record_writer.stats()['pending_rows'])
+    return metrics.response()
+
+@app.route('/admin/model', methods=['GET'])
+@admin_required
+def model_status():
+    return jsonify(model_store.status()), 200
+
+@app.route('/admin/model/reload', methods=['POST'])
+@admin_required
+def reload_model():
+    wait = request.args.get('wait', 'false').lower() == 'true'
+    started = model_store.reload(wait=wait)
+    if not started:
+        return jsonify({'error': 'A model reload is already in progress', **model_store.status()}), 409
+    return jsonify(model_store.status()), 200 if wait else 202
+
+@app.route('/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    try:
+        limit = min(max(1, int(request.args.get('limit', 50))), PROFILE_MAX_STORED)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return jsonify({'profiles': request_profiler.list(limit)}), 200
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+@admin_required
+def get_profile(profile_id):
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return jsonify(profile), 200
+
+@app.route('/admin/profiles/<profile_id>/<kind>', methods=['GET'])
+@admin_required
+def download_profile(profile_id, kind):
+    path = request_profiler.file_path(profile_id, kind)
+    if path is None:
+        return jsonify({'error': 'Profile file not found'}), 404
+    return send_file(path, mimetype=DOWNLOAD_MIMETYPES[kind], as_attachment=True,
+                     download_name=os.path.basename(path))
+
 @app.route('/')
 def home():
     return jsonify({
@@ -294,6 +987,7 @@ def home():
             'predict-only': '/predict-only (POST)',
             'history': '/history (GET)',
             'health': '/health (GET)',
+            'metrics': '/metrics (GET)',
             'predict/bulk': '/predict/bulk (POST)',
             'explore': '/api/explore (GET)'
         }
@@ -307,7 +1001,7 @@ def predict_only():
         if not data:
             return jsonify({'error': 'No input data provided'}), 400
         
-        response_data, error = make_prediction(data)
+        response_data, error = make_prediction(data, explain_requested())
         if error:
             return jsonify({'error': error}), 400
         
@@ -324,7 +1018,9 @@ def predict():
         if not data:
             return jsonify({'error': 'No input data provided'}), 400
         
-        response_data, error = make_prediction(data)
+        started = time.perf_counter()
+        response_data, error = make_prediction(data, explain_requested())
+        latency_ms = (time.perf_counter() - started) * 1000
         if error:
             return jsonify({'error': error}), 400
         
@@ -334,10 +1030,16 @@ def predict():
             'prediction': response_data['predicted_status'],
             'probabilities': response_data['probabilities'],
             'risk_level': response_data['risk_level'],
+            'model_version': response_data['model_version'],
             'timestamp': datetime.utcnow()
         }
+        if STORE_EXPLANATIONS and 'explanation' in response_data:
+            prediction_record['explanation'] = response_data['explanation']
         
-        predictions_collection.insert_one(prediction_record)
+        insert_result = predictions_collection.insert_one(prediction_record)
+        predictions_stored([prediction_record])
+        if shadow_scorer is not None:
+            shadow_scorer.submit(insert_result.inserted_id, data, response_data['probabilities'], latency_ms)
         return jsonify(response_data), 200
     except Exception as e:
         logger.error(f"Prediction error: {str(e)}")
@@ -359,6 +1061,7 @@ def delete_prediction(prediction_id):
         
         result = predictions_collection.delete_one({'_id': obj_id})
         if result.deleted_count == 1:
+            predictions_deleted([prediction])
             return jsonify({'message': 'Prediction deleted successfully'}), 200
         return jsonify({'error': 'Failed to delete prediction'}), 500
     except Exception as e:
@@ -402,6 +1105,80 @@ def get_history():
         logger.error(f"History retrieval error: {e}")
         return jsonify({'error': 'Failed to retrieve prediction history'}), 500
 
+def explain_records(records):
+    """Explanations of stored prediction records with the serving model.
+
+    A stored explanation is reused when it was made by the same model
+    version; the other records are explained together in one batch and,
+    with STORE_EXPLANATIONS, saved back onto their records.
+    """
+    loaded = model_store.get()
+    explanations = [record.get('explanation') for record in records]
+    pending = [i for i, explanation in enumerate(explanations)
+               if not explanation or explanation.get('model_version') != loaded.version]
+    if pending:
+        frame = pd.DataFrame.from_records([records[i].get('input_data') or {} for i in pending])
+        features = loaded.feature_plan.transform_frame(frame)
+        with stage_seconds.time(stage='explanation', model_version=loaded.version):
+            contributions = explainer.explain(loaded, features)
+        for i, row in zip(pending, contributions):
+            explanations[i] = format_explanation(row, loaded.feature_plan, loaded.version)
+        if STORE_EXPLANATIONS:
+            predictions_collection.bulk_write([
+                UpdateOne({'_id': records[i]['_id']}, {'$set': {'explanation': explanations[i]}}) for i in pending
+            ], ordered=False)
+    return explanations
+
+@app.route('/history/<prediction_id>/explanation', methods=['GET'])
+@login_required
+def get_prediction_explanation(prediction_id):
+    try:
+        obj_id = ObjectId(prediction_id)
+    except InvalidId:
+        return jsonify({'error': 'Invalid prediction ID'}), 400
+
+    try:
+        record = predictions_collection.find_one({'_id': obj_id, 'user_id': session['user_id']},
+                                                 {'input_data': 1, 'model_version': 1, 'explanation': 1})
+        if not record:
+            return jsonify({'error': 'Prediction not found or not authorized'}), 404
+        return jsonify({
+            'prediction_id': prediction_id,
+            'prediction_model_version': record.get('model_version'),
+            **explain_records([record])[0]
+        }), 200
+    except Exception as e:
+        logger.error(f"Prediction explanation error: {e}")
+        return jsonify({'error': 'Failed to explain prediction'}), 500
+
+@app.route('/history/explanations', methods=['POST'])
+@login_required
+def explain_predictions():
+    data = request.get_json(silent=True)
+    prediction_ids = (data or {}).get('prediction_ids')
+    if not isinstance(prediction_ids, list) or not prediction_ids:
+        return jsonify({'error': 'No prediction IDs provided'}), 400
+    if len(prediction_ids) > EXPLANATION_MAX_IDS:
+        return jsonify({'error': f'At most {EXPLANATION_MAX_IDS} predictions can be explained per request'}), 400
+    try:
+        obj_ids = [ObjectId(pred_id) for pred_id in prediction_ids]
+    except (InvalidId, TypeError):
+        return jsonify({'error': 'Invalid prediction ID format'}), 400
+
+    try:
+        records = list(predictions_collection.find({'_id': {'$in': obj_ids}, 'user_id': session['user_id']},
+                                                   {'input_data': 1, 'model_version': 1, 'explanation': 1}))
+        explanations = {}
+        for record, explanation in zip(records, explain_records(records) if records else []):
+            explanations[str(record['_id'])] = {'prediction_model_version': record.get('model_version'), **explanation}
+        return jsonify({
+            'explanations': explanations,
+            'not_found': [pred_id for pred_id in map(str, obj_ids) if pred_id not in explanations]
+        }), 200
+    except Exception as e:
+        logger.error(f"Prediction explanation error: {e}")
+        return jsonify({'error': 'Failed to explain predictions'}), 500
+
 
 @app.route('/history/bulk-delete', methods=['DELETE'])
 @login_required
@@ -423,17 +1200,21 @@ def bulk_delete_predictions():
                 return jsonify({'error': f'Invalid prediction ID: {pred_id}'}), 400
         
         user_id = session['user_id']
-        user_predictions = predictions_collection.find({'_id': {'$in': valid_ids}, 'user_id': user_id})
+        user_predictions = list(predictions_collection.find({'_id': {'$in': valid_ids}, 'user_id': user_id}))
         user_prediction_ids = [pred['_id'] for pred in user_predictions]
         
         if len(user_prediction_ids) != len(valid_ids):
             return jsonify({'error': 'Some predictions not found or not authorized'}), 403
         
-        delete_result = predictions_collection.delete_many({'_id': {'$in': valid_ids}, 'user_id': user_id})
-        if delete_result.deleted_count > 0:
+        # One at a time, so only records this request removed are taken out of the statistics;
+        # a concurrent delete of the same prediction has already taken it out
+        deleted = [pred for pred in user_predictions
+                   if predictions_collection.delete_one({'_id': pred['_id'], 'user_id': user_id}).deleted_count]
+        if deleted:
+            predictions_deleted(deleted)
             return jsonify({
-                'message': f'Successfully deleted {delete_result.deleted_count} predictions',
-                'deleted_count': delete_result.deleted_count
+                'message': f'Successfully deleted {len(deleted)} predictions',
+                'deleted_count': len(deleted)
             }), 200
         return jsonify({'error': 'No predictions were deleted'}), 400
     except Exception as e:
@@ -448,63 +1229,15 @@ def get_analysis_summary():
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
     
     try:
-     
-        pipeline = [
-            {
-                '$group': {
-                    '_id': None,
-                    'total_predictions': {'$sum': 1},
-                    'avg_age': {'$avg': '$input_data.Age'},
-                    'avg_bilirubin': {'$avg': '$input_data.Bilirubin'},
-                    'avg_albumin': {'$avg': '$input_data.Albumin'},
-                    'avg_cholesterol': {'$avg': '$input_data.Cholesterol'},
-                    'avg_copper': {'$avg': '$input_data.Copper'},
-                    'avg_alk_phos': {'$avg': '$input_data.Alk_Phos'},
-                    'avg_sgot': {'$avg': '$input_data.SGOT'},
-                    'avg_tryglicerides': {'$avg': '$input_data.Tryglicerides'},
-                    'avg_platelets': {'$avg': '$input_data.Platelets'},
-                    'avg_prothrombin': {'$avg': '$input_data.Prothrombin'},
-                    'high_risk_count': {
-                        '$sum': {'$cond': [{'$eq': ['$risk_level', 'High']}, 1, 0]}
-                    },
-                    'medium_risk_count': {
-                        '$sum': {'$cond': [{'$eq': ['$risk_level', 'Medium']}, 1, 0]}
-                    },
-                    'low_risk_count': {
-                        '$sum': {'$cond': [{'$eq': ['$risk_level', 'Low']}, 1, 0]}
-                    }
-                }
-            }
-        ]
-        
-        result = list(predictions_collection.aggregate(pipeline))
-        
-        if not result:
-            return jsonify({
-                'total_predictions': 0,
-                'avg_age': 0,
-                'avg_bilirubin': 0,
-                'avg_albumin': 0,
-                'avg_cholesterol': 0,
-                'avg_copper': 0,
-                'avg_alk_phos': 0,
-                'avg_sgot': 0,
-                'avg_tryglicerides': 0,
-                'avg_platelets': 0,
-                'avg_prothrombin': 0,
-                'high_risk_count': 0,
-                'medium_risk_count': 0,
-                'low_risk_count': 0
-            }), 200
-        
-        summary = result[0]
-        summary.pop('_id', None)
-        
-    
-        for key, value in summary.items():
-            if value is None:
-                summary[key] = 0
-        
+        rollup = rollup_store.summary()
+        summary = {
+            'total_predictions': rollup['total'],
+            'high_risk_count': rollup['risk'].get('High', 0),
+            'medium_risk_count': rollup['risk'].get('Medium', 0),
+            'low_risk_count': rollup['risk'].get('Low', 0)
+        }
+        for feature, average in rollup['averages'].items():
+            summary[f'avg_{feature.lower()}'] = average if average is not None else 0
         return jsonify(summary), 200
         
     except Exception as e:
@@ -518,25 +1251,16 @@ def get_prediction_outcomes():
     if session.get('role') != 'Researcher':
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403    
     try:       
-        pipeline = [
-            {
-                '$group': {
-                    '_id': '$prediction',
-                    'count': {'$sum': 1}
-                }
-            }
-        ]        
-        results = list(predictions_collection.aggregate(pipeline))       
-        total = sum(result['count'] for result in results)        
+        counts = rollup_store.summary()['status']
+        total = sum(counts.values())        
         if total == 0:
             return jsonify([]), 200        
         outcomes = []
-        for result in results:
-            status = result['_id'] if result['_id'] else 'Unknown'
+        for status, count in counts.items():
             outcomes.append({
                 'status': status,
-                'count': result['count'],
-                'percentage': (result['count'] / total) * 100
+                'count': count,
+                'percentage': (count / total) * 100
             })      
         outcomes.sort(key=lambda x: x['count'], reverse=True)       
         return jsonify(outcomes), 200
@@ -553,73 +1277,26 @@ def get_feature_distribution():
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
     
     try:
-        # Get all predictions
-        predictions = list(predictions_collection.find({}, {'input_data': 1}))
-        
-        if not predictions:
-            return jsonify({}), 200
-        
-        # Extract numerical features
-        numerical_features = [
-            'Age', 'Bilirubin', 'Cholesterol', 'Albumin', 'Copper',
-            'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin'
-        ]
-        
-        distributions = {}
-        
-        for feature in numerical_features:
-            # Extract values for this feature
-            values = []
-            for pred in predictions:
-                if 'input_data' in pred and feature in pred['input_data']:
-                    val = pred['input_data'][feature]
-                    if val is not None:
-                        try:
-                            val_float = float(val)
-                            if not np.isnan(val_float) and not np.isinf(val_float):
-                                values.append(val_float)
-                        except (ValueError, TypeError):
-                            continue
-            
-            if not values:
-                continue
-            
-            # Calculate statistics
-            values_array = np.array(values)
-            mean_val = np.mean(values_array)
-            std_val = np.std(values_array)
-            
-            # Create histogram bins
-            min_val = np.min(values_array)
-            max_val = np.max(values_array)
-            
-            # Avoid division by zero
-            if min_val == max_val:
-                bins = np.array([min_val - 0.5, max_val + 0.5])
-            else:
-                bins = np.linspace(min_val, max_val, 11)  # 10 bins
-            
-            hist, bin_edges = np.histogram(values_array, bins=bins)
-            
-            # Format histogram data
-            histogram_data = []
-            max_count = max(hist) if len(hist) > 0 else 1
-            
-            for i in range(len(hist)):
-                histogram_data.append({
-                    'range': f"{bin_edges[i]:.1f}-{bin_edges[i+1]:.1f}",
-                    'count': int(hist[i])
-                })
-            
-            distributions[feature] = {
-                'histogram': histogram_data,
-                'mean': float(mean_val),
-                'std': float(std_val),
-                'max_count': int(max_count)
-            }
-        
-        return jsonify(distributions), 200
-        
+        match = parse_analysis_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        bins = int(request.args.get('bins', 10))
+    except ValueError:
+        return jsonify({'error': 'bins must be an integer'}), 400
+    if not 1 <= bins <= MAX_BINS:
+        return jsonify({'error': f'bins must be between 1 and {MAX_BINS}'}), 400
+    binning = request.args.get('binning', 'equal_width')
+    if binning not in BINNING_METHODS:
+        return jsonify({'error': f'binning must be one of: {", ".join(BINNING_METHODS)}'}), 400
+    features = request.args.get('features')
+    features = features.split(',') if features else ANALYSIS_FEATURES
+    unknown = [feature for feature in features if feature not in ANALYSIS_FEATURES]
+    if unknown:
+        return jsonify({'error': f'Unknown features: {", ".join(unknown)}'}), 400
+
+    try:
+        return jsonify(feature_distributions(predictions_collection, match, features, bins, binning)), 200
     except Exception as e:
         logger.error(f"Feature distribution error: {str(e)}")
         return jsonify({'error': 'Failed to calculate feature distributions'}), 500
@@ -631,67 +1308,26 @@ def get_correlation_matrix():
     if session.get('role') != 'Researcher':
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
     
+    window = {}
+    for name in ('date_from', 'date_to'):
+        if request.args.get(name):
+            try:
+                window[name] = datetime.fromisoformat(request.args[name]).strftime('%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': f'{name} must be an ISO 8601 date'}), 400
+
     try:
-        # Get all predictions
-        predictions = list(predictions_collection.find({}, {'input_data': 1}))
-        
-        if not predictions:
-            return jsonify({'correlation_matrix': [], 'features': []}), 200
-        
-        # Extract numerical features
-        numerical_features = [
-            'Age', 'Bilirubin', 'Cholesterol', 'Albumin', 'Copper',
-            'Alk_Phos', 'SGOT', 'Tryglicerides', 'Platelets', 'Prothrombin'
-        ]
-        
-        # Create DataFrame
-        data = []
-        for pred in predictions:
-            if 'input_data' not in pred:
-                continue
-            
-            row = {}
-            for feature in numerical_features:
-                if feature in pred['input_data']:
-                    val = pred['input_data'][feature]
-                    if val is not None:
-                        try:
-                            val_float = float(val)
-                            if not np.isnan(val_float) and not np.isinf(val_float):
-                                row[feature] = val_float
-                            else:
-                                row[feature] = np.nan
-                        except (ValueError, TypeError):
-                            row[feature] = np.nan
-                    else:
-                        row[feature] = np.nan
-                else:
-                    row[feature] = np.nan
-            data.append(row)
-        
-        if not data:
-            return jsonify({'correlation_matrix': [], 'features': []}), 200
+        # Pairwise moments are kept up to date on insert and delete, so this reads
+        # one document (or one per day of the window) instead of every prediction
+        moments = correlation_store.read(window.get('date_from'), window.get('date_to'))
         
-        df = pd.DataFrame(data)
-        
-        # Remove features with all NaN values
-        df_clean = df.dropna(axis=1, how='all')
-        
-        if df_clean.empty:
-            return jsonify({'correlation_matrix': [], 'features': []}), 200
-        
-        # Calculate correlation matrix
-        correlation_matrix = df_clean.corr()
-        
-        # Convert to list format for frontend
-        correlation_list = correlation_matrix.values.tolist()
-        features_list = correlation_matrix.columns.tolist()
+        # Remove features with no values
+        present = np.diag(moments.n) > 0
+        features_list = [feature for feature, keep in zip(correlation_store.features, present) if keep]
+        correlation_matrix = moments.correlation()[np.ix_(present, present)]
         
         # Replace NaN values with 0
-        for i in range(len(correlation_list)):
-            for j in range(len(correlation_list[i])):
-                if pd.isna(correlation_list[i][j]):
-                    correlation_list[i][j] = 0
+        correlation_list = np.nan_to_num(correlation_matrix, nan=0.0).tolist()
         
         return jsonify({
             'correlation_matrix': correlation_list,
@@ -702,6 +1338,36 @@ def get_correlation_matrix():
         logger.error(f"Correlation matrix error: {str(e)}")
         return jsonify({'error': 'Failed to calculate correlation matrix'}), 500
 
+@app.route('/admin/analysis/correlation/rebuild', methods=['POST'])
+@admin_required
+def rebuild_correlation_stats():
+    if correlation_store.stats()['rebuilding']:
+        return jsonify({'error': 'A rebuild is already in progress'}), 409
+
+    def rebuild():
+        try:
+            correlation_store.rebuild(predictions_collection)
+        except Exception as e:
+            logger.error(f"Correlation statistics rebuild failed: {str(e)}")
+
+    threading.Thread(target=rebuild, name='correlation-rebuild', daemon=True).start()
+    return jsonify({'status': 'rebuilding'}), 202
+
+@app.route('/admin/analysis/rollups/rebuild', methods=['POST'])
+@admin_required
+def rebuild_rollups():
+    if rollup_store.stats()['rebuilding']:
+        return jsonify({'error': 'A rebuild is already in progress'}), 409
+
+    def rebuild():
+        try:
+            rollup_store.rebuild(predictions_collection)
+        except Exception as e:
+            logger.error(f"Prediction rollups rebuild failed: {str(e)}")
+
+    threading.Thread(target=rebuild, name='rollups-rebuild', daemon=True).start()
+    return jsonify({'status': 'rebuilding'}), 202
+
 @app.route('/api/analysis/feature-importance', methods=['GET'])
 @login_required
 def get_feature_importance():
@@ -709,19 +1375,32 @@ def get_feature_importance():
     if session.get('role') != 'Researcher':
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
     
+    method = request.args.get('method', 'gain')
+    if method not in ('gain', 'contributions'):
+        return jsonify({'error': "method must be 'gain' or 'contributions'"}), 400
+
     try:
-        if model is None or preprocessing_components is None:
-            return jsonify({'error': 'Model not loaded'}), 500
+        loaded = model_store.get()
         
         # Get feature names and importances
-        feature_names = preprocessing_components.get('feature_names', [])
+        feature_names = list(loaded.feature_plan.feature_names)
         
-        if hasattr(model, 'feature_importances_'):
-            importances = model.feature_importances_
+        if method == 'gain' and loaded.feature_importances is not None:
+            importances = loaded.feature_importances
         else:
-            # Fallback for models without feature_importances_
-            logger.warning("Model does not have feature_importances_ attribute")
-            importances = np.random.random(len(feature_names))  # Placeholder
+            # Mean absolute contribution (summed over classes) across the latest stored predictions
+            if method == 'gain':
+                logger.warning("Model does not have feature_importances_, using feature contributions instead")
+            records = list(predictions_collection.find({}, {'input_data': 1})
+                           .sort('timestamp', -1).limit(FEATURE_IMPORTANCE_SAMPLE_SIZE))
+            if not records:
+                return jsonify({'error': 'No stored predictions to compute feature contributions from'}), 404
+            features = loaded.feature_plan.transform_frame(
+                pd.DataFrame.from_records([record.get('input_data') or {} for record in records])
+            )
+            with stage_seconds.time(stage='explanation', model_version=loaded.version):
+                contributions = explainer.explain(loaded, features)
+            importances = np.abs(contributions[:, :, :-1]).sum(axis=1).mean(axis=0)
         
         if len(importances) != len(feature_names):
             logger.warning(f"Mismatch between importances ({len(importances)}) and feature names ({len(feature_names)})")
@@ -751,38 +1430,20 @@ def get_temporal_trends():
     if session.get('role') != 'Researcher':
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
     
+    timezone = request.args.get('timezone', 'UTC')
     try:
-     
-        predictions = list(predictions_collection.find({}, {'timestamp': 1}))
-        
-        if not predictions:
-            return jsonify([]), 200
-        
-     
-        date_counts = defaultdict(int)
-        
-        for pred in predictions:
-            timestamp = pred.get('timestamp')
-            if timestamp:
-                try:
-                    if isinstance(timestamp, str):
-                     
-                        timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                    date_str = timestamp.strftime('%Y-%m-%d')
-                    date_counts[date_str] += 1
-                except (ValueError, AttributeError) as e:
-                    logger.warning(f"Invalid timestamp format: {timestamp}, error: {e}")
-                    continue
-        
-       
-        trends = [
-            {'date': date, 'count': count}
-            for date, count in date_counts.items()
-        ]
-        
-        trends.sort(key=lambda x: x['date'])
-        
-        return jsonify(trends), 200
+        match = localize_timestamp_filter(parse_analysis_filters(request.args), parse_timezone(timezone))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in TREND_GRANULARITIES:
+        return jsonify({'error': f'granularity must be one of: {", ".join(TREND_GRANULARITIES)}'}), 400
+    breakdown = request.args.get('breakdown') or None
+    if breakdown is not None and breakdown not in TREND_BREAKDOWNS:
+        return jsonify({'error': f'breakdown must be one of: {", ".join(TREND_BREAKDOWNS)}'}), 400
+
+    try:
+        return jsonify(temporal_trends(predictions_collection, match, granularity, timezone, breakdown)), 200
         
     except Exception as e:
         logger.error(f"Temporal trends error: {str(e)}")
@@ -796,125 +1457,64 @@ def get_subgroup_comparison():
         return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
     
     try:
-       
-        predictions = list(predictions_collection.find({}, {'input_data': 1, 'risk_level': 1}))
-        
-        if not predictions:
-            return jsonify({}), 200
-        
-        comparisons = {}
-        
-     
-        def safe_float(value):
-            if value is None:
-                return None
-            try:
-                return float(value)
-            except (ValueError, TypeError):
-                return None
-    
-        def calculate_group_stats(group_preds):
-            if not group_preds:
-                return {
-                    'count': 0,
-                    'avg_age': None,
-                    'avg_bilirubin': None,
-                    'avg_albumin': None
-                }
-            
-            ages = [safe_float(p.get('input_data', {}).get('Age')) for p in group_preds]
-            ages = [age for age in ages if age is not None]
-            
-            bilirubins = [safe_float(p.get('input_data', {}).get('Bilirubin')) for p in group_preds]
-            bilirubins = [bil for bil in bilirubins if bil is not None]
-            
-            albumins = [safe_float(p.get('input_data', {}).get('Albumin')) for p in group_preds]
-            albumins = [alb for alb in albumins if alb is not None]
-            
-            return {
-                'count': len(group_preds),
-                'avg_age': float(np.mean(ages)) if ages else None,
-                'avg_bilirubin': float(np.mean(bilirubins)) if bilirubins else None,
-                'avg_albumin': float(np.mean(albumins)) if albumins else None
-            }
-        
+        match = parse_analysis_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    dimensions = request.args.get('dimensions')
+    dimensions = dimensions.split(',') if dimensions else list(SUBGROUP_DIMENSIONS)
+    unknown = [dimension for dimension in dimensions if dimension not in SUBGROUP_DIMENSIONS]
+    if unknown:
+        return jsonify({'error': f'Unknown dimensions: {", ".join(unknown)}'}), 400
+    metrics = request.args.get('metrics')
+    metrics = metrics.split(',') if metrics else list(SUBGROUP_METRICS)
+    unknown = [metric for metric in metrics if metric not in ANALYSIS_FEATURES]
+    if unknown:
+        return jsonify({'error': f'Unknown metrics: {", ".join(unknown)}'}), 400
 
-        gender_groups = {'Male': [], 'Female': []}
-        for pred in predictions:
-            sex = pred.get('input_data', {}).get('Sex', 'M')
-            if sex:
-                sex = str(sex).upper()
-                if sex in ['M', 'MALE']:
-                    gender_groups['Male'].append(pred)
-                elif sex in ['F', 'FEMALE']:
-                    gender_groups['Female'].append(pred)
-        
-        comparisons['gender'] = {}
-        for group, group_preds in gender_groups.items():
-            comparisons['gender'][group] = calculate_group_stats(group_preds)
-        
-        
-        risk_groups = {'Low': [], 'Medium': [], 'High': []}
-        for pred in predictions:
-            risk = pred.get('risk_level', 'Low')
-            if risk and risk in risk_groups:
-                risk_groups[risk].append(pred)
-        
-        comparisons['risk_level'] = {}
-        for group, group_preds in risk_groups.items():
-            comparisons['risk_level'][group] = calculate_group_stats(group_preds)
-        
-     
-        age_groups = {'Under_50': [], 'Over_50': []}
-        for pred in predictions:
-            age = safe_float(pred.get('input_data', {}).get('Age'))
-            if age is not None and age > 0:
-                group = 'Under_50' if age < 50 else 'Over_50'
-                age_groups[group].append(pred)
-        
-        comparisons['age_group'] = {}
-        for group, group_preds in age_groups.items():
-            comparisons['age_group'][group] = calculate_group_stats(group_preds)
-        
-     
-        stage_groups = {'Stage_1': [], 'Stage_2': [], 'Stage_3': [], 'Stage_4': []}
-        for pred in predictions:
-            stage = safe_float(pred.get('input_data', {}).get('Stage'))
-            if stage is not None and 1 <= stage <= 4:
-                stage_key = f'Stage_{int(stage)}'
-                stage_groups[stage_key].append(pred)
-        
-        comparisons['stage'] = {}
-        for group, group_preds in stage_groups.items():
-            if group_preds:  
-                comparisons['stage'][group] = calculate_group_stats(group_preds)
-        
-       
-        drug_groups = defaultdict(list)
-        for pred in predictions:
-            drug = pred.get('input_data', {}).get('Drug', 'Unknown')
-            if drug:
-                drug_groups[str(drug)].append(pred)
-        
-        comparisons['drug'] = {}
-        for group, group_preds in drug_groups.items():
-            if len(group_preds) >= 5: 
-                comparisons['drug'][group] = calculate_group_stats(group_preds)
-        
-        return jsonify(comparisons), 200
+    try:
+        return jsonify(subgroup_comparison(predictions_collection, match, dimensions, metrics)), 200
         
     except Exception as e:
         logger.error(f"Subgroup comparison error: {str(e)}")
         return jsonify({'error': 'Failed to get subgroup comparison'}), 500     
 
+@app.route('/api/analysis/shadow-comparison', methods=['GET'])
+@login_required
+def get_shadow_comparison():
+    """Compare champion and challenger predictions recorded by shadow scoring"""
+    if session.get('role') != 'Researcher':
+        return jsonify({'error': 'Access denied. Restricted to researchers.'}), 403
+    
+    try:
+        challenger_version = request.args.get('challenger_version')
+        comparisons = []
+        for result in predictions_collection.aggregate(comparison_pipeline(challenger_version)):
+            versions = result.pop('_id')
+            result['champion_version'] = versions.get('champion')
+            result['challenger_version'] = versions.get('challenger')
+            if result['champion_log_loss'] is not None and result['challenger_log_loss'] is not None:
+                result['log_loss_delta'] = result['challenger_log_loss'] - result['champion_log_loss']
+            else:
+                result['log_loss_delta'] = None
+            comparisons.append(result)
+        
+        return jsonify({
+            'enabled': shadow_scorer is not None,
+            'shadow': shadow_scorer.stats() if shadow_scorer is not None else None,
+            'comparisons': comparisons
+        }), 200
+    except Exception as e:
+        logger.error(f"Shadow comparison error: {str(e)}")
+        return jsonify({'error': 'Failed to compare champion and challenger'}), 500
+
 @app.route('/stats', methods=['GET'])
 @login_required
 def get_stats():
     try:
         user_id = session['user_id']
-        predictions = list(predictions_collection.find({'user_id': user_id}, {'prediction': 1, 'risk_level': 1, 'timestamp': 1}))
-        total_predictions = len(predictions)
-        if total_predictions == 0:
+        rollup = rollup_store.user(user_id)
+        total_predictions = rollup['total']
+        if total_predictions <= 0:
             return jsonify({
                 'total_predictions': 0,
                 'status_distribution': {},
@@ -922,15 +1522,15 @@ def get_stats():
                 'latest_prediction': None
             }), 200
         
-        status_counts = {}
-        risk_counts = {}
-        for pred in predictions:
-            status = pred.get('prediction', 'Unknown')
-            risk = pred.get('risk_level', 'Unknown')
-            status_counts[status] = status_counts.get(status, 0) + 1
-            risk_counts[risk] = risk_counts.get(risk, 0) + 1
+        status_counts = rollup['status']
+        risk_counts = rollup['risk']
         
-        latest_prediction = predictions_collection.find_one({'user_id': user_id}, sort=[('timestamp', -1)])
+        latest_prediction = None
+        if rollup['latest_prediction_id'] is not None:
+            latest_prediction = predictions_collection.find_one({'_id': rollup['latest_prediction_id'],
+                                                                 'user_id': user_id})
+        if latest_prediction is None:
+            latest_prediction = predictions_collection.find_one({'user_id': user_id}, sort=[('timestamp', -1)])
         if latest_prediction:
             latest_prediction['timestamp'] = latest_prediction['timestamp'].isoformat()
             latest_prediction.pop('_id', None)
@@ -1217,9 +1817,12 @@ def internal_server_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
-    if model is None or preprocessing_components is None:
-        logger.error("Model or preprocessing components not loaded. Exiting...")
+    try:
+        model_store.load()
+    except Exception as e:
+        logger.error(f"Model or preprocessing components not loaded: {e}. Exiting...")
         exit(1)
+    get_job_manager()
     port = int(os.getenv('PORT', 5001))
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
     logger.info(f"Starting LiverLens Prediction API on port {port}")
@@ -0,0 +1,285 @@
+import io
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ('sampling', 'deterministic')
+# Files written per mode, by download name
+PROFILE_FILES = {
+    'sampling': {'calltree': 'calltree.txt', 'folded': 'stacks.folded'},
+    'deterministic': {'calltree': 'calltree.txt', 'pstats': 'profile.pstats'},
+}
+DOWNLOAD_MIMETYPES = {'calltree': 'text/plain', 'folded': 'text/plain', 'pstats': 'application/octet-stream'}
+CALLTREE_MIN_SHARE = 0.01
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval from a helper thread.
+
+    Stacks are counted in collapsed form (root;...;leaf), the input format
+    of flamegraph.pl and speedscope. Overhead does not depend on how many
+    calls the request makes, only on the interval.
+    """
+
+    def __init__(self, thread_id, interval_seconds=0.005):
+        self.thread_id = thread_id
+        self.interval = interval_seconds
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+def folded_stacks(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def sampled_call_tree(stacks, min_share=CALLTREE_MIN_SHARE):
+    """Indented call tree of sampled stacks with inclusive sample shares."""
+    total = sum(stacks.values())
+    if not total:
+        return 'No samples collected (the request finished within one sampling interval)\n'
+    tree = {}
+    for stack, count in stacks.items():
+        node = tree
+        for frame in stack.split(';'):
+            entry = node.setdefault(frame, [0, {}])
+            entry[0] += count
+            node = entry[1]
+
+    lines = [f'{total} samples']
+
+    def walk(node, depth):
+        for frame, (count, children) in sorted(node.items(), key=lambda item: -item[1][0]):
+            if count / total < min_share:
+                continue
+            lines.append(f"{'  ' * depth}{count / total * 100:5.1f}%  {frame}")
+            walk(children, depth + 1)
+
+    walk(tree, 0)
+    return '\n'.join(lines) + '\n'
+
+
+class RequestProfiler:
+    """Opt-in profiling of Flask requests, with the results kept on disk.
+
+    A request is profiled when it carries ``X-Profile: sampling`` or
+    ``X-Profile: deterministic`` together with a valid ``X-Admin-Token``, or
+    when it is picked at ``sample_rate`` (always with the sampling
+    profiler). Each profile is stored as ``<id>.json`` metadata (endpoint,
+    status, duration, request and response size) next to its output files.
+    Only the newest ``max_profiles`` are kept, and at most
+    ``max_concurrent`` requests are profiled at once, only one of them
+    deterministically (cProfile hooks the whole interpreter, and Python
+    3.12+ refuses a second active profiler). A profiler that fails to start
+    is logged and the request is served unprofiled. Streamed response
+    bodies are produced after the request returns and are not covered.
+    """
+
+    def __init__(self, profile_dir, admin_token=None, sample_rate=0.0, max_profiles=100, max_concurrent=2,
+                 sample_interval_ms=5.0, excluded_paths=()):
+        self.profile_dir = profile_dir
+        os.makedirs(profile_dir, exist_ok=True)
+        self.admin_token = admin_token
+        self.sample_rate = float(sample_rate)
+        self.max_profiles = int(max_profiles)
+        self.sample_interval = float(sample_interval_ms) / 1000.0
+        self.excluded_paths = tuple(excluded_paths)
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._deterministic = threading.Lock()
+        self._lock = threading.Lock()
+
+    def install(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    def _requested_mode(self):
+        mode = request.headers.get('X-Profile', '').lower()
+        if mode:
+            token = request.headers.get('X-Admin-Token', '')
+            if mode in PROFILE_MODES and self.admin_token and hmac.compare_digest(token, self.admin_token):
+                return mode, 'header'
+            return None, None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sampling', 'sample'
+        return None, None
+
+    def _start(self):
+        if request.path.startswith(self.excluded_paths):
+            return
+        mode, trigger = self._requested_mode()
+        if mode is None or not self._slots.acquire(blocking=False):
+            return
+        if mode == 'deterministic' and not self._deterministic.acquire(blocking=False):
+            self._slots.release()
+            return
+        try:
+            if mode == 'deterministic':
+                profiler = cProfile.Profile()
+                profiler.enable()
+            else:
+                profiler = StackSampler(threading.get_ident(), self.sample_interval)
+                profiler.start()
+        except Exception as e:
+            logger.warning(f"Could not start {mode} profiler for {request.path}: {str(e)}")
+            self._release(mode)
+            return
+        g.profile = {'mode': mode, 'trigger': trigger, 'profiler': profiler, 'started': time.perf_counter()}
+
+    def _stop(self):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return None
+        try:
+            if profile['mode'] == 'deterministic':
+                profile['profiler'].disable()
+            else:
+                profile['profiler'].stop()
+        finally:
+            self._release(profile['mode'])
+        profile['duration_ms'] = (time.perf_counter() - profile['started']) * 1000
+        return profile
+
+    def _release(self, mode):
+        if mode == 'deterministic':
+            self._deterministic.release()
+        self._slots.release()
+
+    def _finish(self, response):
+        profile = self._stop()
+        if profile is not None:
+            try:
+                profile_id = self._save(profile, response.status_code, response.calculate_content_length())
+                response.headers['X-Profile-Id'] = profile_id
+            except Exception as e:
+                logger.error(f"Failed to store request profile: {str(e)}")
+        return response
+
+    def _teardown(self, error=None):
+        # An unhandled exception skipped after_request; still stop the profiler
+        profile = self._stop()
+        if profile is not None:
+            try:
+                self._save(profile, 500, None)
+            except Exception as e:
+                logger.error(f"Failed to store request profile: {str(e)}")
+
+    def _save(self, profile, status, response_bytes):
+        # Ids sort chronologically, which listing and pruning rely on
+        profile_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:6]}"
+        files = PROFILE_FILES[profile['mode']]
+        if profile['mode'] == 'deterministic':
+            profile['profiler'].dump_stats(self._path(profile_id, files['pstats']))
+            buffer = io.StringIO()
+            stats = pstats.Stats(profile['profiler'], stream=buffer)
+            stats.sort_stats('cumulative').print_stats(60)
+            stats.print_callees(30)
+            calltree = buffer.getvalue()
+            samples = None
+        else:
+            stacks = profile['profiler'].stacks
+            with open(self._path(profile_id, files['folded']), 'w') as f:
+                f.write(folded_stacks(stacks))
+            calltree = sampled_call_tree(stacks)
+            samples = sum(stacks.values())
+        with open(self._path(profile_id, files['calltree']), 'w') as f:
+            f.write(calltree)
+
+        metadata = {
+            'id': profile_id,
+            'mode': profile['mode'],
+            'trigger': profile['trigger'],
+            'endpoint': request.url_rule.rule if request.url_rule is not None else None,
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'duration_ms': profile['duration_ms'],
+            'request_bytes': request.content_length,
+            'response_bytes': response_bytes,
+            'samples': samples,
+            'files': sorted(files),
+            'created_at': datetime.utcnow().isoformat()
+        }
+        with open(self._path(profile_id, 'json'), 'w') as f:
+            json.dump(metadata, f)
+        logger.info(f"Stored {profile['mode']} profile {profile_id} for {request.method} {request.path} "
+                    f"({profile['duration_ms']:.0f} ms)")
+        self._prune()
+        return profile_id
+
+    def _path(self, profile_id, suffix):
+        return os.path.join(self.profile_dir, f'{profile_id}.{suffix}')
+
+    def _ids(self):
+        return sorted((name[:-len('.json')] for name in os.listdir(self.profile_dir) if name.endswith('.json')),
+                      reverse=True)
+
+    def _prune(self):
+        with self._lock:
+            for profile_id in self._ids()[self.max_profiles:]:
+                for name in os.listdir(self.profile_dir):
+                    if name.startswith(profile_id + '.'):
+                        os.remove(os.path.join(self.profile_dir, name))
+
+    def list(self, limit=50):
+        """Metadata of the newest profiles, newest first."""
+        profiles = []
+        for profile_id in self._ids()[:limit]:
+            metadata = self.get(profile_id)
+            if metadata is not None:
+                profiles.append(metadata)
+        return profiles
+
+    def get(self, profile_id):
+        if not self._valid_id(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id, 'json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def file_path(self, profile_id, kind):
+        """Path of one stored output file (calltree, folded or pstats), or None."""
+        metadata = self.get(profile_id)
+        if metadata is None or kind not in metadata['files']:
+            return None
+        return self._path(profile_id, PROFILE_FILES[metadata['mode']][kind])
+
+    @staticmethod
+    def _valid_id(profile_id):
+        stamp, _, suffix = profile_id.partition('-')
+        return len(stamp) == 21 and stamp[:8].isdigit() and len(suffix) == 6 and all(
+            c in '0123456789abcdef' for c in suffix
+        )
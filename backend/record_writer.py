@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import AutoReconnect, BulkWriteError, PyMongoError
+from pymongo.write_concern import WriteConcern
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+# skipped: positions, in the submitted records, of those this write did not insert
+WriteResult = namedtuple('WriteResult', ['persisted', 'failed', 'skipped'], defaults=((),))
+
+
+def parse_write_concern(value):
+    """Build a WriteConcern from an env string such as '1', 'majority' or '1:5000' (w:wtimeout ms)."""
+    if not value:
+        return None
+    w, _, wtimeout = str(value).partition(':')
+    w = int(w) if w.isdigit() else w
+    return WriteConcern(w=w, wtimeout=int(wtimeout)) if wtimeout else WriteConcern(w=w)
+
+
+def is_transient(error):
+    if isinstance(error, AutoReconnect):
+        return True
+    return hasattr(error, 'has_error_label') and error.has_error_label('RetryableWriteError')
+
+
+class RecordWriter:
+    """Writes prediction records on background threads, off the scoring path.
+
+    submit() returns straight away with a Future for a WriteResult, so the
+    caller can score the next chunk while this one is stored. Records are
+    inserted in ``batch_size`` slices with unordered insert_many, so one bad
+    document does not stop the rest of its batch. Transient errors are
+    retried with exponential backoff. Records must carry their own ``_id``:
+    a duplicate key on a retry then means the first attempt already stored
+    that record, and it is counted as persisted. The result's ``skipped``
+    lists the records the write did not insert itself: rejected or failed
+    ones, and ones already stored before it (a duplicate key on the first
+    attempt), so derived statistics can count exactly the new ones. At
+    most ``max_pending`` submissions are buffered; beyond that submit()
+    waits, which keeps memory bounded when Mongo falls behind.
+    """
+
+    def __init__(self, collection, batch_size=500, write_concern=None, max_retries=3,
+                 retry_backoff_seconds=0.1, max_workers=2, max_pending=8):
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+        self.collection = collection
+        self.batch_size = max(1, int(batch_size))
+        self.write_concern = write_concern
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = float(retry_backoff_seconds)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='record-writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.submitted_rows = 0
+        self.persisted_rows = 0
+        self.failed_rows = 0
+        self.batches = 0
+        self.retries = 0
+
+    def submit(self, records):
+        """Queue records for insertion and return a Future resolving to a WriteResult."""
+        records = list(records)
+        self._slots.acquire()
+        with self._lock:
+            self.submitted_rows += len(records)
+        try:
+            future = self._executor.submit(self._write, records)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _write(self, records):
+        persisted = failed = 0
+        skipped = []
+        for start in range(0, len(records), self.batch_size):
+            result = self._write_batch(records[start:start + self.batch_size])
+            persisted += result.persisted
+            failed += result.failed
+            skipped.extend(start + index for index in result.skipped)
+        with self._lock:
+            self.persisted_rows += persisted
+            self.failed_rows += failed
+        return WriteResult(persisted, failed, tuple(skipped))
+
+    def _write_batch(self, batch):
+        # Position in the original batch of each record still being written
+        positions = list(range(len(batch)))
+        skipped = set()
+        failed = 0
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                return WriteResult(len(batch), failed, tuple(sorted(skipped)))
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                rejected = {error['index']: error.get('errmsg') for error in errors
+                            if error.get('code') != DUPLICATE_KEY_ERROR}
+                if rejected:
+                    logger.error(f"{len(rejected)} prediction records rejected: {next(iter(rejected.values()))}")
+                failed += len(rejected)
+                skipped.update(positions[index] for index in rejected)
+                if attempt == 0:
+                    skipped.update(positions[error['index']] for error in errors
+                                   if error.get('code') == DUPLICATE_KEY_ERROR)
+                kept = [index for index in range(len(batch)) if index not in rejected]
+                batch = [batch[index] for index in kept]
+                positions = [positions[index] for index in kept]
+                if not e.details.get('writeConcernErrors') or attempt == self.max_retries:
+                    return WriteResult(len(batch), failed, tuple(sorted(skipped)))
+                logger.warning(f"Write concern not satisfied for {len(batch)} records, retrying")
+            except PyMongoError as e:
+                if not is_transient(e) or attempt == self.max_retries:
+                    logger.error(f"Failed to store {len(batch)} prediction records: {str(e)}")
+                    return WriteResult(0, failed + len(batch), tuple(sorted(skipped.union(positions))))
+                logger.warning(f"Transient error storing prediction records, retrying: {str(e)}")
+            with self._lock:
+                self.retries += 1
+            time.sleep(self.retry_backoff * 2 ** attempt)
+        return WriteResult(0, failed + len(batch), tuple(sorted(skipped.union(positions))))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batch_size': self.batch_size,
+                'write_concern': self.write_concern.document if self.write_concern is not None else None,
+                'submitted_rows': self.submitted_rows,
+                'persisted_rows': self.persisted_rows,
+                'failed_rows': self.failed_rows,
+                'pending_rows': self.submitted_rows - self.persisted_rows - self.failed_rows,
+                'retries': self.retries
+            }
@@ -7,6 +7,7 @@ import re
 from datetime import datetime
 from dotenv import load_dotenv
 from bson import ObjectId
+from metrics import MetricsRegistry, MongoCommandMetrics, instrument_app
 
 
 load_dotenv()
@@ -15,9 +16,13 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'default-secret-key')
 
+# Prometheus metrics, served on /metrics
+metrics = MetricsRegistry()
+instrument_app(app, metrics)
+
 
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
-client = MongoClient(MONGO_URI)
+client = MongoClient(MONGO_URI, event_listeners=[MongoCommandMetrics(metrics)])
 db = client["liverlens_db"]
 users_collection = db["users"]
 
@@ -84,6 +89,11 @@ def health_check():
     }), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return metrics.response()
+
+
 @app.route('/')
 def home():
     return jsonify({
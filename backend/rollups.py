@@ -0,0 +1,314 @@
+import os
+import math
+import numbers
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pymongo import ReplaceOne, UpdateOne
+from analytics import ANALYSIS_FEATURES
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_ID = 'global'
+USER_PREFIX = 'user:'
+UNKNOWN = 'Unknown'
+
+
+def _label(value):
+    return UNKNOWN if value is None else str(value)
+
+
+def _number(value):
+    """The value if $avg would average it (a finite int or float), else None."""
+    if isinstance(value, numbers.Real) and not isinstance(value, bool) and math.isfinite(value):
+        return float(value)
+    return None
+
+
+def _user_id(user_id):
+    return USER_PREFIX + str(user_id)
+
+
+def _latest(record):
+    return {'timestamp': record['timestamp'], 'prediction_id': record['_id']}
+
+
+class RollupStore:
+    """Prediction counts kept current as predictions are stored and deleted.
+
+    The global document holds the total, counts per predicted status and
+    risk level, and the sum and count of each analysis feature (for its
+    average). Each user's document holds their total, status and risk
+    counts and a pointer to their latest prediction. record() and remove()
+    apply the changes with atomic $inc updates, so concurrent API processes
+    never lose a count; the latest pointer only moves forward, with a $set
+    conditional on the stored (timestamp, prediction_id) being older.
+    rebuild() recomputes every document from the predictions collection and
+    check() reports what it would change. On a database from before the
+    rollups, rebuild_if_missing() builds them in the background and
+    summary() and user() compute their answers from the predictions until
+    it has finished.
+    """
+
+    def __init__(self, collection, features=ANALYSIS_FEATURES):
+        self.collection = collection
+        self.features = list(features)
+        self._rebuild_lock = threading.Lock()
+        self.failed_updates = 0
+        self.last_rebuild = None
+        # The predictions collection to compute from while the documents are first built
+        self._fallback = None
+
+    def record(self, records):
+        """Count newly stored prediction records (with their _id and timestamp)."""
+        self._apply(records, 1)
+
+    def remove(self, records, predictions=None):
+        """Take deleted prediction records back out of the counts.
+
+        predictions is the collection they were deleted from; a user whose
+        latest prediction was among them gets the next newest one from it.
+        """
+        self._apply(records, -1)
+        if predictions is not None:
+            self._repair_latest(records, predictions)
+
+    def _apply(self, records, sign):
+        records = list(records)
+        if not records:
+            return
+        increments = defaultdict(lambda: defaultdict(float))
+        latest = {}
+        for record in records:
+            status, risk = _label(record.get('prediction')), _label(record.get('risk_level'))
+            for document_id in (GLOBAL_ID, _user_id(record.get('user_id'))):
+                increments[document_id]['total'] += sign
+                increments[document_id][f'status.{status}'] += sign
+                increments[document_id][f'risk.{risk}'] += sign
+            inputs = record.get('input_data') or {}
+            for feature in self.features:
+                value = _number(inputs.get(feature))
+                if value is not None:
+                    increments[GLOBAL_ID][f'sums.{feature}'] += sign * value
+                    increments[GLOBAL_ID][f'counts.{feature}'] += sign
+            if sign > 0 and isinstance(record.get('timestamp'), datetime) and '_id' in record:
+                user_document = _user_id(record.get('user_id'))
+                latest[user_document] = max(latest.get(user_document, _latest(record)), _latest(record),
+                                            key=lambda pointer: (pointer['timestamp'], str(pointer['prediction_id'])))
+
+        operations = []
+        for document_id, fields in increments.items():
+            update = {'$inc': {field: int(value) if not field.startswith('sums.') else value
+                               for field, value in fields.items()}}
+            if document_id != GLOBAL_ID:
+                update['$set'] = {'user_id': document_id[len(USER_PREFIX):]}
+            operations.append(UpdateOne({'_id': document_id}, update, upsert=True))
+        for document_id, pointer in latest.items():
+            older = {'$or': [
+                {'latest': {'$exists': False}},
+                {'latest.timestamp': {'$lt': pointer['timestamp']}},
+                {'latest.timestamp': pointer['timestamp'], 'latest.prediction_id': {'$lt': pointer['prediction_id']}}
+            ]}
+            operations.append(UpdateOne({'_id': document_id, **older}, {'$set': {'latest': pointer}}))
+        try:
+            # Ordered, so each user document exists before its latest pointer is compared
+            self.collection.bulk_write(operations, ordered=True)
+        except Exception:
+            self.failed_updates += 1
+            raise
+
+    def _repair_latest(self, records, predictions):
+        deleted = defaultdict(set)
+        for record in records:
+            deleted[record.get('user_id')].add(record.get('_id'))
+        for user_id, prediction_ids in deleted.items():
+            document = self.collection.find_one({'_id': _user_id(user_id)}, {'latest': 1})
+            pointer = (document or {}).get('latest')
+            if pointer is None or pointer.get('prediction_id') not in prediction_ids:
+                continue
+            newest = predictions.find_one({'user_id': user_id}, {'timestamp': 1}, sort=[('timestamp', -1)])
+            # Only if it still points at the deleted one; a prediction stored meanwhile has moved it on
+            condition = {'_id': _user_id(user_id), 'latest.prediction_id': pointer['prediction_id']}
+            if newest is not None and isinstance(newest.get('timestamp'), datetime):
+                self.collection.update_one(condition, {'$set': {'latest': _latest(newest)}})
+            else:
+                self.collection.update_one(condition, {'$unset': {'latest': ''}})
+
+    def missing(self, predictions):
+        """True if there are predictions but no global document."""
+        if self.collection.find_one({'_id': GLOBAL_ID}, {'_id': 1}) is not None:
+            return False
+        return predictions.find_one({}, {'_id': 1}) is not None
+
+    def rebuild_if_missing(self, predictions):
+        """Rebuild in a background thread if missing(); returns the thread, or None.
+
+        Until the rebuild succeeds, summary() and user() are computed from
+        predictions rather than read from counters that are still empty.
+        """
+        if not self.missing(predictions):
+            return None
+        self._fallback = predictions
+
+        def rebuild():
+            try:
+                self.rebuild(predictions)
+                self._fallback = None
+            except Exception as e:
+                logger.error(f"Prediction rollups rebuild failed: {str(e)}")
+
+        logger.info('No prediction rollups for the stored predictions yet; rebuilding them')
+        thread = threading.Thread(target=rebuild, name='rollups-rebuild', daemon=True)
+        thread.start()
+        return thread
+
+    def summary(self):
+        """The global document: total, status and risk counts and feature averages."""
+        fallback = self._fallback
+        if fallback is not None:
+            document = self.compute(fallback)[GLOBAL_ID]
+        else:
+            document = self.collection.find_one({'_id': GLOBAL_ID}) or {}
+        sums, counts = document.get('sums', {}), document.get('counts', {})
+        return {
+            'total': int(document.get('total', 0)),
+            'status': {status: int(count) for status, count in document.get('status', {}).items() if count > 0},
+            'risk': {risk: int(count) for risk, count in document.get('risk', {}).items() if count > 0},
+            'averages': {feature: sums.get(feature, 0.0) / counts[feature] if counts.get(feature, 0) > 0 else None
+                         for feature in self.features}
+        }
+
+    def user(self, user_id):
+        """One user's total, status and risk counts and the _id of their latest prediction (or None)."""
+        fallback = self._fallback
+        if fallback is not None:
+            document = self.compute(fallback, user_id).get(_user_id(user_id)) or {}
+        else:
+            document = self.collection.find_one({'_id': _user_id(user_id)}) or {}
+        return {
+            'total': int(document.get('total', 0)),
+            'status': {status: int(count) for status, count in document.get('status', {}).items() if count > 0},
+            'risk': {risk: int(count) for risk, count in document.get('risk', {}).items() if count > 0},
+            'latest_prediction_id': (document.get('latest') or {}).get('prediction_id')
+        }
+
+    def compute(self, predictions, user_id=None):
+        """Every rollup document (or the global and one user's), recomputed from predictions inside MongoDB."""
+        match = [{'$match': {'user_id': user_id}}] if user_id is not None else []
+        group = {
+            '_id': {'user_id': '$user_id', 'status': '$prediction', 'risk': '$risk_level'},
+            'count': {'$sum': 1}
+        }
+        for i, feature in enumerate(self.features):
+            value = f'$input_data.{feature}'
+            numeric = {'$and': [
+                {'$isNumber': value}, {'$gt': [value, float('-inf')]}, {'$lt': [value, float('inf')]}
+            ]}
+            group[f'sum{i}'] = {'$sum': {'$cond': [numeric, value, 0]}}
+            group[f'count{i}'] = {'$sum': {'$cond': [numeric, 1, 0]}}
+
+        documents = {GLOBAL_ID: {'_id': GLOBAL_ID, 'total': 0, 'status': {}, 'risk': {},
+                                 'sums': dict.fromkeys(self.features, 0.0), 'counts': dict.fromkeys(self.features, 0)}}
+        for row in predictions.aggregate(match + [{'$group': group}], allowDiskUse=True):
+            status, risk = _label(row['_id'].get('status')), _label(row['_id'].get('risk'))
+            user_document = _user_id(row['_id'].get('user_id'))
+            documents.setdefault(user_document, {'_id': user_document, 'user_id': user_document[len(USER_PREFIX):],
+                                                 'total': 0, 'status': {}, 'risk': {}})
+            for document_id in (GLOBAL_ID, user_document):
+                document = documents[document_id]
+                document['total'] += row['count']
+                document['status'][status] = document['status'].get(status, 0) + row['count']
+                document['risk'][risk] = document['risk'].get(risk, 0) + row['count']
+            for i, feature in enumerate(self.features):
+                documents[GLOBAL_ID]['sums'][feature] += float(row[f'sum{i}'])
+                documents[GLOBAL_ID]['counts'][feature] += int(row[f'count{i}'])
+
+        latest = predictions.aggregate(match + [
+            {'$match': {'timestamp': {'$type': 'date'}}},
+            {'$sort': {'user_id': 1, 'timestamp': -1, '_id': -1}},
+            {'$group': {'_id': '$user_id', 'timestamp': {'$first': '$timestamp'}, 'prediction_id': {'$first': '$_id'}}}
+        ], allowDiskUse=True)
+        for row in latest:
+            user_document = _user_id(row['_id'])
+            if user_document in documents:
+                documents[user_document]['latest'] = {'timestamp': row['timestamp'],
+                                                      'prediction_id': row['prediction_id']}
+        return documents
+
+    def check(self, predictions):
+        """Ids of the stored documents that differ from a recomputation (missing and stale ones included)."""
+        expected = self.compute(predictions)
+        stored = {document['_id']: document for document in self.collection.find({}, {'updated_at': 0})}
+        drifted = []
+        for document_id in sorted(set(expected) | set(stored)):
+            if not self._same(expected.get(document_id), stored.get(document_id)):
+                drifted.append(document_id)
+        return drifted
+
+    @staticmethod
+    def _same(expected, stored):
+        def counts(document, field):
+            return {key: value for key, value in (document or {}).get(field, {}).items() if value}
+
+        if expected is None or stored is None:
+            return not (expected or stored or {}).get('total')
+        if expected.get('total') != stored.get('total') or expected.get('latest') != stored.get('latest'):
+            return False
+        if any(counts(expected, field) != counts(stored, field) for field in ('status', 'risk', 'counts')):
+            return False
+        return all(math.isclose(value, stored.get('sums', {}).get(feature, 0.0), rel_tol=1e-9, abs_tol=1e-6)
+                   for feature, value in expected.get('sums', {}).items())
+
+    def rebuild(self, predictions):
+        """Replace every document with a recomputation; returns the number of documents written.
+
+        Predictions stored or deleted while the rebuild runs may be counted
+        wrongly; run it when writes are quiet.
+        """
+        with self._rebuild_lock:
+            now = datetime.utcnow()
+            documents = self.compute(predictions)
+            operations = [ReplaceOne({'_id': document_id}, {**document, 'updated_at': now}, upsert=True)
+                          for document_id, document in documents.items()]
+            self.collection.bulk_write(operations, ordered=False)
+            self.collection.delete_many({'_id': {'$nin': list(documents)}})
+            self.last_rebuild = {'finished_at': now.isoformat(), 'predictions': documents[GLOBAL_ID]['total'],
+                                 'documents': len(documents)}
+            logger.info(f"Rebuilt prediction rollups from {documents[GLOBAL_ID]['total']} predictions "
+                        f"({len(documents)} documents)")
+            return len(documents)
+
+    def stats(self):
+        return {
+            'failed_updates': self.failed_updates,
+            'rebuilding': self._rebuild_lock.locked(),
+            'last_rebuild': self.last_rebuild
+        }
+
+
+def main():
+    from pymongo import MongoClient
+    parser = argparse.ArgumentParser(description='Check or rebuild the prediction rollups from the predictions '
+                                                 'collection')
+    parser.add_argument('command', choices=('check', 'rebuild'))
+    parser.add_argument('--mongo-uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='liverlens_db')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri)[args.database]
+    store = RollupStore(db['prediction_rollups'])
+    if args.command == 'check':
+        drifted = store.check(db['predictions'])
+        if drifted:
+            raise SystemExit(f"{len(drifted)} rollup documents differ from the predictions "
+                             f"(e.g. {', '.join(drifted[:5])}); run 'python rollups.py rebuild'")
+        print('Prediction rollups match the predictions collection')
+    else:
+        count = store.rebuild(db['predictions'])
+        print(f"Rebuilt {count} prediction rollup documents")
+
+
+if __name__ == '__main__':
+    main()
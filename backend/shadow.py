@@ -0,0 +1,154 @@
+import time
+import math
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+LOG_LOSS_EPSILON = 1e-15
+
+
+def log_loss(probabilities, label):
+    return -math.log(min(max(probabilities.get(label, 0.0), LOG_LOSS_EPSILON), 1.0))
+
+
+def compare_predictions(champion, challenger, label=None):
+    """Disagreement stats between two {class: probability} dicts for one row."""
+    labels = set(champion) | set(challenger)
+    comparison = {
+        'prediction': max(challenger, key=challenger.get),
+        'probabilities': challenger,
+        'agrees': max(champion, key=champion.get) == max(challenger, key=challenger.get),
+        'max_abs_diff': max(abs(champion.get(c, 0.0) - challenger.get(c, 0.0)) for c in labels)
+    }
+    if label in labels:
+        comparison['label'] = label
+        comparison['champion_log_loss'] = log_loss(champion, label)
+        comparison['challenger_log_loss'] = log_loss(challenger, label)
+    return comparison
+
+
+class ShadowScorer:
+    """Scores a challenger model next to the champion, off the request path.
+
+    Work goes to a small thread pool; when ``max_pending`` jobs are already
+    queued new ones are dropped (and counted) rather than delaying requests.
+    Results are written into the prediction record under ``shadow``.
+    """
+
+    def __init__(self, store, collection, max_workers=1, max_pending=64, label_field='Status'):
+        self.store = store
+        self.collection = collection
+        self.label_field = label_field
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shadow')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        self._slots.release()
+        with self._lock:
+            if future.exception() is not None:
+                self.failed += 1
+                logger.error(f"Shadow scoring failed: {future.exception()}")
+            else:
+                self.completed += 1
+
+    def submit(self, record_id, data, champion_probabilities, champion_latency_ms):
+        """Queue one stored /predict record for challenger scoring."""
+        return self._submit(self._score_one, record_id, dict(data), champion_probabilities, champion_latency_ms)
+
+    def submit_batch(self, record_ids, df, champion_probabilities, champion_latency_ms):
+        """Queue a /predict/bulk upload; latency is the champion's per-row average."""
+        return self._submit(self._score_batch, list(record_ids), df.copy(), champion_probabilities,
+                            champion_latency_ms)
+
+    def _score_one(self, record_id, data, champion_probabilities, champion_latency_ms):
+        loaded = self.store.get()
+        feature_plan = loaded.feature_plan
+        started = time.perf_counter()
+        row = feature_plan.transform(data, out=np.zeros((1, feature_plan.n_features), dtype=np.float32))
+        probabilities = loaded.scorer.predict_proba(row)[0]
+        latency_ms = (time.perf_counter() - started) * 1000
+        challenger = {label: float(p) for label, p in zip(feature_plan.class_labels, probabilities)}
+        shadow = self._shadow_record(loaded, champion_probabilities, challenger, data.get(self.label_field),
+                                     latency_ms, champion_latency_ms)
+        self.collection.update_one({'_id': record_id}, {'$set': {'shadow': shadow}})
+
+    def _score_batch(self, record_ids, df, champion_probabilities, champion_latency_ms):
+        loaded = self.store.get()
+        feature_plan = loaded.feature_plan
+        started = time.perf_counter()
+        probabilities = loaded.scorer.predict_proba(feature_plan.transform_frame(df))
+        latency_ms = (time.perf_counter() - started) * 1000 / max(len(df), 1)
+        labels = df[self.label_field].tolist() if self.label_field in df.columns else [None] * len(df)
+        updates = []
+        for record_id, row, champion, label in zip(record_ids, probabilities, champion_probabilities, labels):
+            challenger = {c: float(p) for c, p in zip(feature_plan.class_labels, row)}
+            shadow = self._shadow_record(loaded, champion, challenger, label, latency_ms, champion_latency_ms)
+            updates.append(UpdateOne({'_id': record_id}, {'$set': {'shadow': shadow}}))
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+
+    def _shadow_record(self, loaded, champion, challenger, label, latency_ms, champion_latency_ms):
+        if label is not None and (isinstance(label, float) and pd.isna(label)):
+            label = None
+        shadow = compare_predictions(champion, challenger, str(label) if label is not None else None)
+        shadow.update({
+            'model_version': loaded.version,
+            'latency_ms': latency_ms,
+            'champion_latency_ms': champion_latency_ms,
+            'scored_at': datetime.utcnow()
+        })
+        return shadow
+
+    def stats(self):
+        with self._lock:
+            return {
+                'challenger': self.store.get().describe() if self.store.loaded else None,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'dropped': self.dropped,
+                'failed': self.failed
+            }
+
+
+def comparison_pipeline(challenger_version=None):
+    match = {'shadow': {'$exists': True}}
+    if challenger_version:
+        match['shadow.model_version'] = challenger_version
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': {'champion': '$model_version', 'challenger': '$shadow.model_version'},
+            'count': {'$sum': 1},
+            'agreement_rate': {'$avg': {'$cond': ['$shadow.agrees', 1, 0]}},
+            'mean_max_abs_diff': {'$avg': '$shadow.max_abs_diff'},
+            'max_abs_diff': {'$max': '$shadow.max_abs_diff'},
+            'champion_latency_ms': {'$avg': '$shadow.champion_latency_ms'},
+            'challenger_latency_ms': {'$avg': '$shadow.latency_ms'},
+            'labeled_count': {'$sum': {'$cond': [{'$ifNull': ['$shadow.label', False]}, 1, 0]}},
+            'champion_log_loss': {'$avg': '$shadow.champion_log_loss'},
+            'challenger_log_loss': {'$avg': '$shadow.challenger_log_loss'}
+        }},
+        {'$sort': {'count': -1}}
+    ]
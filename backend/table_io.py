@@ -0,0 +1,169 @@
+import io
+import pandas as pd
+from inference import NUMERICAL_FEATURES, CATEGORICAL_FEATURES
+
+# Upload formats by file suffix; compressed CSV is decompressed by pandas
+# (zstd needs the zstandard package, Parquet and Arrow need pyarrow)
+INPUT_FORMATS = {
+    '.csv': 'csv',
+    '.csv.gz': 'csv.gz',
+    '.csv.zst': 'csv.zst',
+    '.csv.zstd': 'csv.zst',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+CSV_COMPRESSION = {'csv': None, 'csv.gz': 'gzip', 'csv.zst': 'zstd'}
+
+OUTPUT_FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+}
+
+TEXT_COLUMNS = CATEGORICAL_FEATURES + [
+    'Patient_Name', 'Patient_ID', 'predicted_status', 'status_description', 'risk_level'
+]
+ARROW_FILE_MAGIC = b'ARROW1'
+
+
+class UnsupportedFormatError(Exception):
+    """Raised when a file format is unknown or its optional dependency is missing."""
+    pass
+
+
+def detect_format(filename):
+    """Return the input format for an upload's file name, or None if unsupported."""
+    name = (filename or '').lower()
+    for suffix in sorted(INPUT_FORMATS, key=len, reverse=True):
+        if name.endswith(suffix):
+            return INPUT_FORMATS[suffix]
+    return None
+
+
+def _pyarrow(feature):
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise UnsupportedFormatError(f"{feature} support requires the pyarrow package")
+    return pyarrow
+
+
+def check_output_format(output_format):
+    """Raise UnsupportedFormatError if the package needed to write output_format is missing."""
+    _pyarrow(output_format.capitalize())
+
+
+def _read_csv(source, input_format, **kwargs):
+    try:
+        return pd.read_csv(source, compression=CSV_COMPRESSION[input_format], **kwargs)
+    except ImportError as e:
+        raise UnsupportedFormatError(f"Reading {input_format} files requires an extra package: {e}")
+
+
+def _open_arrow(source):
+    """A reader for an Arrow IPC file or stream; only the schema (and a file's footer) is read up front."""
+    pa = _pyarrow('Arrow')
+    if isinstance(source, str):
+        source = pa.memory_map(source)
+    position = source.tell()
+    is_file = source.read(len(ARROW_FILE_MAGIC)) == ARROW_FILE_MAGIC
+    source.seek(position)
+    return pa.ipc.open_file(source) if is_file else pa.ipc.open_stream(source)
+
+
+def _arrow_batches(reader):
+    if hasattr(reader, 'get_batch'):
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+    else:
+        yield from reader
+
+
+def read_columns(source, input_format):
+    """Column names of an upload without reading its rows; rewinds file objects."""
+    position = None if isinstance(source, str) else source.tell()
+    try:
+        if input_format in CSV_COMPRESSION:
+            return list(_read_csv(source, input_format, nrows=0).columns)
+        if input_format == 'parquet':
+            return _pyarrow('Parquet').parquet.read_schema(source).names
+        return _open_arrow(source).schema.names
+    finally:
+        if position is not None:
+            source.seek(position)
+
+
+def read_table(source, input_format):
+    if input_format in CSV_COMPRESSION:
+        return _read_csv(source, input_format)
+    if input_format == 'parquet':
+        return _pyarrow('Parquet').parquet.read_table(source).to_pandas()
+    return _open_arrow(source).read_all().to_pandas()
+
+
+def iter_table_chunks(source, input_format, chunk_size, skip_rows=0):
+    """Yield DataFrames of up to chunk_size rows, starting after skip_rows data rows."""
+    if input_format in CSV_COMPRESSION:
+        reader = _read_csv(source, input_format, chunksize=chunk_size,
+                           skiprows=range(1, skip_rows + 1) if skip_rows else None)
+        with reader:
+            yield from reader
+        return
+
+    if input_format == 'parquet':
+        batches = _pyarrow('Parquet').parquet.ParquetFile(source).iter_batches(batch_size=chunk_size)
+        for batch in batches:
+            if skip_rows >= batch.num_rows:
+                skip_rows -= batch.num_rows
+                continue
+            yield batch.slice(skip_rows).to_pandas()
+            skip_rows = 0
+        return
+
+    # One record batch is read at a time; batches are regrouped into chunk_size rows
+    pa = _pyarrow('Arrow')
+    pending, pending_rows = [], 0
+    for batch in _arrow_batches(_open_arrow(source)):
+        if skip_rows >= batch.num_rows:
+            skip_rows -= batch.num_rows
+            continue
+        pending.append(batch.slice(skip_rows))
+        pending_rows += batch.num_rows - skip_rows
+        skip_rows = 0
+        while pending_rows >= chunk_size:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunk_size).to_pandas()
+            rest = table.slice(chunk_size)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+    if pending_rows:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+
+def conform_frame(df, feature_plan):
+    """Cast result columns to the model's schema: numeric features and probabilities to float64, codes to strings."""
+    df = df.copy()
+    numeric = {feature for feature, _, _ in feature_plan.numerical} | set(NUMERICAL_FEATURES)
+    for column in df.columns:
+        if column in numeric or column.startswith('probability_'):
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+        elif column in TEXT_COLUMNS:
+            values = df[column]
+            df[column] = values.astype(object).where(values.isna(), values.astype(str)).astype('string')
+    return df
+
+
+def write_table(rows, output_format, feature_plan, columns=None):
+    """Serialize result rows as Parquet or an Arrow IPC file and return the bytes."""
+    pa = _pyarrow(output_format.capitalize())
+    df = conform_frame(pd.DataFrame(rows, columns=columns), feature_plan)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    buffer = io.BytesIO()
+    if output_format == 'parquet':
+        pa.parquet.write_table(table, buffer, compression='zstd')
+    else:
+        with pa.ipc.new_file(buffer, table.schema) as writer:
+            writer.write_table(table)
+    return buffer.getvalue()
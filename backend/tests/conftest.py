@@ -0,0 +1,21 @@
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(BACKEND_DIR, '..', 'data')
+sys.path.insert(0, BACKEND_DIR)
+
+
+def _drop_sort(add):
+    def wrapper(*args, sort=None, **kwargs):
+        return add(*args, **kwargs)
+    return wrapper
+
+
+# pymongo 4.11+ passes sort= to the bulk builder for UpdateOne/ReplaceOne, which mongomock 4.3 does not accept
+try:
+    from mongomock.collection import BulkOperationBuilder
+    BulkOperationBuilder.add_update = _drop_sort(BulkOperationBuilder.add_update)
+    BulkOperationBuilder.add_replace = _drop_sort(BulkOperationBuilder.add_replace)
+except ImportError:
+    pass
@@ -0,0 +1,82 @@
+import sqlite3
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+from bulk_jobs import FINAL_STATUSES, JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path))
+
+
+def set_job(store, job_id, **columns):
+    assignments = ', '.join(f'{column} = ?' for column in columns)
+    with sqlite3.connect(store.path) as conn:
+        conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*columns.values(), job_id))
+
+
+def ago(**delta):
+    return (datetime.utcnow() - timedelta(**delta)).isoformat()
+
+
+def test_claim_takes_a_job_only_once(store):
+    store.create('job', 'u1', 'a.csv')
+    assert store.claim('job', 'worker-a', stale_seconds=60)
+    assert store.get('job')['status'] == 'running' and store.get('job')['owner'] == 'worker-a'
+    assert not store.claim('job', 'worker-b', stale_seconds=60)
+    # The owner can claim again, e.g. when it restarts the job itself
+    assert store.claim('job', 'worker-a', stale_seconds=60)
+
+
+def test_claim_takes_over_a_stale_job(store):
+    store.create('job', 'u1', 'a.csv')
+    store.claim('job', 'worker-a', stale_seconds=60)
+    set_job(store, 'job', updated_at=ago(minutes=5))
+    assert store.claim('job', 'worker-b', stale_seconds=60)
+    assert store.get('job')['owner'] == 'worker-b'
+
+
+def test_claim_skips_cancelled_and_finished_jobs(store):
+    for job_id in ('cancelled', 'running', 'done'):
+        store.create(job_id, 'u1', 'a.csv')
+    store.request_cancel('cancelled')
+    store.claim('running', 'worker-a', stale_seconds=60)
+    store.request_cancel('running')
+    store.claim('done', 'worker-a', stale_seconds=60)
+    store.finish('done', 'completed')
+    assert store.get('cancelled')['status'] == 'cancelled'
+    assert not any(store.claim(job_id, 'worker-b', stale_seconds=0) for job_id in ('cancelled', 'running', 'done'))
+
+
+def test_resumable_lists_unowned_and_stale_jobs_oldest_first(store):
+    for job_id in ('owned', 'stale', 'queued', 'finished'):
+        store.create(job_id, 'u1', 'a.csv')
+    for job_id in ('owned', 'stale', 'finished'):
+        store.claim(job_id, 'worker-a', stale_seconds=60)
+    store.finish('finished', 'failed', error='boom')
+    set_job(store, 'stale', updated_at=ago(minutes=5), created_at=ago(hours=1))
+    assert store.resumable(stale_seconds=60) == ['stale', 'queued']
+    assert store.resumable(stale_seconds=3600) == ['queued']
+
+
+def test_purge_drops_old_finished_jobs_with_their_rows(store):
+    for status in FINAL_STATUSES + ('running',):
+        for age in ('old', 'new'):
+            job_id = f'{status}-{age}'
+            store.create(job_id, 'u1', 'a.csv')
+            store.add_results(job_id, [1, 2], [{'predicted_status': 'C'}] * 2, processed_rows=2, model_version='v1')
+            store.add_errors(job_id, pd.DataFrame({'row': [3], 'field': ['Age'], 'message': ['Age must be a valid number']}))
+            if status != 'running':
+                store.finish(job_id, status)
+            if age == 'old':
+                set_job(store, job_id, finished_at=ago(days=10))
+
+    assert store.purge(older_than_days=7) == len(FINAL_STATUSES)
+    for status in FINAL_STATUSES:
+        assert store.get(f'{status}-old') is None
+        assert store.results(f'{status}-old') == [] and store.errors(f'{status}-old') == []
+        assert store.get(f'{status}-new') is not None and len(store.results(f'{status}-new')) == 2
+    # An active job is never purged, however old its timestamps
+    assert store.get('running-old') is not None and store.invalid_rows('running-old') == 1
+    assert store.purge(older_than_days=7) == 0
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+import mongomock
+import numpy as np
+import pandas as pd
+import pytest
+from correlation import CorrelationStore, PairwiseMoments, numeric_matrix
+
+FEATURES = ['Age', 'Bilirubin', 'Albumin', 'Copper']
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(400, len(FEATURES))) * [10, 2, 0.5, 80] + [50, 1, 3.5, 90]
+    values[:, 1] += values[:, 0] * 0.05
+    # Different rows missing per column, so every pair covers its own rows
+    values[rng.random(values.shape) < 0.2] = np.nan
+    return pd.DataFrame(values, columns=FEATURES)
+
+
+def assert_matches_pandas(moments, frame):
+    assert np.allclose(moments.correlation(), frame.corr().to_numpy(), atol=1e-10, equal_nan=True)
+
+
+def test_from_values_matches_pairwise_corr(frame):
+    assert_matches_pandas(PairwiseMoments.from_values(frame.to_numpy()), frame)
+
+
+def test_merge_matches_corr_of_all_rows(frame):
+    moments = PairwiseMoments(len(FEATURES))
+    for start in range(0, len(frame), 70):
+        moments.merge(PairwiseMoments.from_values(frame.iloc[start:start + 70].to_numpy()))
+    assert_matches_pandas(moments, frame)
+
+
+def test_removing_rows_matches_corr_of_the_rest(frame):
+    moments = PairwiseMoments.from_values(frame.to_numpy())
+    moments.merge(PairwiseMoments.from_values(frame.iloc[:150].to_numpy()), sign=-1)
+    assert_matches_pandas(moments, frame.iloc[150:])
+    present = frame.iloc[150:].notna().to_numpy(dtype=float)
+    assert np.allclose(moments.n, present.T @ present)
+
+
+def test_removing_everything_leaves_empty_moments(frame):
+    moments = PairwiseMoments.from_values(frame.to_numpy())
+    moments.merge(PairwiseMoments.from_values(frame.to_numpy()), sign=-1)
+    assert not moments.n.any() and not moments.m2.any() and not moments.comoment.any()
+    assert np.isnan(moments.correlation()).all()
+
+
+def test_numeric_matrix_drops_text_and_infinite_values():
+    values = numeric_matrix([{'Age': '51.5', 'Bilirubin': 'n/a'}, {'Age': float('inf'), 'Copper': 3}, None],
+                            FEATURES)
+    assert values[0, 0] == 51.5 and np.isnan(values[0, 1])
+    assert np.isnan(values[1, 0]) and values[1, 3] == 3
+    assert np.isnan(values[2]).all()
+
+
+def records(frame, start=datetime(2025, 1, 1)):
+    inputs = [{feature: value for feature, value in row.items() if value == value}
+              for row in frame.to_dict('records')]
+    return inputs, [start + timedelta(hours=6 * i) for i in range(len(frame))]
+
+
+def test_store_records_removes_and_reads_day_windows(frame):
+    store = CorrelationStore(mongomock.MongoClient().db.correlation_stats, FEATURES, flush_interval=0)
+    inputs, timestamps = records(frame)
+    store.record(inputs, timestamps)
+    store.remove(inputs[:40], timestamps[:40])
+    assert_matches_pandas(store.read(), frame.iloc[40:])
+    # 6-hourly rows: days 2025-01-11 to 2025-01-20 are rows 40 to 79
+    assert_matches_pandas(store.read('2025-01-11', '2025-01-20'), frame.iloc[40:80])
+
+
+def test_rebuild_if_missing_builds_an_existing_database_once(frame):
+    db = mongomock.MongoClient().db
+    store = CorrelationStore(db.correlation_stats, FEATURES, flush_interval=0)
+    assert store.rebuild_if_missing(db.predictions) is None
+
+    inputs, timestamps = records(frame)
+    db.predictions.insert_many([{'input_data': data, 'timestamp': timestamp}
+                                for data, timestamp in zip(inputs, timestamps)])
+    assert store.missing(db.predictions)
+    store.rebuild_if_missing(db.predictions).join()
+    assert_matches_pandas(store.read(), frame)
+    assert not store.missing(db.predictions)
+    assert store.rebuild_if_missing(db.predictions) is None
+
+    # Built for other features counts as missing
+    assert CorrelationStore(db.correlation_stats, FEATURES[:2], flush_interval=0).missing(db.predictions)
@@ -0,0 +1,135 @@
+import os
+import random
+from datetime import datetime, timedelta
+import mongomock
+import numpy as np
+import pandas as pd
+import pymongo
+import pytest
+from bson import ObjectId
+from conftest import DATA_DIR
+
+
+class MockClient(mongomock.MongoClient):
+    def __init__(self, *args, event_listeners=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def prediction(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(pymongo, 'MongoClient', MockClient)
+        patch.setenv('BULK_JOB_DIR', str(tmp_path_factory.mktemp('bulk_jobs')))
+        patch.setenv('PROFILE_DIR', str(tmp_path_factory.mktemp('profiles')))
+        patch.setenv('CORRELATION_FLUSH_SECONDS', '0')
+        patch.setenv('PREDICTION_CACHE_SIZE', '0')
+        import prediction
+        yield prediction
+
+
+@pytest.fixture
+def client(prediction):
+    prediction.predictions_collection.delete_many({})
+    prediction.rollup_store.rebuild(prediction.predictions_collection)
+    client = prediction.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'u1'
+        session['role'] = 'Doctor'
+    return client
+
+
+def store_records(prediction, count):
+    statuses = ['C', 'CL', 'D']
+    records = [{
+        '_id': ObjectId(),
+        'user_id': 'u1',
+        'timestamp': datetime(2025, 1, 1) + timedelta(hours=i),
+        'prediction': statuses[i % 3],
+        'risk_level': prediction.get_risk_level(statuses[i % 3]),
+        'input_data': {'Age': 40.0 + i, 'Bilirubin': 1.0 + i}
+    } for i in range(count)]
+    prediction.predictions_collection.insert_many(records)
+    prediction.predictions_stored(records)
+    return records
+
+
+def test_bulk_delete_only_takes_out_what_it_deleted(prediction, client, monkeypatch):
+    records = store_records(prediction, 6)
+    collection = prediction.predictions_collection
+    find = collection.find
+
+    # Another request deletes one of the predictions between the lookup and the delete
+    def find_then_delete_elsewhere(*args, **kwargs):
+        monkeypatch.setattr(collection, 'find', find)
+        found = list(find(*args, **kwargs))
+        collection.delete_one({'_id': records[0]['_id']})
+        prediction.predictions_deleted([records[0]])
+        return found
+
+    monkeypatch.setattr(collection, 'find', find_then_delete_elsewhere)
+    response = client.delete('/history/bulk-delete',
+                             json={'prediction_ids': [str(record['_id']) for record in records[:4]]})
+
+    assert response.status_code == 200 and response.get_json()['deleted_count'] == 3
+    assert prediction.rollup_store.user('u1')['total'] == 2
+    assert prediction.rollup_store.check(collection) == []
+
+
+@pytest.fixture(scope='module')
+def api_rows():
+    """test.csv rows as the API receives them, with the awkward inputs the two paths must agree on."""
+    df = pd.read_csv(os.path.join(DATA_DIR, 'test.csv'), nrows=400)
+    df['Age'] = df['Age'] / 365.25
+    df['Patient_Name'] = 'Patient'
+    df['Patient_ID'] = 'P' + df.pop('id').astype(str)
+    rows = df.astype(object).where(df.notna(), None).to_dict('records')
+    rng = random.Random(0)
+    numeric = ['N_Days', 'Bilirubin', 'Cholesterol', 'Albumin', 'Copper', 'Alk_Phos', 'SGOT',
+               'Tryglicerides', 'Platelets', 'Prothrombin']
+    # A blank Sex is rejected in bulk (validate_input_frame), so only the other categoricals go missing
+    categorical = ['Drug', 'Ascites', 'Hepatomegaly', 'Spiders', 'Edema']
+    for row in rows[:300]:
+        for feature in rng.sample(numeric, 3):
+            row[feature] = rng.choice([None, '', 'null', 'n/a', str(row[feature])])
+        for feature in rng.sample(categorical, 2):
+            row[feature] = rng.choice([None, '', 'null'])
+        row['Age'], row['Stage'] = rng.choice([(None, ''), ('null', None), (str(row['Age']), row['Stage'])])
+    # First-letter rule and categories the encoders never saw
+    for row, (feature, value) in zip(rows[300:], [
+            ('Sex', 'male'), ('Sex', 'Female'), ('Ascites', 'yes'), ('Hepatomegaly', 'no'),
+            ('Edema', 'Slight'), ('Edema', 'Q'), ('Drug', 'Experimental'), ('Drug', 'placebo'),
+            ('Drug', 'd-penicillamine'), ('Spiders', 'X')] * 10):
+        row[feature] = value
+    return rows
+
+
+def test_batch_scoring_matches_make_prediction(prediction, api_rows):
+    single = []
+    for row in api_rows:
+        result, error = prediction.make_prediction(dict(row))
+        assert error is None
+        single.append(result)
+
+    df, errors, message = prediction.prepare_batch(pd.DataFrame(api_rows))
+    assert errors.empty and message is None
+    loaded = prediction.model_store.get()
+    expected = np.vstack([loaded.feature_plan.transform(dict(row)).copy() for row in api_rows])
+    np.testing.assert_array_equal(loaded.feature_plan.transform_frame(df), expected)
+
+    results, _ = prediction.score_batch(df)
+    assert [r['predicted_status'] for r in results] == [r['predicted_status'] for r in single]
+    labels = loaded.feature_plan.class_labels
+    batch = np.array([[r['probabilities'][label] for label in labels] for r in results])
+    per_row = np.array([[r['probabilities'][label] for label in labels] for r in single])
+    np.testing.assert_allclose(batch, per_row, rtol=0, atol=1e-6)
+
+
+def test_prepare_batch_fills_defaults_like_make_prediction(prediction, api_rows):
+    rows = [{k: v for k, v in row.items() if k not in prediction.INPUT_DEFAULTS} for row in api_rows[:50]]
+    df, errors, _ = prediction.prepare_batch(pd.DataFrame(rows), row_offset=10)
+    assert errors.empty and list(df.index) == list(range(11, 61))
+    results, _ = prediction.score_batch(df)
+    for row, result in zip(rows, results):
+        single, error = prediction.make_prediction(dict(row))
+        assert error is None and single['predicted_status'] == result['predicted_status']
+        assert single['probabilities'] == pytest.approx(result['probabilities'], abs=1e-6)
@@ -0,0 +1,124 @@
+import threading
+from datetime import datetime, timedelta
+import mongomock
+import pytest
+from bson import ObjectId
+from rollups import GLOBAL_ID, RollupStore
+
+START = datetime(2025, 1, 1)
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def store(db):
+    return RollupStore(db.prediction_rollups, features=['Age', 'Bilirubin'])
+
+
+def make_records(user_id, count, start=START, ages=None):
+    statuses = ['C', 'CL', 'D']
+    return [{
+        '_id': ObjectId(),
+        'user_id': user_id,
+        'timestamp': start + timedelta(hours=i),
+        'prediction': statuses[i % 3],
+        'risk_level': {'C': 'Low', 'CL': 'Medium', 'D': 'High'}[statuses[i % 3]],
+        'input_data': {'Age': (ages or {}).get(i, 40.0 + i), 'Bilirubin': 'n/a' if i == 0 else 1.5}
+    } for i in range(count)]
+
+
+def store_predictions(db, store, records):
+    db.predictions.insert_many(records)
+    store.record(records)
+
+
+def test_record_counts_statuses_risks_and_averages(db, store):
+    store_predictions(db, store, make_records('u1', 4) + make_records('u2', 2))
+    summary = store.summary()
+    assert summary['total'] == 6
+    assert summary['status'] == {'C': 3, 'CL': 2, 'D': 1}
+    assert summary['risk'] == {'Low': 3, 'Medium': 2, 'High': 1}
+    assert summary['averages']['Age'] == pytest.approx((40 + 41 + 42 + 43 + 40 + 41) / 6)
+    # Text values are left out of the average, as $avg leaves them out
+    assert summary['averages']['Bilirubin'] == pytest.approx(1.5)
+    assert store.user('u1')['total'] == 4 and store.user('u2')['status'] == {'C': 1, 'CL': 1}
+    assert store.user('nobody') == {'total': 0, 'status': {}, 'risk': {}, 'latest_prediction_id': None}
+    assert store.check(db.predictions) == []
+
+
+def test_latest_pointer_only_moves_forward(db, store):
+    newer = make_records('u1', 3, start=START + timedelta(days=1))
+    older = make_records('u1', 3)
+    store_predictions(db, store, newer)
+    store_predictions(db, store, older)
+    assert store.user('u1')['latest_prediction_id'] == newer[-1]['_id']
+
+    # Same timestamp: the larger _id wins, as in the rebuild's sort
+    tie = dict(newer[-1], _id=ObjectId())
+    store_predictions(db, store, [tie])
+    assert store.user('u1')['latest_prediction_id'] == max(tie['_id'], newer[-1]['_id'])
+    assert store.check(db.predictions) == []
+
+
+def test_remove_takes_counts_out_and_repairs_latest(db, store):
+    records = make_records('u1', 5)
+    store_predictions(db, store, records)
+
+    db.predictions.delete_many({'_id': {'$in': [records[-1]['_id'], records[0]['_id']]}})
+    store.remove([records[-1], records[0]], db.predictions)
+    user = store.user('u1')
+    assert user['total'] == 3 and user['latest_prediction_id'] == records[-2]['_id']
+    assert store.check(db.predictions) == []
+
+    db.predictions.delete_many({})
+    store.remove(records[1:4], db.predictions)
+    assert store.user('u1') == {'total': 0, 'status': {}, 'risk': {}, 'latest_prediction_id': None}
+    assert store.summary()['total'] == 0 and store.summary()['averages']['Age'] is None
+
+
+def test_repair_leaves_a_pointer_that_moved_on(db, store):
+    records = make_records('u1', 3)
+    store_predictions(db, store, records)
+    newer = make_records('u1', 1, start=START + timedelta(days=2))
+    store_predictions(db, store, newer)
+
+    # A delete of the old latest arriving after a newer prediction does not move the pointer back
+    db.predictions.delete_one({'_id': records[-1]['_id']})
+    store.remove([records[-1]], db.predictions)
+    assert store.user('u1')['latest_prediction_id'] == newer[0]['_id']
+
+
+def test_rebuild_replaces_drifted_documents(db, store):
+    store_predictions(db, store, make_records('u1', 3))
+    db.prediction_rollups.update_one({'_id': GLOBAL_ID}, {'$inc': {'total': 5}})
+    db.prediction_rollups.insert_one({'_id': 'user:ghost', 'total': 2})
+    assert store.check(db.predictions) == [GLOBAL_ID, 'user:ghost']
+    assert store.rebuild(db.predictions) == 2
+    assert store.check(db.predictions) == []
+
+
+def test_existing_database_is_answered_from_predictions_until_rebuilt(db, store, monkeypatch):
+    records = make_records('u1', 4) + make_records('u2', 3)
+    db.predictions.insert_many(records)
+    assert store.missing(db.predictions)
+
+    release = threading.Event()
+    rebuild = store.rebuild
+    monkeypatch.setattr(store, 'rebuild', lambda predictions: release.wait() and rebuild(predictions))
+    thread = store.rebuild_if_missing(db.predictions)
+    assert store.summary()['total'] == 7
+    assert store.user('u2')['total'] == 3
+    assert store.user('u1')['latest_prediction_id'] == records[3]['_id']
+
+    release.set()
+    thread.join()
+    assert not store.missing(db.predictions) and store.rebuild_if_missing(db.predictions) is None
+    assert store.summary()['total'] == 7 and store.check(db.predictions) == []
+
+
+def test_empty_database_needs_no_rebuild(db, store):
+    assert not store.missing(db.predictions)
+    assert store.rebuild_if_missing(db.predictions) is None
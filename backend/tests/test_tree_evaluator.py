@@ -0,0 +1,57 @@
+import os
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost
+from conftest import BACKEND_DIR, DATA_DIR
+from inference import FeaturePlan, build_scorer
+from tree_evaluator import CompiledForest
+
+
+@pytest.fixture(scope='module')
+def model():
+    return joblib.load(os.path.join(BACKEND_DIR, 'final_xgb_model.pkl'))
+
+
+@pytest.fixture(scope='module')
+def features():
+    components = joblib.load(os.path.join(BACKEND_DIR, 'preprocessing_components.pkl'))
+    return FeaturePlan.from_components(components).transform_frame(pd.read_csv(os.path.join(DATA_DIR, 'test.csv')))
+
+
+@pytest.fixture(scope='module')
+def forest(model):
+    return CompiledForest.from_booster(model.get_booster())
+
+
+def test_matches_predict_proba(model, forest, features):
+    assert np.allclose(forest.predict_proba(features), model.predict_proba(features), atol=1e-5)
+
+
+def test_missing_values_follow_default_left(model, forest, features):
+    # transform_frame imputes every missing input, so NaN is set in the matrix directly
+    rng = np.random.default_rng(0)
+    with_missing = features[rng.integers(0, len(features), 2000)]
+    with_missing[rng.random(with_missing.shape) < 0.3] = np.nan
+    with_missing[:10] = np.nan
+    assert np.allclose(forest.predict_proba(with_missing), model.predict_proba(with_missing), atol=1e-5)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, None, 5000])
+def test_chunk_size_does_not_change_margins(forest, features, chunk_size):
+    assert np.array_equal(forest.predict_margin(features[:500], chunk_size=chunk_size),
+                          forest.predict_margin(features[:500], chunk_size=500))
+
+
+def test_early_stopped_model_scores_up_to_best_iteration():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(600, 5)).astype(np.float32)
+    y = (x[:, 0] + rng.normal(size=600) > 0).astype(int) + (x[:, 1] > 1)
+    model = xgboost.XGBClassifier(n_estimators=200, max_depth=3, learning_rate=0.3, early_stopping_rounds=5)
+    model.fit(x[:400], y[:400], eval_set=[(x[400:], y[400:])], verbose=False)
+    assert model.best_iteration + 1 < model.get_booster().num_boosted_rounds()
+
+    compiled = build_scorer(model, 'compiled').predict_proba(x)
+    assert np.allclose(compiled, model.predict_proba(x), atol=1e-5)
+    assert np.allclose(compiled, build_scorer(model, 'booster').predict_proba(x), atol=1e-5)
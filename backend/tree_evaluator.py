@@ -0,0 +1,201 @@
+import os
+import json
+import argparse
+import time
+import numpy as np
+
+MAX_DEPTH = 12
+# Node tests evaluated per chunk of rows: small enough that a chunk's working
+# arrays stay in cache, which measured several times faster than 64-row
+# chunks on the 900-tree model (and than whole-batch evaluation)
+CHUNK_NODES = 1 << 17
+
+
+class CompiledForest:
+    """XGBoost tree ensemble flattened into packed NumPy arrays.
+
+    Every tree is padded to a complete binary tree of ``depth`` levels and
+    stored in heap order (children of node i are 2i+1 and 2i+2), so a batch
+    of rows walks all trees in lock-step with a handful of array operations
+    per level. Per-class margins are summed and passed through softmax the
+    same way multi:softprob does.
+
+    It is built for cold start and small requests: no xgboost import, a
+    single row in about 0.1 ms. Large batches score several times slower
+    than the native booster (pure NumPy, one thread), so bulk-heavy
+    deployments should serve with the booster backend.
+    """
+
+    name = 'compiled'
+
+    def __init__(self, feature, threshold, default_left, leaf_value, tree_class, base_margin):
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float32)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.leaf_value = np.asarray(leaf_value, dtype=np.float32)
+        self.tree_class = np.asarray(tree_class, dtype=np.int32)
+        self.base_margin = np.asarray(base_margin, dtype=np.float64)
+        self.n_trees, self.n_internal = self.feature.shape
+        self.depth = int(np.log2(self.leaf_value.shape[1]))
+        self.n_classes = len(self.base_margin)
+
+        self._feature = self.feature.ravel()
+        self._threshold = self.threshold.ravel()
+        self._default_right = ~self.default_left.ravel()
+        self._leaf_value = self.leaf_value.ravel()
+        self._leaf_offset = np.arange(self.n_trees, dtype=np.intp) * self.leaf_value.shape[1]
+        self._class_matrix = np.zeros((self.n_trees, self.n_classes), dtype=np.float64)
+        self._class_matrix[np.arange(self.n_trees), self.tree_class] = 1.0
+
+    @classmethod
+    def from_booster(cls, booster, iteration_range=None):
+        learner = json.loads(booster.save_raw('json'))['learner']
+        n_classes = max(1, int(learner['learner_model_param'].get('num_class', 1)))
+        base_score = learner['learner_model_param']['base_score'].strip('[]').split(',')
+        base_margin = np.resize(np.array([float(v) for v in base_score], dtype=np.float64), n_classes)
+
+        gbtree = learner['gradient_booster']['model']
+        trees = gbtree['trees']
+        tree_info = gbtree['tree_info']
+        if iteration_range is not None:
+            indptr = gbtree['iteration_indptr']
+            begin, end = iteration_range
+            trees = trees[indptr[begin]:indptr[end]]
+            tree_info = tree_info[indptr[begin]:indptr[end]]
+
+        for tree in trees:
+            if any(tree.get('split_type', [])):
+                raise ValueError("Categorical splits are not supported by the compiled forest")
+        depth = max(tree_depth(tree) for tree in trees)
+        if depth > MAX_DEPTH:
+            raise ValueError(f"Trees of depth {depth} exceed the compiled forest limit of {MAX_DEPTH}")
+
+        n_internal = 2 ** depth - 1
+        feature = np.zeros((len(trees), n_internal), dtype=np.int32)
+        # Padding nodes always go left (x < inf, NaN defaults left) and both
+        # of their subtrees end in copies of the same leaf.
+        threshold = np.full((len(trees), n_internal), np.inf, dtype=np.float32)
+        default_left = np.ones((len(trees), n_internal), dtype=bool)
+        leaf_value = np.zeros((len(trees), 2 ** depth), dtype=np.float32)
+
+        for t, tree in enumerate(trees):
+            stack = [(0, 0, 0)]
+            while stack:
+                node, slot, level = stack.pop()
+                if level == depth:
+                    leaf_value[t, slot - n_internal] = tree['split_conditions'][node]
+                    continue
+                if tree['left_children'][node] == -1:
+                    stack.append((node, 2 * slot + 1, level + 1))
+                    stack.append((node, 2 * slot + 2, level + 1))
+                    continue
+                feature[t, slot] = tree['split_indices'][node]
+                threshold[t, slot] = tree['split_conditions'][node]
+                default_left[t, slot] = bool(tree['default_left'][node])
+                stack.append((tree['left_children'][node], 2 * slot + 1, level + 1))
+                stack.append((tree['right_children'][node], 2 * slot + 2, level + 1))
+
+        return cls(feature, threshold, default_left, leaf_value, tree_info, base_margin)
+
+    def leaf_values(self, features):
+        """Return the (n_rows, n_trees) leaf value each row reaches in each tree."""
+        n_rows = len(features)
+        x = features[:, self._feature]
+        go_right = x >= self._threshold
+        missing = np.isnan(x)
+        if missing.any():
+            go_right = np.where(missing, self._default_right, go_right)
+        go_right = go_right.ravel().view(np.uint8)
+
+        node_base = np.arange(n_rows * self.n_trees, dtype=np.intp) * self.n_internal
+        position = np.zeros(n_rows * self.n_trees, dtype=np.intp)
+        for level in range(self.depth):
+            position = 2 * position + go_right.take(node_base + (2 ** level - 1) + position)
+        return self._leaf_value.take(position.reshape(n_rows, self.n_trees) + self._leaf_offset)
+
+    def predict_margin(self, features, chunk_size=None):
+        features = np.asarray(features, dtype=np.float32)
+        if chunk_size is None:
+            chunk_size = max(1, CHUNK_NODES // (self.n_trees * self.n_internal))
+        margins = np.empty((len(features), self.n_classes), dtype=np.float64)
+        for start in range(0, len(features), chunk_size):
+            chunk = features[start:start + chunk_size]
+            margins[start:start + len(chunk)] = self.leaf_values(chunk) @ self._class_matrix
+        return margins + self.base_margin
+
+    def predict_proba(self, features):
+        margins = self.predict_margin(features)
+        margins -= margins.max(axis=1, keepdims=True)
+        np.exp(margins, out=margins)
+        margins /= margins.sum(axis=1, keepdims=True)
+        return margins.astype(np.float32)
+
+
+def tree_depth(tree):
+    depth = 0
+    stack = [(0, 0)]
+    while stack:
+        node, level = stack.pop()
+        if tree['left_children'][node] == -1:
+            depth = max(depth, level)
+        else:
+            stack.append((tree['left_children'][node], level + 1))
+            stack.append((tree['right_children'][node], level + 1))
+    return depth
+
+
+def verify(args):
+    import joblib
+    import pandas as pd
+    from model_store import load_bundle
+    loaded = load_bundle(args.bundle, 'compiled')
+    forest = loaded.scorer
+    features = loaded.feature_plan.transform_frame(pd.read_csv(args.csv))
+    # transform_frame imputes every missing input, so rows with NaN cells are added to reach the
+    # default_left branches; XGBoost sends NaN the same way
+    rng = np.random.default_rng(0)
+    with_missing = features[rng.integers(0, len(features), args.missing_rows)]
+    with_missing[rng.random(with_missing.shape) < args.missing_share] = np.nan
+    features = np.vstack([features, with_missing])
+
+    started = time.perf_counter()
+    compiled = forest.predict_proba(features)
+    compiled_seconds = time.perf_counter() - started
+
+    model = joblib.load(args.model)
+    started = time.perf_counter()
+    reference = model.predict_proba(features)
+    reference_seconds = time.perf_counter() - started
+
+    max_diff = float(np.abs(compiled - reference).max())
+    same_class = float(np.mean(compiled.argmax(axis=1) == reference.argmax(axis=1)))
+    print(f"Rows: {len(features)} ({len(with_missing)} with missing values)")
+    print(f"Compiled forest: {compiled_seconds * 1000:.1f} ms, predict_proba: {reference_seconds * 1000:.1f} ms")
+    print(f"Max absolute probability difference: {max_diff:.3g} (tolerance {args.tolerance:g})")
+    print(f"Predicted class agreement: {same_class * 100:.2f}%")
+    if max_diff > args.tolerance:
+        raise SystemExit("Compiled forest does not match predict_proba")
+    print("Compiled forest matches predict_proba")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the model bundle's pure-NumPy forest "
+                                                 "(written by 'python model_store.py build')")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    verify_parser = subparsers.add_parser('verify', help='Compare the compiled forest against predict_proba')
+    verify_parser.add_argument('csv', nargs='?', default=os.path.join('..', 'data', 'test.csv'))
+    verify_parser.add_argument('--model', default='final_xgb_model.pkl')
+    verify_parser.add_argument('--bundle', default='model_bundle')
+    verify_parser.add_argument('--missing-rows', type=int, default=2000,
+                               help='Extra rows with a share of their features set to NaN')
+    verify_parser.add_argument('--missing-share', type=float, default=0.3)
+    verify_parser.add_argument('--tolerance', type=float, default=1e-5)
+    verify_parser.set_defaults(func=verify)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
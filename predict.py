@@ -1,21 +1,29 @@
 # cirrhosis_prediction_app.py
-import joblib
+import os
+import sys
+import json
+import argparse
 import pandas as pd
 import numpy as np
 
-# Load the trained model and preprocessing components
-MODEL_PATH = 'final_xgb_model.pkl'
-PREPROCESSING_PATH = 'preprocessing_components.pkl'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from model_store import ModelStore, ModelLoadError, LEGACY_MODEL_FILE, LEGACY_PREPROCESSING_FILE
 
-try:
-    model = joblib.load(MODEL_PATH)
-    components = joblib.load(PREPROCESSING_PATH)
-    print("✅ Model and preprocessing components loaded successfully!")
-except FileNotFoundError:
-    print("❌ Error: Model files not found. Please ensure:")
-    print(f"- {MODEL_PATH} and {PREPROCESSING_PATH} exist in the current directory")
-    print("- You've run the full training pipeline first")
-    exit()
+# The trained model and preprocessing components are loaded on first use,
+# from the model bundle if present, otherwise from the pickles
+model_store = ModelStore.from_env()
+
+def load_model(log=sys.stdout):
+    try:
+        loaded = model_store.get()
+    except ModelLoadError:
+        print("❌ Error: Model files not found. Please ensure:", file=log)
+        print(f"- model_bundle/ or {LEGACY_MODEL_FILE} and {LEGACY_PREPROCESSING_FILE} exist in the current directory", file=log)
+        print("- You've run the full training pipeline first", file=log)
+        sys.exit(1)
+    print("✅ Model and preprocessing components loaded successfully!", file=log)
+    print(f"🔍 Model expects {loaded.feature_plan.n_features} features", file=log)
+    return loaded
 
 # Clinical feature descriptions for user guidance
 FEATURE_DESCRIPTIONS = {
@@ -39,13 +47,11 @@ FEATURE_DESCRIPTIONS = {
     'Stage': 'Histologic stage of disease (1-4)'
 }
 
-# Get all expected features from the model
-EXPECTED_FEATURES = components['feature_names']
-print(f"🔍 Model expects {len(EXPECTED_FEATURES)} features")
-
-def get_user_input():
+def get_user_input(feature_plan):
     """Collect user input for each clinical feature"""
     patient_data = {}
+    categorical_classes = feature_plan.categorical_classes()
+    default_values = {feature: median for feature, _, median in feature_plan.numerical}
     
     print("\n" + "="*50)
     print("CIRRHOSIS STATUS PREDICTION TOOL")
@@ -55,7 +61,7 @@ def get_user_input():
     print("="*50)
     
     # Collect all expected features
-    for feature in EXPECTED_FEATURES:
+    for feature in feature_plan.feature_names:
         description = FEATURE_DESCRIPTIONS.get(feature, feature)
         
         # Handle special case for Alk_Phos
@@ -64,12 +70,11 @@ def get_user_input():
         else:
             prompt_name = feature
             
-        # Get encoder if available
-        encoder = components['categorical_encoders'].get(feature) if 'categorical_encoders' in components else None
+        # Get encoder classes if available
+        valid_options = categorical_classes.get(feature)
         
-        if encoder:
+        if valid_options:
             # Categorical feature
-            valid_options = list(encoder.classes_)
             formatted_options = ", ".join(valid_options)
             
             while True:
@@ -82,9 +87,7 @@ def get_user_input():
         else:
             # Numeric feature
             # Find default value if available
-            default_value = None
-            if 'imputation_values' in components and feature in components['imputation_values']:
-                default_value = components['imputation_values'][feature]
+            default_value = default_values.get(feature)
             
             while True:
                 value_input = input(f"{prompt_name} ({description}): ")
@@ -101,19 +104,21 @@ def get_user_input():
     
     return patient_data
 
-def preprocess_input(input_data, components):
+def preprocess_input(input_data, feature_plan):
     """Preprocess user input to match model requirements"""
     # Create DataFrame
     input_df = pd.DataFrame([input_data])
     
     # Encode categorical features
-    if 'categorical_encoders' in components:
-        for feature, encoder in components['categorical_encoders'].items():
-            if feature in input_df.columns:
-                input_df[feature] = encoder.transform(input_df[feature])
+    for feature, classes in feature_plan.categorical_classes().items():
+        if feature in input_df.columns:
+            value = input_df[feature].iloc[0]
+            if value not in classes:
+                raise ValueError(f"Unknown value '{value}' for {feature}")
+            input_df[feature] = classes.index(value)
     
     # Ensure correct feature order
-    input_df = input_df[EXPECTED_FEATURES]
+    input_df = input_df[list(feature_plan.feature_names)]
     
     return input_df
 
@@ -198,21 +203,129 @@ def display_results(results):
     for rec in recommendations[results['predicted_class']]:
         print(f"- {rec}")
 
+def read_jsonl(lines):
+    """Yield (line_number, record, error) for each non-blank JSON line."""
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_number, None, "Each line must be a JSON object"
+            continue
+        yield line_number, record, None
+
+def score_records(records, loaded, id_field='id'):
+    """Score a micro-batch of (line_number, record) pairs and return output dicts in input order.
+
+    The batch is encoded in one go; if any record has an unknown category,
+    records are encoded one by one so only the bad ones are reported.
+    """
+    feature_plan = loaded.feature_plan
+    frame = pd.DataFrame.from_records([record for _, record in records], columns=list(feature_plan.feature_names))
+    try:
+        features = feature_plan.encode_frame(frame)
+        errors = [None] * len(records)
+    except ValueError:
+        features = np.zeros((len(records), feature_plan.n_features), dtype=np.float32)
+        errors = []
+        for i in range(len(records)):
+            try:
+                features[i] = feature_plan.encode_frame(frame.iloc[i:i + 1])[0]
+                errors.append(None)
+            except ValueError as e:
+                errors.append(str(e))
+    valid = [i for i, error in enumerate(errors) if error is None]
+    probabilities = loaded.scorer.predict_proba(features[valid]) if valid else []
+
+    results = [{id_field: record[id_field]} if id_field in record else {} for _, record in records]
+    for i, row in zip(valid, probabilities):
+        interpreted = interpret_prediction(row[np.newaxis])
+        results[i].update({
+            'predicted_class': interpreted['predicted_class'],
+            'confidence': float(interpreted['confidence']),
+            'risk_level': interpreted['risk_level'],
+            'probabilities': {status: float(prob) for status, prob in interpreted['probabilities'].items()}
+        })
+    for i, error in enumerate(errors):
+        if error is not None:
+            results[i].update({'line': records[i][0], 'error': error})
+    return results
+
+def run_jsonl(input_file, output_file, batch_size, id_field='id'):
+    """Score JSON Lines patient records in micro-batches, writing one JSON line per record.
+
+    Only one batch is held in memory at a time and output is flushed after
+    each batch, so the mode can sit in a pipe of any length.
+    """
+    loaded = load_model(log=sys.stderr)
+    scored = failed = 0
+    batch = []
+
+    def flush():
+        nonlocal scored, failed
+        if not batch:
+            return
+        for result in score_records(batch, loaded, id_field):
+            if 'error' in result:
+                failed += 1
+            else:
+                scored += 1
+            output_file.write(json.dumps(result) + '\n')
+        batch.clear()
+        output_file.flush()
+
+    for line_number, record, error in read_jsonl(input_file):
+        if error is not None:
+            flush()
+            output_file.write(json.dumps({'line': line_number, 'error': error}) + '\n')
+            failed += 1
+            continue
+        batch.append((line_number, record))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    print(f"✅ Scored {scored} records ({failed} errors)", file=sys.stderr)
+
 def main():
     """Main application flow"""
+    parser = argparse.ArgumentParser(description='Predict cirrhosis status interactively or from JSON Lines')
+    parser.add_argument('--jsonl', nargs='?', const='-', metavar='INPUT',
+                        help='Score JSON Lines patient records from INPUT (default: stdin) instead of prompting')
+    parser.add_argument('--output', default='-', help='Where to write JSON Lines results (default: stdout)')
+    parser.add_argument('--batch-size', type=int, default=256, help='Records scored per model call')
+    parser.add_argument('--id-field', default='id', help='Record field copied to each result line')
+    args = parser.parse_args()
+
+    if args.jsonl is not None:
+        input_file = sys.stdin if args.jsonl == '-' else open(args.jsonl, encoding='utf-8')
+        output_file = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+        try:
+            run_jsonl(input_file, output_file, max(1, args.batch_size), args.id_field)
+        finally:
+            for f in (input_file, output_file):
+                if f not in (sys.stdin, sys.stdout):
+                    f.close()
+        return
+
+    loaded = load_model()
+    
     # Get user input
-    user_data = get_user_input()
+    user_data = get_user_input(loaded.feature_plan)
     
     # Preprocess input
     try:
-        processed_data = preprocess_input(user_data, components)
+        processed_data = preprocess_input(user_data, loaded.feature_plan)
     except Exception as e:
         print(f"❌ Error during preprocessing: {str(e)}")
         print("Please check your input values and try again.")
         return
     
     # Make prediction
-    probabilities = model.predict_proba(processed_data)
+    probabilities = loaded.scorer.predict_proba(processed_data.to_numpy(dtype=np.float32))
     
     # Interpret results
     results = interpret_prediction(probabilities)